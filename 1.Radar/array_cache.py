@@ -0,0 +1,100 @@
+"""
+Cache of arrays computed once per key, in memory and optionally on disk.
+
+The gridding weights (grid_weights), composite index maps (composite),
+region label arrays (region_masks) and quicklook layouts (quicklooks) are
+slow to build and depend only on a key (a hash of the geometry and the
+options). ArrayCache keeps the entries of the keys in memory and, with a
+cache directory, in <cache_dir>/<key>.npz files, written to a temporary
+file first and renamed, so a reader never sees a partial file and
+processes sharing the directory can write the same key.
+
+Subclasses convert their entries to and from dictionaries of arrays with
+_to_arrays and _from_arrays, and get their entries with _cached.
+
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+class ArrayCache(object):
+    """
+    Entries of keys cached in memory and optionally on disk.
+
+    Parameters
+    ----------
+    cache_dir : str or None, optional
+        Directory where the entries are stored, created if needed. None
+        keeps them in memory only.
+
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.loads = 0
+        self.builds = 0
+        self.rebuilds = 0
+        self._memory = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, key):
+        """File of the entry of a key."""
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _to_arrays(self, entry):
+        """Dictionary of the arrays of an entry, stored on disk."""
+        return entry
+
+    def _from_arrays(self, arrays):
+        """Entry of a dictionary of arrays loaded from disk."""
+        return arrays
+
+    def _load(self, key):
+        """Entry of a key stored on disk, or None."""
+        if self.cache_dir is None:
+            return None
+        filename = self._path(key)
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as f:
+            return self._from_arrays(dict([(name, f[name]) for name in f.files]))
+
+    def _save(self, key, entry):
+        """Store an entry on disk, replacing the file atomically."""
+        if self.cache_dir is None:
+            return
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".npz", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **self._to_arrays(entry))
+        os.replace(tmp, self._path(key))
+
+    def _cached(self, key, build, valid=None):
+        """
+        Entry of a key, from memory, disk or build(). Entries for which
+        valid(entry) is False are built again (counted as rebuilds).
+        """
+        entry = self._memory.get(key)
+        if entry is not None:
+            self.hits += 1
+        else:
+            entry = self._load(key)
+            if entry is not None:
+                self.loads += 1
+        if entry is not None and valid is not None and not valid(entry):
+            self.rebuilds += 1
+            entry = None
+        if entry is None:
+            self.builds += 1
+            entry = build()
+            self._save(key, entry)
+        self._memory[key] = entry
+        return entry
+
+    def stats(self):
+        """Number of entries found in memory (hits), loaded and built."""
+        return {"hits": self.hits, "loads": self.loads, "builds": self.builds}
@@ -0,0 +1,380 @@
+"""
+Batch conversion of radar files to CF/Radial (radar volumes) or CF grid
+(CAPPIs) NetCDF files.
+
+Inputs can be any mix of Rainbow HDF5 (read_rainbow_hdf5), GAMIC HDF5
+(pyart.aux_io.read_gamic), MIRA .mmclx (read_mira), SIPAM CAPPI
+(read_sipam_cappi) and FCTH CAPPI (read_fcth_cappi) files. The reader of
+each file is chosen from its contents, not its name. Files are converted
+by a pool of processes, and outputs newer than their input are skipped, as
+are files of other formats (reported as unsupported). Outputs keep the
+directories of the inputs below their common directory.
+The readers are imported before the pool is started, so the workers do
+not import Py-ART again. Run from this folder with:
+
+    python batch_ingest.py ../dados/radar/XPOL_CMP "/data/mira/*.mmclx" \\
+        -o /data/cfradial -j 4 --summary timing.json
+
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import netCDF4
+import pyart
+
+from read_brazil_radar_py3 import read_rainbow_hdf5
+from read_fcth_cappis import read_fcth_cappi
+from read_mira_radar import read_mira
+from read_sipam_cappis import read_sipam_cappi
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+NETCDF3_SIGNATURE = b"CDF"
+GZIP_SIGNATURE = b"\x1f\x8b"
+
+# how/software of the GAMIC HDF5 volumes (Sao Roque and SIPAM radars)
+GAMIC_SOFTWARE = ["FROG", "MURAN"]
+
+
+def _classify_variables(names):
+    """Kind of a netCDF file, from the names of its variables."""
+    if "x0" in names and "z0" in names:
+        return "sipam"
+    if "NyquistVelocity" in names and "range" in names:
+        return "mira"
+    return None
+
+
+def detect_format(filename):
+    """
+    Kind of a radar file, from its signature and structure.
+
+    Returns
+    -------
+    kind : str or None
+        'rainbow_hdf5', 'gamic', 'mira', 'sipam', 'fcth' or None if
+        unknown.
+    """
+    with open(filename, "rb") as f:
+        head = f.read(8)
+    if head == HDF5_SIGNATURE:
+        with h5py.File(filename, "r") as r:
+            if "scan0" in r and "where" in r:
+                # both have the same layout, but GAMIC files have their own
+                # software name
+                software = ""
+                if "how" in r:
+                    software = str(r["how"].attrs.get("software", ""))
+                for name in GAMIC_SOFTWARE:
+                    if name in software:
+                        return "gamic"
+                return "rainbow_hdf5"
+            return _classify_variables(list(r.keys()))
+    if head[:3] == NETCDF3_SIGNATURE:
+        with netCDF4.Dataset(filename) as d:
+            return _classify_variables(list(d.variables))
+    # FCTH CAPPIs are raw float32 grids, with or without gzip
+    name = os.path.basename(filename)
+    if name.endswith(".dat") or (
+        name.endswith(".dat.gz") and head[:2] == GZIP_SIGNATURE
+    ):
+        return "fcth"
+    return None
+
+
+def read_file(filename, kind=None):
+    """
+    Read a file with the reader of its kind, detected if kind is None.
+    MIRA files are returned without their melting layer heights.
+    """
+    if kind is None:
+        kind = detect_format(filename)
+        if kind is None:
+            raise ValueError("unknown file format")
+    if kind == "rainbow_hdf5":
+        return read_rainbow_hdf5(filename)
+    if kind == "gamic":
+        return pyart.aux_io.read_gamic(filename)
+    if kind == "mira":
+        return read_mira(filename)[0]
+    if kind == "sipam":
+        return read_sipam_cappi(filename)
+    return read_fcth_cappi(filename)
+
+
+def _write(obj, filename):
+    """Write a Radar as CF/Radial or a Grid as CF grid NetCDF."""
+    if isinstance(obj, pyart.core.Grid):
+        # SIPAM CAPPIs have no origin altitude, which write_grid requires
+        if obj.origin_altitude is None:
+            obj.origin_altitude = dict(obj.radar_altitude)
+        pyart.io.write_grid(filename, obj)
+    else:
+        pyart.io.write_cfradial(filename, obj)
+
+
+def output_name(filename, output_dir, root=None):
+    """
+    Output file of an input file, <output_dir>/<input name>.nc, or
+    <output_dir>/<directory of the input below root>/<input name>.nc if
+    root is given.
+    """
+    name = os.path.basename(filename)
+    for ext in [".gz", ".HDF5", ".hdf5", ".h5", ".mvol", ".mmclx", ".nc", ".dat"]:
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+    if root is not None:
+        relative = os.path.relpath(os.path.dirname(os.path.abspath(filename)), root)
+        if relative != os.curdir:
+            output_dir = os.path.join(output_dir, relative)
+    return os.path.join(output_dir, name + ".nc")
+
+
+def output_names(filenames, output_dir):
+    """
+    Output files of input files, keeping their directories below their
+    common directory, see output_name.
+
+    Raises
+    ------
+    ValueError
+        If two inputs have the same output (e.g. a.HDF5 and a.h5 in the
+        same directory), or an output is its own input (a .nc file
+        converted into its own directory).
+    """
+    if not filenames:
+        return []
+    root = os.path.commonpath(
+        [os.path.dirname(os.path.abspath(f)) for f in filenames]
+    )
+    outputs = [output_name(f, output_dir, root) for f in filenames]
+    inputs = {}
+    for filename, output in zip(filenames, outputs):
+        if os.path.abspath(output) == os.path.abspath(filename):
+            raise ValueError("%s would be overwritten by its output" % filename)
+        if output in inputs:
+            raise ValueError(
+                "%s and %s have the same output %s"
+                % (inputs[output], filename, output)
+            )
+        inputs[output] = filename
+    return outputs
+
+
+def is_up_to_date(filename, output):
+    """True if output exists and is newer than filename."""
+    return (
+        os.path.exists(output)
+        and os.path.getmtime(output) >= os.path.getmtime(filename)
+    )
+
+
+def convert_file(filename, output, kind=None):
+    """
+    Convert one file, of a kind detected if None, returning a dictionary
+    with its kind, status ('written' or 'failed'), read and write times in
+    seconds, input and output sizes in bytes and the error message if it
+    failed.
+    """
+    result = {
+        "input": filename,
+        "output": output,
+        "kind": None,
+        "status": "failed",
+        "read_seconds": 0.0,
+        "write_seconds": 0.0,
+        "input_bytes": os.path.getsize(filename),
+        "output_bytes": 0,
+        "error": None,
+    }
+    try:
+        result["kind"] = kind or detect_format(filename)
+        if result["kind"] is None:
+            raise ValueError("unknown file format")
+        t0 = time.perf_counter()
+        obj = read_file(filename, result["kind"])
+        t1 = time.perf_counter()
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        # write to a temporary name, so an interrupted run never leaves an
+        # output that looks up to date
+        tmp = output + ".part"
+        _write(obj, tmp)
+        os.replace(tmp, output)
+        t2 = time.perf_counter()
+        result["read_seconds"] = t1 - t0
+        result["write_seconds"] = t2 - t1
+        result["output_bytes"] = os.path.getsize(output)
+        result["status"] = "written"
+    except Exception as err:
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+        if os.path.exists(output + ".part"):
+            os.remove(output + ".part")
+    return result
+
+
+def expand_inputs(inputs):
+    """Files of a list of files, directories and glob patterns."""
+    filenames = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            paths = glob.glob(item)
+        filenames.extend(sorted([p for p in paths if os.path.isfile(p)]))
+    return filenames
+
+
+def batch_ingest(inputs, output_dir, workers=None, force=False, log=print):
+    """
+    Convert many radar files to CF NetCDF with a pool of processes.
+
+    Parameters
+    ----------
+    inputs : list of str
+        Files, directories and glob patterns to convert.
+    output_dir : str
+        Directory of the output files, created if needed.
+    workers : int or None, optional
+        Number of processes. None uses the number of CPUs.
+    force : bool, optional
+        True to convert files whose output is up to date.
+    log : callable or None, optional
+        Function called with a line of text for each file.
+
+    Returns
+    -------
+    summary : dict
+        'files', the list of results of convert_file (files with an up to
+        date output have status 'skipped', and files of unknown format
+        'unsupported'), and totals of files, bytes and seconds.
+
+    Raises
+    ------
+    ValueError
+        If two inputs have the same output, or an output is its input, see
+        output_names.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    t0 = time.perf_counter()
+    results = []
+    jobs = []
+    filenames = expand_inputs(inputs)
+    for filename, output in zip(filenames, output_names(filenames, output_dir)):
+        if not force and is_up_to_date(filename, output):
+            results.append(
+                {"input": filename, "output": output, "status": "skipped"}
+            )
+            continue
+        try:
+            kind = detect_format(filename)
+        except Exception:
+            # unreadable signature or structure, convert_file reports it
+            jobs.append((filename, output, None))
+            continue
+        if kind is None:
+            results.append(
+                {"input": filename, "output": None, "status": "unsupported"}
+            )
+            if log is not None:
+                log("%-8s %-12s %7s    %s" % ("skip", "unsupported", "", filename))
+        else:
+            jobs.append((filename, output, kind))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert_file, *job) for job in jobs]
+        for future in as_completed(futures):
+            res = future.result()
+            results.append(res)
+            if log is not None:
+                if res["status"] == "written":
+                    log(
+                        "%-8s %-12s %7.2f s  %s"
+                        % (
+                            "ok",
+                            res["kind"],
+                            res["read_seconds"] + res["write_seconds"],
+                            res["input"],
+                        )
+                    )
+                else:
+                    log(
+                        "%-8s %-12s %7s    %s (%s)"
+                        % ("FAILED", res["kind"], "", res["input"], res["error"])
+                    )
+    elapsed = time.perf_counter() - t0
+
+    written = [r for r in results if r["status"] == "written"]
+    nbytes = sum([r["input_bytes"] for r in written])
+    return {
+        "files": results,
+        "written": len(written),
+        "skipped": len([r for r in results if r["status"] == "skipped"]),
+        "failed": len([r for r in results if r["status"] == "failed"]),
+        "unsupported": len([r for r in results if r["status"] == "unsupported"]),
+        "input_bytes": nbytes,
+        "seconds": elapsed,
+        "files_per_second": len(written) / elapsed if elapsed else 0.0,
+        "megabytes_per_second": nbytes / 2**20 / elapsed if elapsed else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert radar files to CF/Radial or CF grid NetCDF."
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", required=True, help="directory of the outputs"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="number of processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="convert files whose output is up to date",
+    )
+    parser.add_argument(
+        "--summary", default=None,
+        help="write the per-file timings and totals to this JSON file",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        summary = batch_ingest(
+            args.inputs, args.output_dir, args.workers, args.force
+        )
+    except ValueError as err:
+        # outputs that collide or would overwrite an input
+        parser.error(str(err))
+    print(
+        "%d written, %d skipped, %d unsupported, %d failed in %.1f s "
+        "(%.2f files/s, %.1f MB/s)"
+        % (
+            summary["written"],
+            summary["skipped"],
+            summary["unsupported"],
+            summary["failed"],
+            summary["seconds"],
+            summary["files_per_second"],
+            summary["megabytes_per_second"],
+        )
+    )
+    if args.summary is not None:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,641 @@
+"""
+Benchmarks for the radar readers in this folder.
+
+Each case runs a reader on an input in a fresh child process, stage by
+stage, and records for every stage the wall time, the peak resident memory
+of the process and the bytes it read (rchar, through read calls, and
+read_bytes, from storage, from /proc/self/io). Cases are run with a cold
+page cache (the input files are evicted with posix_fadvise first) and a
+warm one (the files are read once first).
+
+Inputs are the samples in ../dados/radar and synthetic files written in a
+temporary directory: Rainbow HDF5 volumes with the sweeps of the samples
+repeated, MIRA .mmclx files and SIPAM CAPPI files. Each input is also
+scaled to 2x and 10x its sweeps, times, levels or files, so the time per
+unit shows any non-linear behaviour. Run from this folder with:
+
+    python benchmark_readers.py --output benchmark.json
+    python benchmark_readers.py --scales 1 2 --output new.json --compare benchmark.json
+
+With --trace, the spans of the readers (see reader_trace) are also
+written to a JSON lines file, which slows the readers down slightly.
+
+The import time of each reader module, and of the gridding and composite
+modules, in a fresh interpreter, is also recorded. Importing them must not
+import Py-ART, which is only imported when a Radar or Grid is built. With
+--import-budget, only the imports are checked, and the exit status is 1 if
+a module imports Py-ART or takes longer than the budget:
+
+    python benchmark_readers.py --import-budget 0.5
+
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import h5py
+import netCDF4
+import numpy as np
+
+from read_brazil_radar_py3 import read_rainbow_hdf5
+from read_mira_radar import read_mira, read_multi_mira
+from read_sipam_cappis import read_sipam_cappi
+from reader_trace import Trace, process_io
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dados")
+XPOL_CMP = os.path.join(DATA_DIR, "radar", "XPOL_CMP", "117BRX-20171115215006.HDF5")
+XPOL_RELAMPAGO = os.path.join(
+    DATA_DIR, "radar", "XPOL_RELAMPAGO", "117BRX-20181127130002.HDF5"
+)
+
+READERS = ["rainbow_hdf5", "mira", "multi_mira", "sipam_cappi"]
+READER_MODULES = [
+    "read_brazil_radar_py3",
+    "read_fcth_cappis",
+    "read_mira_radar",
+    "read_rainbow_vol",
+    "read_sipam_cappis",
+    "read_xpol_rhi",
+]
+# modules importing the readers lazily, held to the same rule
+IMPORT_MODULES = READER_MODULES + ["grid_weights", "composite"]
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start, "pyart" in sys.modules)
+"""
+
+
+def make_rainbow_hdf5(source, dest, nsweeps):
+    """
+    Write a Rainbow HDF5 volume with `nsweeps` sweeps, repeating the scans
+    of `source` in order. Scan timestamps are kept, so the sweep timing
+    of the copy is only meaningful for benchmarking.
+    """
+    with h5py.File(source, "r") as src, h5py.File(dest, "w") as dst:
+        scans = sorted([k for k in src if k[:4] == "scan"], key=lambda k: int(k[4:]))
+        for key in src:
+            if key[:4] != "scan":
+                src.copy(src[key], dst, name=key)
+        for i in range(nsweeps):
+            src.copy(src[scans[i % len(scans)]], dst, name="scan" + str(i))
+        # keep the timestamps increasing and consistent with the scan speed,
+        # so the last sweep time can be fitted
+        stamp = np.datetime64("2017-11-15T21:50:06")
+        for i in range(nsweeps):
+            duration = 19 + i % 3
+            how = dst["scan" + str(i)]["how"]
+            how.attrs["timestamp"] = np.array([str(stamp) + ".000Z"], dtype=object)
+            how.attrs["scan_speed"] = np.array([360.0 / duration])
+            stamp = stamp + np.timedelta64(duration, "s")
+
+
+def make_mmclx(dest, start, ntimes=360, ngates=500, seed=0):
+    """
+    Write a synthetic MIRA-35C .mmclx file with `ntimes` profiles every
+    10 s from `start` (seconds since 1970) and `ngates` gates every 30 m,
+    with the variables and attributes read by read_mira.
+    """
+    rng = np.random.default_rng(seed)
+    with netCDF4.Dataset(dest, "w", format="NETCDF4") as d:
+        d.Latitude = "22.81S"
+        d.Longitude = "47.06W"
+        d.Altitude = "600m"
+        d.hrd = "HEADER\nAVE: 10\nCAL: 1"
+        d.createDimension("time", None)
+        d.createDimension("range", ngates)
+        var = d.createVariable("time", "i4", ("time",))
+        var.units = "seconds since 1970-01-01 00:00:00 UTC"
+        var[:] = start + 10 * np.arange(ntimes)
+        var = d.createVariable("range", "f4", ("range",))
+        var.units = "m"
+        var[:] = 150.0 + 30.0 * np.arange(ngates)
+        for name in ["Ze", "Zg", "VEL", "RMS", "LDR", "SNR"]:
+            var = d.createVariable(
+                name, "f4", ("time", "range"), fill_value=np.float32(-999.0)
+            )
+            var.long_name = name
+            var.units = "x"
+            data = rng.lognormal(-3.0, 2.0, (ntimes, ngates)).astype("f4")
+            data[rng.random((ntimes, ngates)) < 0.3] = -999.0
+            var[:] = data
+        scalars = [("lambda", 0.0085), ("prf", 5000.0), ("NyquistVelocity", 10.6)]
+        for name, value in scalars:
+            d.createVariable(name, "f4", ())[:] = value
+        d.createVariable("nave", "i4", ())[:] = 10
+        for name in ["MeltHei", "MeltHeiDet", "MeltHeiDB"]:
+            var = d.createVariable(name, "f4", ("time",))
+            var.long_name = name
+            var.units = "m"
+            var.yrange = "0 8000"
+            var[:] = rng.uniform(3500, 4500, ntimes)
+
+
+def make_sipam_cappi(dest, nz=20, ny=241, nx=241, seed=0):
+    """
+    Write a synthetic SIPAM CAPPI file (sbmn_cappi_*.nc layout) with `nz`
+    levels every 1 km and ny x nx points every 2 km, read by
+    read_sipam_cappi.
+    """
+    rng = np.random.default_rng(seed)
+    with netCDF4.Dataset(dest, "w", format="NETCDF4") as d:
+        d.title = "SIPAM CAPPI"
+        d.Conventions = "CF-1.6"
+        for name, size in [("time", 1), ("z0", nz), ("y0", ny), ("x0", nx), ("nv", 2)]:
+            d.createDimension(name, size)
+        for name in ["time", "start_time", "stop_time"]:
+            var = d.createVariable(name, "f8", ("time",))
+            var.units = "seconds since 2014-03-01 00:00:00"
+            var[:] = 28803.0
+        d.variables["time"].standard_name = "time"
+        d.createVariable("time_bounds", "f8", ("time", "nv"))[:] = [[28803.0, 29523.0]]
+        for name, size, step in [("x0", nx, 2.0), ("y0", ny, 2.0), ("z0", nz, 1.0)]:
+            var = d.createVariable(name, "f4", (name,))
+            var.units = "km"
+            if name == "z0":
+                var[:] = 1.0 + step * np.arange(size)
+            else:
+                var[:] = step * (np.arange(size) - (size - 1) / 2.0)
+        var = d.createVariable("grid_mapping_0", "i4", ())
+        var.grid_mapping_name = "azimuthal_equidistant"
+        var.latitude_of_projection_origin = -3.1493
+        var.longitude_of_projection_origin = -59.992
+        lon, lat = np.meshgrid(
+            -59.992 + 0.018 * (np.arange(nx) - nx // 2),
+            -3.1493 + 0.018 * (np.arange(ny) - ny // 2),
+        )
+        d.createVariable("lat0", "f4", ("y0", "x0"))[:] = lat
+        d.createVariable("lon0", "f4", ("y0", "x0"))[:] = lon
+        for name in ["DBZc", "VEL"]:
+            var = d.createVariable(
+                name,
+                "f4",
+                ("time", "z0", "y0", "x0"),
+                fill_value=np.float32(-9999.0),
+            )
+            var.units = "dBZ"
+            var.long_name = name
+            var.grid_mapping = "grid_mapping_0"
+            data = rng.normal(20.0, 10.0, (1, nz, ny, nx)).astype("f4")
+            data[rng.random(data.shape) < 0.5] = -9999.0
+            var[:] = data
+
+
+def _rss_mb():
+    """Resident memory of this process in MB, from /proc/self/status."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return float("nan")
+
+
+def evict(filenames):
+    """Drop files from the page cache, so they are read from storage."""
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def warm(filenames):
+    """Read files once, so they are in the page cache."""
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            while f.read(2**24):
+                pass
+
+
+def _run_stages(stages, conn):
+    """Run stages in this (child) process, sending their measurements."""
+    results = []
+    value = None
+    for name, stage in stages:
+        gc.collect()
+        rchar0, read_bytes0 = process_io()
+        rss0 = _rss_mb()
+        t0 = time.perf_counter()
+        value = stage(value)
+        seconds = time.perf_counter() - t0
+        rchar1, read_bytes1 = process_io()
+        # ru_maxrss is the peak of the whole child, in kB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        results.append(
+            {
+                "name": name,
+                "seconds": seconds,
+                "rss_before_mb": rss0,
+                "peak_rss_mb": peak,
+                "rchar": rchar1 - rchar0,
+                "read_bytes": read_bytes1 - read_bytes0,
+            }
+        )
+    conn.send(results)
+    conn.close()
+
+
+def run_case(stages, filenames, cache="cold", repeat=3):
+    """
+    Run the stages of a case `repeat` times, each in a new process.
+
+    Parameters
+    ----------
+    stages : list of (str, callable)
+        Stage names and functions, each called with the result of the
+        previous stage (None for the first).
+    filenames : list of str
+        Input files, evicted from or loaded into the page cache before
+        each run.
+    cache : str, optional
+        'cold' or 'warm'.
+    repeat : int, optional
+        Number of runs.
+
+    Returns
+    -------
+    stages : list of dict
+        For each stage: its name, best and all wall times in seconds,
+        largest peak RSS in MB (of the process, including the memory
+        before the stage, 'rss_before_mb'), and bytes read in the best
+        run.
+    """
+    context = multiprocessing.get_context("fork")
+    runs = []
+    for _ in range(repeat):
+        if cache == "cold":
+            evict(filenames)
+        else:
+            warm(filenames)
+        parent, child = context.Pipe(duplex=False)
+        process = context.Process(target=_run_stages, args=(stages, child))
+        process.start()
+        child.close()
+        runs.append(parent.recv())
+        process.join()
+        if process.exitcode:
+            raise RuntimeError("benchmark process failed")
+
+    summary = []
+    for i, (name, _) in enumerate(stages):
+        results = [run[i] for run in runs]
+        best = min(results, key=lambda r: r["seconds"])
+        summary.append(
+            {
+                "name": name,
+                "seconds": best["seconds"],
+                "seconds_all": [r["seconds"] for r in results],
+                "peak_rss_mb": max([r["peak_rss_mb"] for r in results]),
+                "rss_before_mb": best["rss_before_mb"],
+                "rchar": best["rchar"],
+                "read_bytes": best["read_bytes"],
+            }
+        )
+    return summary
+
+
+def _load_fields(obj):
+    """Access the data of every field, loading lazy fields."""
+    for field in obj.fields.values():
+        np.ma.asarray(field["data"]).sum()
+    return obj
+
+
+def rainbow_cases(tmpdir, scales):
+    """Cases of read_rainbow_hdf5: the XPOL samples with sweeps repeated."""
+    cases = []
+    for label, sample in [("XPOL_CMP", XPOL_CMP), ("XPOL_RELAMPAGO", XPOL_RELAMPAGO)]:
+        with h5py.File(sample, "r") as f:
+            base = len([k for k in f if k[:4] == "scan"])
+        for scale in scales:
+            fname = sample
+            if scale != 1:
+                fname = os.path.join(tmpdir, "%s_x%d.h5" % (label, scale))
+                make_rainbow_hdf5(sample, fname, base * scale)
+            cases.append(
+                {
+                    "reader": "rainbow_hdf5",
+                    "input": label,
+                    "scale": scale,
+                    "units": base * scale,
+                    "unit": "sweeps",
+                    "filenames": [fname],
+                    "stages": [
+                        (
+                            "read",
+                            lambda _, f=fname: read_rainbow_hdf5(
+                                f, delay_field_loading=True
+                            ),
+                        ),
+                        ("fields", _load_fields),
+                    ],
+                }
+            )
+    return cases
+
+
+def mira_cases(tmpdir, scales):
+    """
+    Cases of read_mira (one file with 360 x scale profiles) and
+    read_multi_mira (2 x scale files of 360 profiles).
+    """
+    cases = []
+    start = 1583452800  # 2020-03-06 00:00 UTC
+    for scale in scales:
+        fname = os.path.join(tmpdir, "mira_x%d.mmclx" % scale)
+        make_mmclx(fname, start, ntimes=360 * scale, seed=scale)
+        cases.append(
+            {
+                "reader": "mira",
+                "input": "synthetic",
+                "scale": scale,
+                "units": 360 * scale,
+                "unit": "profiles",
+                "filenames": [fname],
+                "stages": [("read", lambda _, f=fname: read_mira(f))],
+            }
+        )
+    files = []
+    for i in range(2 * max(scales)):
+        fname = os.path.join(tmpdir, "mira_%02d.mmclx" % i)
+        make_mmclx(fname, start + 3600 * i, seed=100 + i)
+        files.append(fname)
+    for scale in scales:
+        fnames = files[: 2 * scale]
+        cases.append(
+            {
+                "reader": "multi_mira",
+                "input": "synthetic",
+                "scale": scale,
+                "units": len(fnames),
+                "unit": "files",
+                "filenames": fnames,
+                "stages": [("read", lambda _, f=fnames: read_multi_mira(f))],
+            }
+        )
+    return cases
+
+
+def sipam_cases(tmpdir, scales):
+    """Cases of read_sipam_cappi: CAPPIs with 20 x scale levels."""
+    cases = []
+    for scale in scales:
+        fname = os.path.join(tmpdir, "sbmn_cappi_x%d.nc" % scale)
+        make_sipam_cappi(fname, nz=20 * scale, seed=scale)
+        cases.append(
+            {
+                "reader": "sipam_cappi",
+                "input": "synthetic",
+                "scale": scale,
+                "units": 20 * scale,
+                "unit": "levels",
+                "filenames": [fname],
+                "stages": [
+                    (
+                        "read",
+                        lambda _, f=fname: read_sipam_cappi(
+                            f, delay_field_loading=True
+                        ),
+                    ),
+                    ("fields", _load_fields),
+                ],
+            }
+        )
+    return cases
+
+
+def import_times(modules=IMPORT_MODULES, repeat=3):
+    """
+    Time the import of modules, each in a new interpreter.
+
+    Returns
+    -------
+    times : dict
+        For each module, the best import time in seconds and whether it
+        imported Py-ART.
+    """
+    times = {}
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.check_output(
+                [sys.executable, "-c", _IMPORT_SCRIPT % module],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            # the last line, after the Py-ART banner if it was imported
+            seconds, pyart = output.decode().splitlines()[-1].split()
+            runs.append((float(seconds), pyart == "True"))
+        times[module] = {
+            "seconds": min([run[0] for run in runs]),
+            "imports_pyart": any([run[1] for run in runs]),
+        }
+    return times
+
+
+def check_imports(times, budget):
+    """Messages for the modules of `import_times` over the budget."""
+    failures = []
+    for module, result in times.items():
+        if result["imports_pyart"]:
+            failures.append("%s imports pyart" % module)
+        if result["seconds"] > budget:
+            failures.append(
+                "%s takes %.3f s to import, budget %.3f s"
+                % (module, result["seconds"], budget)
+            )
+    return failures
+
+
+def _metadata():
+    """Description of the machine, versions and commit of a run."""
+    import pyart
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        )
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "h5py": h5py.__version__,
+        "netCDF4": netCDF4.__version__,
+        "pyart": pyart.__version__,
+        "commit": commit,
+    }
+
+
+def run_benchmarks(
+    readers=READERS, scales=(1, 2, 10), caches=("cold", "warm"), repeat=3, log=print
+):
+    """
+    Run the benchmark cases.
+
+    Returns
+    -------
+    results : dict
+        'meta', the machine and versions, and 'cases', a list with the
+        reader, input, scale, number of units (sweeps, profiles, files
+        or levels), cache state, input bytes, stages (see run_case),
+        total seconds and seconds per unit of each case.
+    """
+    builders = {
+        "rainbow_hdf5": rainbow_cases,
+        "mira": mira_cases,
+        "multi_mira": mira_cases,
+        "sipam_cappi": sipam_cases,
+    }
+    # _metadata imports Py-ART, so the forked cases do not time its import
+    results = {"meta": _metadata(), "cases": []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = []
+        for builder in set([builders[reader] for reader in readers]):
+            cases.extend([c for c in builder(tmpdir, scales) if c["reader"] in readers])
+        for case in cases:
+            for cache in caches:
+                stages = run_case(case["stages"], case["filenames"], cache, repeat)
+                total = sum([stage["seconds"] for stage in stages])
+                result = {
+                    "reader": case["reader"],
+                    "input": case["input"],
+                    "scale": case["scale"],
+                    "units": case["units"],
+                    "unit": case["unit"],
+                    "cache": cache,
+                    "input_bytes": sum([os.path.getsize(f) for f in case["filenames"]]),
+                    "stages": stages,
+                    "seconds": total,
+                    "seconds_per_unit": total / case["units"],
+                }
+                results["cases"].append(result)
+                if log is not None:
+                    log(_format_case(result))
+    return results
+
+
+def _case_key(case):
+    return (case["reader"], case["input"], case["scale"], case["cache"])
+
+
+def _format_case(case):
+    """One line of a case result."""
+    stages = " ".join(["%s %.3f s" % (s["name"], s["seconds"]) for s in case["stages"]])
+    line = "%-13s %-15s x%-3d %-5s %8.3f s %10.5f s/%s  peak %6.0f MB  read %6.1f MB"
+    return (line + "  (%s)") % (
+        case["reader"],
+        case["input"],
+        case["scale"],
+        case["cache"],
+        case["seconds"],
+        case["seconds_per_unit"],
+        case["unit"].rstrip("s"),
+        max([s["peak_rss_mb"] for s in case["stages"]]),
+        sum([s["rchar"] for s in case["stages"]]) / 2**20,
+        stages,
+    )
+
+
+def compare(results, reference, log=print):
+    """
+    Compare the times of two runs, case by case.
+
+    Returns
+    -------
+    ratios : dict
+        Ratio of the time of each case (reader, input, scale, cache) to
+        its time in the reference run, for the cases in both runs.
+    """
+    previous = dict([(_case_key(c), c) for c in reference["cases"]])
+    ratios = {}
+    for case in results["cases"]:
+        key = _case_key(case)
+        if key not in previous:
+            continue
+        ratios[key] = case["seconds"] / previous[key]["seconds"]
+        if log is not None:
+            log(
+                "%-13s %-15s x%-3d %-5s %8.3f s  was %8.3f s  (%5.2fx)"
+                % (key + (case["seconds"], previous[key]["seconds"], ratios[key]))
+            )
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the radar readers.")
+    parser.add_argument(
+        "--readers", nargs="+", choices=READERS, default=READERS,
+        help="readers to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--scales", nargs="+", type=int, default=[1, 2, 10],
+        help="input scales (default: 1 2 10)",
+    )
+    parser.add_argument(
+        "--cache", nargs="+", choices=["cold", "warm"], default=["cold", "warm"],
+        help="page cache states (default: cold warm)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case")
+    parser.add_argument("-o", "--output", default=None, help="JSON results file")
+    parser.add_argument(
+        "--compare", default=None, help="JSON results of a previous run to compare"
+    )
+    parser.add_argument(
+        "--trace", default=None, help="JSON lines file for the reader spans"
+    )
+    parser.add_argument(
+        "--import-budget", type=float, default=None,
+        help="only check the reader imports against this time in seconds",
+    )
+    args = parser.parse_args(argv)
+
+    if args.import_budget is not None:
+        times = import_times()
+        for module, result in times.items():
+            print("%-22s %.3f s" % (module, result["seconds"]))
+        failures = check_imports(times, args.import_budget)
+        for failure in failures:
+            print("FAIL " + failure)
+        return 1 if failures else 0
+
+    if args.trace is not None:
+        trace = Trace(args.trace, keep=False).start()
+    results = run_benchmarks(args.readers, args.scales, args.cache, args.repeat)
+    if args.trace is not None:
+        trace.stop()
+    results["imports"] = import_times()
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
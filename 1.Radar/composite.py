@@ -0,0 +1,435 @@
+"""
+Multi-radar reflectivity composites.
+
+Compositor maps radar volumes (Radar objects from read_rainbow_hdf5,
+read_rainbow_vol, pyart.aux_io.read_gamic, ...) onto a shared latitude /
+longitude or azimuthal equidistant (AEQD) grid and merges them. For each
+radar, every grid cell is matched to the nearest ray and gate of each
+sweep (4/3 Earth radius beam propagation), giving an index map that
+depends only on the scan geometry. Index maps are cached in memory and
+optionally on disk (grid_weights.GeometryCache, as the weights of
+CachedGridder), so each new volume only costs a gather. The value of a
+radar in a cell is its column maximum over the sweeps, and radars are
+merged with one of the rules:
+
+* 'max': largest value of all radars;
+* 'nearest': value of the nearest radar covering the cell;
+* 'weighted': average weighted by the inverse squared distance to each
+  radar, in linear units for fields in dBZ.
+
+Radars are mapped in parallel threads, and the result includes the time
+of each stage. Composite the shipped samples of the Sao Paulo radars
+(FCTH, Sao Roque and XPOL) from this folder with:
+
+    python composite.py ../dados/radar/FCTH/2017031418273000 \\
+        ../dados/radar/SR/SRO-250--2017-03-14--18-30-22.mvol \\
+        ../dados/radar/XPOL_CMP/117BRX-20171115215006.HDF5 \\
+        --rule max -o composite.png
+
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from grid_weights import GeometryCache
+
+# Effective Earth radius (4/3 model), in meters
+EARTH_RADIUS = 6371000.0 * 4.0 / 3.0
+
+# Default Sao Paulo region, (lon_min, lat_min, lon_max, lat_max)
+SAO_PAULO_BBOX = (-49.0, -25.5, -44.0, -21.0)
+
+# Names of the reflectivity fields of the readers, in order of preference
+REFLECTIVITY_FIELDS = [
+    "corrected_reflectivity",
+    "reflectivity",
+    "DBZc",
+    "DBZ",
+    "DBZh",
+]
+
+RULES = ["max", "nearest", "weighted"]
+
+
+def _field_name(radar, field=None):
+    """Field of a radar to composite."""
+    if field is not None:
+        return field
+    for name in REFLECTIVITY_FIELDS:
+        if name in radar.fields:
+            return name
+    raise KeyError("No reflectivity field in the radar: %s" % list(radar.fields))
+
+
+class Compositor(GeometryCache):
+    """
+    Composite of radar volumes on a shared grid.
+
+    Parameters
+    ----------
+    bbox : tuple, optional
+        (lon_min, lat_min, lon_max, lat_max) of the grid.
+    resolution : float, optional
+        Grid spacing, in degrees for projection 'latlon' and in meters for
+        'aeqd'.
+    projection : str, optional
+        'latlon' for a regular latitude / longitude grid, or 'aeqd' for an
+        azimuthal equidistant grid centered on the bbox.
+    cache_dir : str or None, optional
+        Directory where the index maps are stored. None keeps them in
+        memory only.
+    max_range : float or None, optional
+        Largest ground distance in meters used for any radar. None uses
+        the whole range of each radar.
+    angle_tolerance : float, optional
+        Largest difference in degrees between the azimuths or elevations
+        of a volume and those of its cached index map before the map is
+        rebuilt.
+    workers : int or None, optional
+        Number of threads mapping radars. None uses one per radar.
+
+    """
+
+    def __init__(
+        self,
+        bbox=SAO_PAULO_BBOX,
+        resolution=0.01,
+        projection="latlon",
+        cache_dir=None,
+        max_range=None,
+        angle_tolerance=0.5,
+        workers=None,
+    ):
+        from pyart.core.transforms import (
+            cartesian_to_geographic_aeqd,
+            geographic_to_cartesian_aeqd,
+        )
+
+        GeometryCache.__init__(self, cache_dir, angle_tolerance)
+        self.bbox = tuple([float(v) for v in bbox])
+        self.resolution = float(resolution)
+        self.projection = projection
+        self.max_range = max_range
+        self.workers = workers
+
+        lon_min, lat_min, lon_max, lat_max = self.bbox
+        if projection == "latlon":
+            self.lon = np.arange(lon_min, lon_max + resolution / 2, resolution)
+            self.lat = np.arange(lat_min, lat_max + resolution / 2, resolution)
+            self.longitude, self.latitude = np.meshgrid(self.lon, self.lat)
+        elif projection == "aeqd":
+            self.center = ((lon_min + lon_max) / 2.0, (lat_min + lat_max) / 2.0)
+            cx, cy = geographic_to_cartesian_aeqd(
+                np.array([lon_min, lon_max, lon_min, lon_max]),
+                np.array([lat_min, lat_min, lat_max, lat_max]),
+                *self.center
+            )
+            self.x = np.arange(cx.min(), cx.max() + resolution / 2, resolution)
+            self.y = np.arange(cy.min(), cy.max() + resolution / 2, resolution)
+            x, y = np.meshgrid(self.x, self.y)
+            self.longitude, self.latitude = cartesian_to_geographic_aeqd(
+                x, y, *self.center
+            )
+        else:
+            raise ValueError("Unknown projection: " + str(projection))
+        self.shape = self.latitude.shape
+
+    def _key(self, radar):
+        """Key of the geometry of a radar and the grid."""
+        geometry = (
+            self.bbox,
+            self.resolution,
+            self.projection,
+            self.max_range,
+            np.round(radar.latitude["data"], 5).tolist(),
+            np.round(radar.longitude["data"], 5).tolist(),
+            np.round(radar.fixed_angle["data"], 2).tolist(),
+            radar.rays_per_sweep["data"].tolist(),
+        )
+        sha = hashlib.sha1(repr(geometry).encode())
+        sha.update(np.round(radar.range["data"], 1).astype("float64").tobytes())
+        return sha.hexdigest()
+
+    def _build(self, radar, order):
+        """Index map of a radar, with rays in order."""
+        from pyart.core.transforms import geographic_to_cartesian_aeqd
+
+        azimuth = radar.azimuth["data"][order]
+        elevation = radar.elevation["data"][order]
+        ranges = radar.range["data"]
+        gate_spacing = ranges[1] - ranges[0]
+
+        x, y = geographic_to_cartesian_aeqd(
+            self.longitude.ravel(),
+            self.latitude.ravel(),
+            radar.longitude["data"][0],
+            radar.latitude["data"][0],
+        )
+        distance = np.hypot(x, y)
+        cell_azimuth = np.degrees(np.arctan2(x, y)) % 360.0
+        theta = distance / EARTH_RADIUS
+
+        starts = radar.sweep_start_ray_index["data"]
+        ends = radar.sweep_end_ray_index["data"]
+        # flat gate index in the volume with rays in order, -1 where the
+        # cell is outside the sweep
+        index = np.full((radar.nsweeps, len(distance)), -1, dtype="int32")
+        for i in range(radar.nsweeps):
+            az = azimuth[starts[i] : ends[i] + 1]
+            beam = np.median(np.diff(az)) if len(az) > 1 else 1.0
+            # nearest ray, across north
+            pos = np.searchsorted(az, cell_azimuth) % len(az)
+            prev = (pos - 1) % len(az)
+            dpos = np.abs((cell_azimuth - az[pos] + 180.0) % 360.0 - 180.0)
+            dprev = np.abs((cell_azimuth - az[prev] + 180.0) % 360.0 - 180.0)
+            nearest = np.where(dprev < dpos, prev, pos)
+            dnearest = np.minimum(dprev, dpos)
+            # slant range of the cell along the ray
+            elev = np.radians(elevation[starts[i] + nearest])
+            slant = EARTH_RADIUS * np.sin(theta) / np.cos(elev + theta)
+            gate = np.rint((slant - ranges[0]) / gate_spacing).astype("int64")
+            valid = (dnearest <= beam) & (gate >= 0) & (gate < len(ranges))
+            if self.max_range is not None:
+                valid &= distance <= self.max_range
+            ray = starts[i] + nearest[valid]
+            index[i, valid] = ray * len(ranges) + gate[valid]
+        covered = (index >= 0).any(axis=0)
+        return {
+            "index": index,
+            "distance": np.where(covered, distance, np.inf).astype("float32"),
+            "azimuth": azimuth,
+            "elevation": elevation,
+        }
+
+    def index_map(self, radar):
+        """
+        Index map of a radar on the grid, built if needed.
+
+        Returns
+        -------
+        entry : dict
+            'index', (nsweeps, ncells) flat index of the gate of each cell
+            in each sweep, in the gates of the volume with rays in ray
+            order (-1 outside the sweep), 'distance', ground distance in
+            meters of each cell to the radar (inf where not covered), and
+            the azimuths and elevations of the rays in ray order.
+        order : array
+            Ray order, indices of the rays of the radar sorted by azimuth
+            in each sweep.
+        """
+        return self.entry(radar)
+
+    def map_radar(self, radar, field=None):
+        """
+        Column maximum of a field of a radar on the grid.
+
+        Returns
+        -------
+        values : array
+            (ncells,) float32 values, NaN where the radar has no data.
+        distance : array
+            (ncells,) ground distance to the radar, inf where not covered.
+        timings : dict
+            Seconds spent getting the index map and gathering the values.
+        """
+        name = _field_name(radar, field)
+        t0 = time.perf_counter()
+        entry, order = self.index_map(radar)
+        t1 = time.perf_counter()
+
+        data = np.ma.asarray(radar.fields[name]["data"])[order]
+        # the extra NaN at the end is taken by the index -1
+        flat = np.empty(data.size + 1, dtype="float32")
+        flat[:-1] = np.ma.filled(data, np.nan).ravel()
+        flat[-1] = np.nan
+        values = flat[entry["index"]]
+        # fmax ignores NaN, so the maximum is over the sweeps with data
+        values = np.fmax.reduce(values, axis=0)
+        t2 = time.perf_counter()
+        return values, entry["distance"], {"index_map": t1 - t0, "gather": t2 - t1}
+
+    def composite(self, radars, field=None, rule="max", units=None):
+        """
+        Composite of radar volumes.
+
+        Parameters
+        ----------
+        radars : list of Radar
+            Radar volumes.
+        field : str or None, optional
+            Field to composite. None uses the first reflectivity field
+            of each radar (corrected_reflectivity, reflectivity, ...).
+        rule : str, optional
+            'max', 'nearest' or 'weighted'.
+        units : str or None, optional
+            Units of the field, to average dBZ in linear units with the
+            'weighted' rule. None takes them from the first radar.
+
+        Returns
+        -------
+        composite : dict
+            'latitude' and 'longitude' of the cells (2D arrays), 'x' and
+            'y' in meters for the 'aeqd' projection, 'data' (masked 2D
+            array), 'source' (index of the radar used in each cell, -1
+            for none or for the 'weighted' rule), 'rule' and 'timings',
+            seconds of each stage of each radar and of the merge.
+        """
+        if rule not in RULES:
+            raise ValueError("Unknown rule: %s, use one of %s" % (rule, RULES))
+        t0 = time.perf_counter()
+        workers = self.workers or max(len(radars), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            mapped = list(executor.map(lambda r: self.map_radar(r, field), radars))
+        t1 = time.perf_counter()
+
+        values = np.stack([m[0] for m in mapped])
+        distance = np.stack([m[1] for m in mapped])
+        has_data = ~np.isnan(values)
+        source = np.full(values.shape[1], -1, dtype="int32")
+        if rule == "max":
+            source = np.argmax(np.where(has_data, values, -np.inf), axis=0)
+            result = np.fmax.reduce(values, axis=0)
+        elif rule == "nearest":
+            source = np.argmin(distance, axis=0)
+            result = values[source, np.arange(values.shape[1])]
+        else:
+            if units is None:
+                units = radars[0].fields[_field_name(radars[0], field)].get("units")
+            weights = np.where(has_data, 1.0 / np.maximum(distance, 1000.0) ** 2, 0)
+            linear = units == "dBZ"
+            vals = 10.0 ** (values / 10.0) if linear else values
+            total = weights.sum(axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = np.nansum(weights * vals, axis=0) / total
+                if linear:
+                    result = 10.0 * np.log10(result)
+            result[total == 0] = np.nan
+        source = np.where(np.isnan(result), -1, source)
+        t2 = time.perf_counter()
+
+        timings = {"radars": [m[2] for m in mapped], "map": t1 - t0, "merge": t2 - t1}
+        timings["total"] = t2 - t0
+        composite = {
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "data": np.ma.masked_invalid(result.reshape(self.shape)),
+            "source": source.reshape(self.shape),
+            "rule": rule,
+            "timings": timings,
+        }
+        if self.projection == "aeqd":
+            composite["x"] = self.x
+            composite["y"] = self.y
+        return composite
+
+
+def read_radar(path):
+    """
+    Read a radar volume: a Rainbow or GAMIC HDF5 file, or the prefix of
+    the per-moment Rainbow .vol files of a volume (FCTH).
+    """
+    if os.path.isfile(path):
+        from batch_ingest import read_file
+
+        return read_file(path)
+    if glob.glob(path + "*.vol"):
+        from read_rainbow_vol import read_rainbow_vol
+
+        return read_rainbow_vol(path)
+    raise ValueError("Not a radar file or .vol prefix: " + path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Composite of radar volumes.")
+    parser.add_argument(
+        "inputs", nargs="+", help="radar files, or prefixes of .vol volumes"
+    )
+    parser.add_argument(
+        "--bbox", nargs=4, type=float, default=SAO_PAULO_BBOX,
+        metavar=("LON_MIN", "LAT_MIN", "LON_MAX", "LAT_MAX"),
+        help="region of the grid (default: Sao Paulo)",
+    )
+    parser.add_argument(
+        "--resolution", type=float, default=None,
+        help="grid spacing (default: 0.01 degree or 1000 m)",
+    )
+    parser.add_argument("--projection", choices=["latlon", "aeqd"], default="latlon")
+    parser.add_argument("--rule", choices=RULES, default="max")
+    parser.add_argument("--field", default=None, help="field to composite")
+    parser.add_argument("--cache-dir", default=None, help="index map cache")
+    parser.add_argument(
+        "-o", "--output", default=None, help="save the composite (.png or .npz)"
+    )
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor() as executor:
+        radars = list(executor.map(read_radar, args.inputs))
+    read_seconds = time.perf_counter() - t0
+
+    resolution = args.resolution
+    if resolution is None:
+        resolution = 0.01 if args.projection == "latlon" else 1000.0
+    compositor = Compositor(
+        args.bbox, resolution, args.projection, cache_dir=args.cache_dir
+    )
+    composite = compositor.composite(radars, args.field, args.rule)
+
+    timings = composite["timings"]
+    print("read     %7.3f s" % read_seconds)
+    for path, radar_timings in zip(args.inputs, timings["radars"]):
+        print(
+            "map      %7.3f s  (index map %.3f s, gather %.3f s)  %s"
+            % (
+                sum(radar_timings.values()),
+                radar_timings["index_map"],
+                radar_timings["gather"],
+                path,
+            )
+        )
+    print("merge    %7.3f s" % timings["merge"])
+    print("total    %7.3f s  (composite only)" % timings["total"])
+    for i, path in enumerate(args.inputs):
+        print("%8d cells from %s" % ((composite["source"] == i).sum(), path))
+
+    if args.output is not None and args.output.endswith(".npz"):
+        np.savez(
+            args.output,
+            latitude=composite["latitude"],
+            longitude=composite["longitude"],
+            data=np.ma.filled(composite["data"], np.nan),
+            source=composite["source"],
+        )
+    elif args.output is not None:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(figsize=(7, 6))
+        mesh = ax.pcolormesh(
+            composite["longitude"],
+            composite["latitude"],
+            composite["data"],
+            vmin=-10,
+            vmax=70,
+            cmap="jet",
+            shading="auto",
+        )
+        for radar in radars:
+            ax.plot(radar.longitude["data"], radar.latitude["data"], "k^")
+        fig.colorbar(mesh, ax=ax, label="dBZ")
+        ax.set_title("Composite (%s)" % args.rule)
+        fig.savefig(args.output, dpi=100)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Pseudo-RHI cross sections of PPI volumes.
+
+pyart.util.cross_section_ppi and RadarDisplay.plot_azimuth_to_rhi search
+the azimuths of every sweep for each target azimuth. AzimuthIndex sorts
+the azimuths of every sweep once, and `azimuth_index` keeps it on the
+radar object, so the nearest ray of every sweep is found for any number
+of target azimuths with a single searchsorted. Azimuth differences wrap
+around north (359.9 and 0.1 degrees are 0.2 degrees apart), which Py-ART
+does not do.
+
+`extract_rhi` gathers the rays of the target azimuths into compact
+(azimuth, sweep, gate) arrays, one per field, for batches of azimuths.
+`cross_section_ppi` returns the same Radar object as its Py-ART
+counterpart. Fields read with read_rainbow_hdf5(..., quantized=True) are
+gathered from their raw codes, so only the gathered rays are decoded.
+
+Example
+-------
+>>> from read_brazil_radar_py3 import read_rainbow_hdf5
+>>> from cross_sections import cross_section_ppi, extract_rhi
+>>> radar = read_rainbow_hdf5("117BRX-20171115215006.HDF5")
+>>> rhi = extract_rhi(radar, np.arange(0, 360, 5), fields=["reflectivity"])
+>>> rhi["fields"]["reflectivity"].shape  # (72, nsweeps, ngates)
+>>> radar_rhi = cross_section_ppi(radar, [300, 310, 320])
+
+"""
+
+import warnings
+
+import numpy as np
+
+# Key span of a sweep in the index: its azimuths, padded by one ray on
+# each side, are between -360 and 720 degrees
+_SWEEP_SPAN = 1080.0
+
+
+class AzimuthIndex(object):
+    """
+    Rays of each sweep of a radar volume, sorted by azimuth.
+
+    Parameters
+    ----------
+    azimuth : array
+        Azimuth of each ray, in degrees.
+    sweep_start, sweep_end : array of int
+        Index of the first and last ray of each sweep.
+    """
+
+    def __init__(self, azimuth, sweep_start, sweep_end):
+        azimuth = np.mod(np.asarray(azimuth, dtype="float64"), 360.0)
+        sweep_start = np.asarray(sweep_start, dtype="intp")
+        sweep_end = np.asarray(sweep_end, dtype="intp")
+        self.nsweeps = len(sweep_start)
+        nrays = sweep_end - sweep_start + 1
+        sweep = np.repeat(np.arange(self.nsweeps), nrays)
+        rays = np.arange(len(sweep)) - np.repeat(np.cumsum(nrays) - nrays, nrays)
+        rays += np.repeat(sweep_start, nrays)
+        order = np.lexsort((azimuth[rays], sweep))
+        rays = rays[order]
+        sweep = sweep[order]
+        angles = azimuth[rays]
+
+        # the last ray of each sweep is repeated 360 degrees lower and the
+        # first one 360 degrees higher, so the nearest ray wraps around
+        last = np.cumsum(nrays)[nrays > 0] - 1
+        first = last - nrays[nrays > 0] + 1
+        rays = np.concatenate([rays[last], rays, rays[first]])
+        sweep = np.concatenate([sweep[last], sweep, sweep[first]])
+        angles = np.concatenate([angles[last] - 360.0, angles, angles[first] + 360.0])
+        keys = sweep * _SWEEP_SPAN + 360.0 + angles
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.rays = rays[order]
+        self.sweeps = sweep[order]
+
+    def nearest(self, target_azimuths, az_tol=None):
+        """
+        Nearest ray of every sweep to each target azimuth.
+
+        Parameters
+        ----------
+        target_azimuths : array
+            Target azimuths, in degrees.
+        az_tol : float or None, optional
+            Largest azimuth difference, in degrees. None takes the nearest
+            ray at any distance.
+
+        Returns
+        -------
+        rays : array of int
+            Ray index, shape (ntargets, nsweeps), -1 where the sweep has
+            no ray within az_tol.
+        distance : array
+            Azimuth difference in degrees to the ray, same shape.
+        """
+        targets = np.mod(np.atleast_1d(np.asarray(target_azimuths, "float64")), 360)
+        sweep = np.arange(self.nsweeps)
+        query = (sweep * _SWEEP_SPAN + 360.0)[np.newaxis, :] + targets[:, np.newaxis]
+        if len(self.keys) == 0:
+            return np.full(query.shape, -1, dtype="intp"), np.full(query.shape, np.inf)
+        after = np.clip(np.searchsorted(self.keys, query), 0, len(self.keys) - 1)
+        before = np.clip(after - 1, 0, len(self.keys) - 1)
+        d_after = np.abs(self.keys[after] - query)
+        d_before = np.abs(query - self.keys[before])
+        pick = np.where(d_after < d_before, after, before)
+        distance = np.minimum(d_after, d_before)
+        rays = self.rays[pick]
+        # sweeps without rays take a ray of another sweep
+        missing = self.sweeps[pick] != sweep[np.newaxis, :]
+        if az_tol is not None:
+            missing |= distance > az_tol
+        rays[missing] = -1
+        distance[missing] = np.inf
+        return rays, distance
+
+
+def azimuth_index(radar):
+    """
+    AzimuthIndex of a radar, built on first use and kept on the radar
+    object. It is built again if the azimuth or sweep index arrays of the
+    radar are replaced, but not if they are modified in place.
+    """
+    sources = (
+        radar.azimuth["data"],
+        radar.sweep_start_ray_index["data"],
+        radar.sweep_end_ray_index["data"],
+    )
+    cached = getattr(radar, "_azimuth_index", None)
+    if cached is not None and all([a is b for a, b in zip(cached[0], sources)]):
+        return cached[1]
+    index = AzimuthIndex(*sources)
+    radar._azimuth_index = (sources, index)
+    return index
+
+
+def _gather_field(field, rays):
+    """
+    Data of the rays of a field dictionary, masked where the ray is -1.
+    QuantizedField fields are gathered from their codes.
+    """
+    shape = rays.shape
+    rays = rays.ravel()
+    invalid = rays < 0
+    take = np.where(invalid, 0, rays)
+    moment = getattr(field, "moment", None)
+    if moment is not None:
+        codes = moment.codes[take]
+        sweep = np.searchsorted(moment.ray_start, take, side="right") - 1
+        data = codes.astype("float32")
+        data *= moment.scale[sweep].astype("float32")[:, np.newaxis]
+        data += moment.offset[sweep].astype("float32")[:, np.newaxis]
+        data = np.ma.masked_where(codes == 0, data, copy=False)
+    else:
+        data = np.ma.asarray(field["data"])[take]
+    if np.any(invalid):
+        data = np.ma.asarray(data)
+        data[invalid] = np.ma.masked
+    return data.reshape(shape + data.shape[1:])
+
+
+def extract_rhi(radar, target_azimuths, fields=None, az_tol=None):
+    """
+    Extract pseudo-RHIs of a PPI volume at many azimuths at once.
+
+    Parameters
+    ----------
+    radar : Radar
+        Volume of PPI sweeps.
+    target_azimuths : array
+        Azimuths of the pseudo-RHIs, in degrees, in the order of the
+        output.
+    fields : list or None, optional
+        Fields to extract. None extracts all fields.
+    az_tol : float or None, optional
+        Largest azimuth difference to the target, in degrees. Sweeps
+        without a ray within it are masked. None takes the nearest ray.
+
+    Returns
+    -------
+    rhi : dict
+        Dictionary with 'target_azimuth' (ntargets), 'ray' (ntargets,
+        nsweeps) ray indices (-1 where missing), 'azimuth' and
+        'elevation' (ntargets, nsweeps) of the rays, masked where missing,
+        'fixed_angle' and 'range' of the radar, and 'fields', masked
+        arrays of shape (ntargets, nsweeps, ngates).
+    """
+    if fields is None:
+        fields = list(radar.fields.keys())
+    targets = np.atleast_1d(np.asarray(target_azimuths, dtype="float64"))
+    rays, _ = azimuth_index(radar).nearest(targets, az_tol)
+    missing = rays < 0
+    take = np.where(missing, 0, rays)
+    return {
+        "target_azimuth": targets,
+        "ray": rays,
+        "azimuth": np.ma.masked_where(missing, radar.azimuth["data"][take]),
+        "elevation": np.ma.masked_where(missing, radar.elevation["data"][take]),
+        "fixed_angle": np.asarray(radar.fixed_angle["data"]),
+        "range": np.asarray(radar.range["data"]),
+        "fields": dict(
+            [(field, _gather_field(radar.fields[field], rays)) for field in fields]
+        ),
+    }
+
+
+def _copy_dic(dic, data=None):
+    """Copy of a metadata dictionary, with new data if given."""
+    new_dic = dict([(k, v) for k, v in dic.items() if k != "data"])
+    if data is not None:
+        new_dic["data"] = data
+    return new_dic
+
+
+def cross_section_ppi(radar, target_azimuths, az_tol=None, fields=None):
+    """
+    Extract cross sections from a PPI volume along one or more azimuths,
+    as pyart.util.cross_section_ppi.
+
+    Parameters
+    ----------
+    radar : Radar
+        Volume of PPI sweeps.
+    target_azimuths : list
+        Azimuths of the cross sections, in degrees.
+    az_tol : float or None, optional
+        Largest azimuth difference to the target, in degrees. Sweeps
+        without a ray within it are left out of the cross section, with a
+        warning. None takes the nearest ray.
+    fields : list or None, optional
+        Fields to extract. None extracts all fields.
+
+    Returns
+    -------
+    radar_rhi : Radar
+        Volume with one RHI sweep per target azimuth (sorted), and one ray
+        per PPI sweep. Ray dimension instrument parameters are kept.
+    """
+    from pyart.core.radar import Radar
+
+    targets = np.unique(np.asarray(target_azimuths, dtype="float64"))
+    rays, distance = azimuth_index(radar).nearest(targets, az_tol)
+    valid = rays >= 0
+    if not np.all(valid):
+        for target, d in zip(targets, distance):
+            if np.any(np.isinf(d)):
+                warnings.warn(
+                    "No ray within %s degrees of azimuth %s in %d sweeps"
+                    % (az_tol, target, np.sum(np.isinf(d)))
+                )
+    nrays = np.sum(valid, axis=1)
+    targets = targets[nrays > 0]
+    nrays = nrays[nrays > 0]
+    if len(targets) == 0:
+        raise ValueError("No azimuth found within tolerance")
+    rays = rays[valid]
+    nsweeps = len(targets)
+    sweep_end = np.cumsum(nrays) - 1
+
+    if fields is None:
+        fields = list(radar.fields.keys())
+    rhi_fields = {}
+    for field in fields:
+        rhi_fields[field] = _copy_dic(
+            radar.fields[field], _gather_field(radar.fields[field], rays)
+        )
+    instrument_parameters = None
+    if radar.instrument_parameters is not None:
+        instrument_parameters = {}
+        for key, dic in radar.instrument_parameters.items():
+            if np.shape(dic.get("data"))[:1] == (radar.nrays,):
+                dic = _copy_dic(dic, np.asarray(dic["data"])[rays])
+            instrument_parameters[key] = dic
+
+    return Radar(
+        _copy_dic(radar.time, radar.time["data"][rays]),
+        _copy_dic(radar.range, radar.range["data"]),
+        rhi_fields,
+        _copy_dic(radar.metadata),
+        "rhi",
+        _copy_dic(radar.latitude, radar.latitude["data"]),
+        _copy_dic(radar.longitude, radar.longitude["data"]),
+        _copy_dic(radar.altitude, radar.altitude["data"]),
+        _copy_dic(radar.sweep_number, np.arange(nsweeps, dtype="int32")),
+        _copy_dic(radar.sweep_mode, np.array(["rhi"] * nsweeps)),
+        _copy_dic(radar.fixed_angle, targets.astype("float32")),
+        _copy_dic(
+            radar.sweep_start_ray_index,
+            (sweep_end - nrays + 1).astype("int32"),
+        ),
+        _copy_dic(radar.sweep_end_ray_index, sweep_end.astype("int32")),
+        _copy_dic(radar.azimuth, radar.azimuth["data"][rays]),
+        _copy_dic(radar.elevation, radar.elevation["data"][rays]),
+        instrument_parameters=instrument_parameters,
+    )
@@ -0,0 +1,228 @@
+"""
+Persistent on-disk cache of decoded radar files.
+
+The readers in this folder (read_rainbow_hdf5, read_mira and
+read_sipam_cappi) accept a `cache` argument. When a DecodeCache is given,
+the object returned by the reader is stored on disk the first time a file
+is read, with every numpy array saved as a separate .npy file. Later reads
+of the same file with the same options load these arrays memory-mapped,
+so they return without decoding the file again.
+
+Entries are keyed by the absolute path, size and modification time of the
+source file, the reader and its options. A changed source file is a miss,
+and the entries of its previous versions, with any reader and options, are
+removed. The total size of the cache is kept
+under a limit by removing the least recently used entries.
+
+Example
+-------
+>>> from decode_cache import DecodeCache
+>>> from read_brazil_radar_py3 import read_rainbow_hdf5
+>>> cache = DecodeCache("/tmp/radar_cache", max_bytes=20 * 2**30)
+>>> radar = read_rainbow_hdf5("117BRX-20171115215006.HDF5", cache=cache)
+>>> cache.stats()
+
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+# arrays smaller than this are kept inside the pickle
+_MIN_ARRAY_BYTES = 1024
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickler that stores large numpy arrays as .npy files."""
+
+    def __init__(self, file, directory):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.count = 0
+
+    def _save(self, array):
+        name = "array_%d.npy" % self.count
+        self.count += 1
+        np.save(os.path.join(self.directory, name), np.asarray(array))
+        return name
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+            return None
+        if obj.nbytes < _MIN_ARRAY_BYTES:
+            return None
+        if isinstance(obj, np.ma.MaskedArray):
+            mask = np.ma.getmask(obj)
+            if mask is not np.ma.nomask:
+                mask = self._save(mask)
+            return ("masked", self._save(obj.data), mask, obj.fill_value)
+        return ("array", self._save(obj))
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """Unpickler that loads the .npy files of _ArrayPickler memory-mapped."""
+
+    def __init__(self, file, directory):
+        pickle.Unpickler.__init__(self, file)
+        self.directory = directory
+
+    def _load(self, name):
+        # copy-on-write, so arrays can be modified without changing the cache
+        return np.load(os.path.join(self.directory, name), mmap_mode="c")
+
+    def persistent_load(self, pid):
+        if pid[0] == "array":
+            return self._load(pid[1])
+        data = self._load(pid[1])
+        mask = pid[2]
+        if mask is not np.ma.nomask:
+            mask = self._load(mask)
+        return np.ma.MaskedArray(data, mask=mask, fill_value=pid[3])
+
+
+class DecodeCache(object):
+    """
+    Persistent cache of decoded radar files, shared by the readers.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the cache is stored. It is created if needed.
+    max_bytes : int, optional
+        Maximum total size of the cache in bytes. The least recently used
+        entries are removed when it is exceeded.
+
+    """
+
+    def __init__(self, directory, max_bytes=10 * 2**30):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _keys(self, filename, reader, kwargs):
+        """Keys of the source file, of the reader and options, and of the
+        current version of the file."""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        options = repr((reader.__module__, reader.__name__, sorted(kwargs.items())))
+        version = repr((stat.st_size, stat.st_mtime_ns))
+        source_key = hashlib.sha1(path.encode()).hexdigest()
+        options_key = hashlib.sha1(options.encode()).hexdigest()[:16]
+        version_key = hashlib.sha1(version.encode()).hexdigest()[:16]
+        return source_key, options_key, version_key
+
+    def _entries(self):
+        """List of (last access time, size in bytes, path) of all entries."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            obj = os.path.join(path, "object.pkl")
+            if name.startswith(".") or not os.path.isfile(obj):
+                continue
+            size = sum(
+                [os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)]
+            )
+            entries.append((os.path.getmtime(obj), size, path))
+        return entries
+
+    def _evict(self):
+        """Remove least recently used entries until the size limit is met."""
+        entries = sorted(self._entries())
+        total = sum([entry[1] for entry in entries])
+        while entries and total > self.max_bytes:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def fetch(self, filename, reader, **kwargs):
+        """
+        Return reader(filename, **kwargs), from the cache if possible.
+
+        Parameters
+        ----------
+        filename : str
+            File to read.
+        reader : callable
+            Reader function, e.g. read_rainbow_hdf5. Its module and name,
+            together with kwargs, are part of the cache key.
+        kwargs : dict
+            Options passed to the reader. Their repr must identify them.
+
+        Returns
+        -------
+        result : object
+            What the reader returns, with the arrays memory-mapped from
+            the cache.
+        """
+        source_key, options_key, version_key = self._keys(filename, reader, kwargs)
+        entry = os.path.join(
+            self.directory, "-".join([source_key, options_key, version_key])
+        )
+        obj = os.path.join(entry, "object.pkl")
+        if os.path.isfile(obj):
+            self.hits += 1
+            os.utime(obj)
+            with open(obj, "rb") as f:
+                return _ArrayUnpickler(f, entry).load()
+
+        self.misses += 1
+        # remove the entries of previous versions of this file, read with
+        # any options
+        for name in os.listdir(self.directory):
+            if name.startswith(source_key + "-") and not name.endswith(
+                "-" + version_key
+            ):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                self.invalidations += 1
+
+        result = reader(filename, **kwargs)
+
+        # write to a temporary directory first, so readers in other
+        # processes never see a partial entry
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            with open(os.path.join(tmpdir, "object.pkl"), "wb") as f:
+                _ArrayPickler(f, tmpdir).dump(result)
+            os.rename(tmpdir, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self._evict()
+        return result
+
+    def stats(self):
+        """
+        Cache statistics.
+
+        Returns
+        -------
+        stats : dict
+            Number of hits, misses, invalidations (entries removed because
+            the source file changed) and evictions since this object was
+            created, and the current number of entries and total size in
+            bytes.
+        """
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum([entry[1] for entry in entries]),
+        }
+
+    def clear(self):
+        """Remove all entries."""
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
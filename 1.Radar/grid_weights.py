@@ -0,0 +1,384 @@
+"""
+Gridding of radar volumes with precomputed interpolation weights.
+
+The radars in ../dados repeat the same scan strategy every cycle, so the
+neighbour search from gates to grid points (the slow part of
+pyart.map.grid_from_radars) gives the same result for every volume.
+CachedGridder does this search once per radar geometry and keeps the
+interpolation weights as a sparse matrix (grid points x gates), in memory
+and optionally on disk. Gridding a volume is then one sparse matrix
+product for all its fields.
+
+The weights use the same radius of influence ('dist_beam' or constant)
+and weighting functions ('Barnes2', 'Barnes', 'Cressman', 'Nearest') as
+grid_from_radars, from the `max_neighbors` nearest gates of each grid
+point. Rays are sorted by azimuth within each sweep, so volumes whose
+sweeps start at a different azimuth share the weights. The geometry key
+is made of the radar location, fixed angles, rays per sweep and range
+gates; azimuths and elevations are compared with the stored ones, and the
+weights are rebuilt when any differs by more than `angle_tolerance`.
+
+Example
+-------
+>>> from grid_weights import CachedGridder
+>>> from read_brazil_radar_py3 import read_rainbow_hdf5
+>>> gridder = CachedGridder(
+...     (15, 201, 201),
+...     ((1000, 15000), (-100000, 100000), (-100000, 100000)),
+...     cache_dir="/tmp/grid_weights",
+... )
+>>> radar = read_rainbow_hdf5("117BRX-20171115215006.HDF5")
+>>> grid = gridder.grid(radar, fields=["corrected_reflectivity"])
+>>> gridder.stats()
+
+"""
+
+import hashlib
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from array_cache import ArrayCache
+
+
+def _weights(dist2, roi2, weighting_function):
+    """Interpolation weights of squared distances, as in grid_from_radars."""
+    if weighting_function == "Barnes2":
+        return np.exp(-dist2 / (roi2 / 4.0)) + 1e-5
+    if weighting_function == "Barnes":
+        return np.exp(-dist2 / (2.0 * roi2)) + 1e-5
+    if weighting_function == "Cressman":
+        return (roi2 - dist2) / (roi2 + dist2)
+    raise ValueError("Unknown weighting_function: " + str(weighting_function))
+
+
+def ray_order(radar):
+    """Indices of the rays of a radar, sorted by azimuth in each sweep."""
+    sweep = np.repeat(np.arange(radar.nsweeps), radar.rays_per_sweep["data"])
+    return np.lexsort((radar.azimuth["data"], sweep))
+
+
+class GeometryCache(ArrayCache):
+    """
+    Arrays computed from the scan geometry of radar volumes, cached in
+    memory and optionally on disk (see array_cache).
+
+    Subclasses define _key, the key of the geometry of a radar, and
+    _build, the entry of a radar with its rays in ray order: a dictionary
+    with the 'azimuth' and 'elevation' of the rays, compared with those of
+    each volume, and the arrays of the subclass.
+
+    Parameters
+    ----------
+    cache_dir : str or None, optional
+        Directory where the entries are stored, created if needed. None
+        keeps them in memory only.
+    angle_tolerance : float, optional
+        Largest difference in degrees between the azimuths or elevations
+        of a volume and those of its entry before the entry is rebuilt.
+
+    """
+
+    def __init__(self, cache_dir=None, angle_tolerance=0.5):
+        ArrayCache.__init__(self, cache_dir)
+        self.angle_tolerance = angle_tolerance
+
+    def ray_order(self, radar):
+        """Indices of the rays of a radar, sorted by azimuth in each sweep."""
+        return ray_order(radar)
+
+    def _matches(self, entry, radar, order):
+        """True if the angles of the rays match those of the entry."""
+        azimuth = radar.azimuth["data"][order]
+        elevation = radar.elevation["data"][order]
+        if len(azimuth) != len(entry["azimuth"]):
+            return False
+        daz = np.abs((azimuth - entry["azimuth"] + 180.0) % 360.0 - 180.0)
+        delev = np.abs(elevation - entry["elevation"])
+        return max(daz.max(), delev.max()) <= self.angle_tolerance
+
+    def entry(self, radar):
+        """
+        Entry of a radar volume, built if needed.
+
+        Returns
+        -------
+        entry : dict
+            Entry of the geometry of the radar, see _build.
+        order : array
+            Ray order, indices of the rays of the radar sorted by azimuth
+            in each sweep.
+        """
+        order = self.ray_order(radar)
+        entry = self._cached(
+            self._key(radar),
+            lambda: self._build(radar, order),
+            lambda entry: self._matches(entry, radar, order),
+        )
+        return entry, order
+
+    def stats(self):
+        """
+        Number of entries found in memory (hits), loaded from disk (loads),
+        built (builds), and rebuilt because the angles changed (rebuilds).
+        """
+        stats = ArrayCache.stats(self)
+        stats["rebuilds"] = self.rebuilds
+        return stats
+
+
+class CachedGridder(GeometryCache):
+    """
+    Gridder of radar volumes with cached sparse interpolation weights.
+
+    Parameters
+    ----------
+    grid_shape : 3-tuple of int
+        Number of points of the grid in the z, y and x dimensions.
+    grid_limits : 3-tuple of 2-tuples
+        Minimum and maximum of the z, y and x coordinates of the grid, in
+        meters from the radar.
+    cache_dir : str or None, optional
+        Directory where the weights are stored, created if needed. None
+        keeps them in memory only.
+    weighting_function : str, optional
+        'Barnes2', 'Barnes', 'Cressman' or 'Nearest'.
+    roi_func : str, optional
+        'dist_beam' for a radius of influence growing with height and
+        distance to the radar, or 'constant' for constant_roi.
+    constant_roi : float, optional
+        Radius of influence in meters with roi_func='constant'.
+    h_factor, nb, bsp, min_radius : float, optional
+        Parameters of the 'dist_beam' radius of influence, as in
+        grid_from_radars.
+    max_neighbors : int, optional
+        Maximum number of gates used for each grid point.
+    angle_tolerance : float, optional
+        Largest difference in degrees between the azimuths or elevations
+        of a volume and those of the cached weights.
+
+    """
+
+    def __init__(
+        self,
+        grid_shape,
+        grid_limits,
+        cache_dir=None,
+        weighting_function="Barnes2",
+        roi_func="dist_beam",
+        constant_roi=500.0,
+        h_factor=1.0,
+        nb=1.0,
+        bsp=1.0,
+        min_radius=250.0,
+        max_neighbors=32,
+        angle_tolerance=0.5,
+    ):
+        GeometryCache.__init__(self, cache_dir, angle_tolerance)
+        self.grid_shape = tuple([int(n) for n in grid_shape])
+        self.grid_limits = tuple([(float(lo), float(hi)) for lo, hi in grid_limits])
+        self.weighting_function = weighting_function
+        self.roi_func = roi_func
+        self.constant_roi = constant_roi
+        self.h_factor = h_factor
+        self.nb = nb
+        self.bsp = bsp
+        self.min_radius = min_radius
+        self.max_neighbors = max_neighbors
+
+    def axes(self):
+        """z, y and x coordinates of the grid, in meters."""
+        limits = zip(self.grid_limits, self.grid_shape)
+        return [np.linspace(lo, hi, n) for (lo, hi), n in limits]
+
+    def _key(self, radar):
+        """Key of the geometry of a radar and the gridding options."""
+        geometry = (
+            self.grid_shape,
+            self.grid_limits,
+            self.weighting_function,
+            self.roi_func,
+            self.constant_roi,
+            self.h_factor,
+            self.nb,
+            self.bsp,
+            self.min_radius,
+            self.max_neighbors,
+            np.round(radar.latitude["data"], 5).tolist(),
+            np.round(radar.longitude["data"], 5).tolist(),
+            np.round(radar.altitude["data"], 1).tolist(),
+            np.round(radar.fixed_angle["data"], 2).tolist(),
+            radar.rays_per_sweep["data"].tolist(),
+        )
+        sha = hashlib.sha1(repr(geometry).encode())
+        sha.update(np.round(radar.range["data"], 1).astype("float64").tobytes())
+        return sha.hexdigest()
+
+    def _roi(self, z, y, x):
+        """Radius of influence at grid points, in meters."""
+        if self.roi_func == "constant":
+            return np.full(z.shape, float(self.constant_roi))
+        if self.roi_func != "dist_beam":
+            raise ValueError("Unknown roi_func: " + str(self.roi_func))
+        beam_factor = np.tan(np.radians(self.nb * self.bsp))
+        h = self.h_factor
+        roi = np.sqrt((h * z) ** 2 + (h * y) ** 2 + (h * x) ** 2) * beam_factor
+        return np.maximum(roi, self.min_radius)
+
+    def _build(self, radar, order):
+        """Weights matrix of the gates of a radar, with rays in order."""
+        from pyart.core.transforms import antenna_vectors_to_cartesian
+
+        azimuth = radar.azimuth["data"][order]
+        elevation = radar.elevation["data"][order]
+        gx, gy, gz = antenna_vectors_to_cartesian(
+            radar.range["data"], azimuth, elevation
+        )
+        gates = np.column_stack((gz.ravel(), gy.ravel(), gx.ravel()))
+        ngates = len(gates)
+
+        z, y, x = np.meshgrid(*self.axes(), indexing="ij")
+        points = np.column_stack((z.ravel(), y.ravel(), x.ravel()))
+        roi = self._roi(points[:, 0], points[:, 1], points[:, 2])
+
+        k = 1 if self.weighting_function == "Nearest" else self.max_neighbors
+        dist, index = cKDTree(gates).query(
+            points, k=k, distance_upper_bound=roi.max(), workers=-1
+        )
+        dist = dist.reshape(len(points), k)
+        index = index.reshape(len(points), k)
+        valid = dist <= roi[:, np.newaxis]
+        rows = np.nonzero(valid)[0]
+        if self.weighting_function == "Nearest":
+            weights = np.ones(len(rows))
+        else:
+            weights = _weights(
+                dist[valid] ** 2, roi[rows] ** 2, self.weighting_function
+            )
+        matrix = csr_matrix(
+            (weights.astype("float32"), (rows, index[valid])),
+            shape=(len(points), ngates),
+        )
+        return {"matrix": matrix, "azimuth": azimuth, "elevation": elevation}
+
+    def _to_arrays(self, entry):
+        """Arrays of the sparse weights matrix of an entry."""
+        matrix = entry["matrix"]
+        return {
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr,
+            "shape": np.array(matrix.shape),
+            "azimuth": entry["azimuth"],
+            "elevation": entry["elevation"],
+        }
+
+    def _from_arrays(self, arrays):
+        """Entry of the arrays of a sparse weights matrix."""
+        matrix = csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=tuple(arrays["shape"]),
+        )
+        return {
+            "matrix": matrix,
+            "azimuth": arrays["azimuth"],
+            "elevation": arrays["elevation"],
+        }
+
+    def weights(self, radar):
+        """
+        Interpolation weights of a radar volume, built if needed.
+
+        Returns
+        -------
+        matrix : scipy.sparse.csr_matrix
+            Weights of the gates (columns, with rays in ray order) for
+            each grid point (rows, in z, y, x order).
+        order : array
+            Ray order, indices of the rays of the radar in the columns.
+        """
+        entry, order = self.entry(radar)
+        return entry["matrix"], order
+
+    def grid(self, radar, fields=None):
+        """
+        Map the fields of a radar volume to the grid.
+
+        Parameters
+        ----------
+        radar : Radar
+            Radar volume.
+        fields : list of str or None, optional
+            Fields to grid. None grids all fields.
+
+        Returns
+        -------
+        grid : Grid
+            Grid object with origin at the radar. Grid points without
+            valid gates within their radius of influence are masked.
+        """
+        from pyart.config import get_metadata
+        from pyart.core.grid import Grid
+
+        if fields is None:
+            fields = list(radar.fields)
+        matrix, order = self.weights(radar)
+        ngates = matrix.shape[1]
+
+        # value and weight columns of all fields, so the weights are
+        # applied with a single sparse product
+        columns = np.zeros((ngates, 2 * len(fields)), dtype="float32")
+        for i, name in enumerate(fields):
+            data = radar.fields[name]["data"]
+            values = np.ma.getdata(data)[order].reshape(ngates)
+            valid = ~np.ma.getmaskarray(data)[order].reshape(ngates)
+            valid &= np.isfinite(values)
+            np.copyto(columns[:, 2 * i], values, where=valid)
+            columns[:, 2 * i + 1] = valid
+        sums = matrix @ columns
+
+        _fields = {}
+        for i, name in enumerate(fields):
+            total = sums[:, 2 * i + 1]
+            value = sums[:, 2 * i] / np.where(total > 0, total, 1)
+            _fields[name] = dict(
+                [(k, v) for k, v in radar.fields[name].items() if k != "data"]
+            )
+            _fields[name]["data"] = np.ma.MaskedArray(
+                value.reshape(self.grid_shape),
+                mask=(total <= 0).reshape(self.grid_shape),
+            )
+
+        time = get_metadata("grid_time")
+        time["units"] = radar.time["units"]
+        time["data"] = np.array([radar.time["data"][0]])
+        origin_latitude = get_metadata("origin_latitude")
+        origin_latitude["data"] = np.array([radar.latitude["data"][0]])
+        origin_longitude = get_metadata("origin_longitude")
+        origin_longitude["data"] = np.array([radar.longitude["data"][0]])
+        origin_altitude = get_metadata("origin_altitude")
+        origin_altitude["data"] = np.array([radar.altitude["data"][0]])
+        z, y, x = self.axes()
+        _x = get_metadata("x")
+        _x["data"] = x
+        _y = get_metadata("y")
+        _y["data"] = y
+        _z = get_metadata("z")
+        _z["data"] = z
+
+        return Grid(
+            time,
+            _fields,
+            dict(radar.metadata),
+            origin_latitude,
+            origin_longitude,
+            origin_altitude,
+            _x,
+            _y,
+            _z,
+            radar_latitude=dict(radar.latitude),
+            radar_longitude=dict(radar.longitude),
+            radar_altitude=dict(radar.altitude),
+            radar_time=dict(time),
+        )
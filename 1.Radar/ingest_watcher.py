@@ -0,0 +1,621 @@
+"""
+Near-real-time ingest of radar files dropped in a directory.
+
+IngestWatcher polls a directory for new files. A file is complete when its
+size and modification time have not changed for `settle` seconds or, with
+atomic=True, as soon as it appears, for writers that create files under a
+temporary name and rename them when done. Hidden files and names ending in
+.part or .tmp are never taken.
+
+Each complete file is decoded in an executor, with the reader chosen by
+batch_ingest.detect_format, and then goes through a list of product stages
+in order (gridding, CAPPI, maximum reflectivity, quicklook PNG or any
+function of a volume). Decoding and stages are connected by bounded
+asyncio queues: when a stage is slower than the files arrive, the previous
+stages wait for room instead of keeping decoded volumes in memory, and new
+files are left in the directory until the pipeline can take them.
+
+Each volume ends with a report of its decode and stage times and its
+latency, from its detection to the end of its last stage. Run from this
+folder with:
+
+    python ingest_watcher.py /data/incoming -o /data/products \\
+        --stages grid maxz quicklook --reports reports.jsonl
+
+or, from a test harness copying files into a directory:
+
+>>> import asyncio
+>>> from ingest_watcher import IngestWatcher, grid_stage, maxz_stage
+>>> watcher = IngestWatcher("/tmp/incoming", [grid_stage(), maxz_stage()])
+>>> reports = asyncio.run(watcher.run(max_files=3, timeout=600))
+
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+import numpy as np
+import pyart
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from batch_ingest import detect_format, output_name, read_file
+from composite import REFLECTIVITY_FIELDS
+
+_TEMPORARY_SUFFIXES = (".part", ".tmp")
+
+
+def _reflectivity_field(obj, field=None):
+    """Name of the field to use of a Radar or Grid."""
+    if field is not None:
+        return field
+    for name in REFLECTIVITY_FIELDS:
+        if name in obj.fields:
+            return name
+    return sorted(obj.fields)[0]
+
+
+def _product_name(volume, output_dir, suffix):
+    """
+    Output file of a product of a volume, <output_dir>/<name>_<suffix>,
+    with the name of the input without extension (see output_name).
+    """
+    name = output_name(volume["filename"], output_dir)[: -len(".nc")]
+    return name + "_" + suffix
+
+
+def _volume_grid(volume):
+    """Grid of a volume: the decoded data or the product of a grid stage."""
+    if isinstance(volume["data"], pyart.core.Grid):
+        return volume["data"]
+    if "grid" not in volume["products"]:
+        raise ValueError("a grid stage must come before this stage for radars")
+    return volume["products"]["grid"]
+
+
+def _colormap(name):
+    """Colormap of a name, with or without the pyart_ prefix of Py-ART 1.x."""
+    if name not in matplotlib.colormaps and name.startswith("pyart_"):
+        name = name[len("pyart_") :]
+    return matplotlib.colormaps[name]
+
+
+def _save_plane(plane, filename):
+    """Save a 2D product as .npz, with missing data as NaN."""
+    np.savez(
+        filename,
+        x=plane["x"],
+        y=plane["y"],
+        data=np.ma.filled(plane["data"].astype("float32"), np.nan),
+    )
+
+
+def grid_stage(
+    grid_shape=(15, 201, 201),
+    grid_limits=((1000.0, 15000.0), (-100000.0, 100000.0), (-100000.0, 100000.0)),
+    field=None,
+    output_dir=None,
+    gridder=None,
+):
+    """
+    Stage gridding radar volumes with pyart.map.grid_from_radars, or with
+    the cached weights of a grid_weights.CachedGridder if gridder is given
+    (its grid shape and limits are then used).
+
+    Grids (SIPAM and FCTH CAPPIs) are passed through unchanged. Only the
+    reflectivity field, or `field`, is gridded. With an output_dir, the
+    grid is written as <name>_grid.nc.
+    """
+
+    def grid(volume):
+        obj = volume["data"]
+        if isinstance(obj, pyart.core.Grid):
+            return obj
+        fields = [_reflectivity_field(obj, field)]
+        if gridder is not None:
+            result = gridder.grid(obj, fields=fields)
+        else:
+            result = pyart.map.grid_from_radars(
+                (obj,), grid_shape=grid_shape, grid_limits=grid_limits, fields=fields
+            )
+        if output_dir is not None:
+            pyart.io.write_grid(_product_name(volume, output_dir, "grid.nc"), result)
+        return result
+
+    grid.__name__ = "grid"
+    return grid
+
+
+def cappi_stage(height=2000.0, field=None, output_dir=None):
+    """
+    Stage taking the level of the grid nearest to `height` meters, as a
+    dictionary of x, y (meters) and data. With an output_dir, the CAPPI is
+    saved as <name>_cappi.npz.
+    """
+
+    def cappi(volume):
+        grid = _volume_grid(volume)
+        name = _reflectivity_field(grid, field)
+        k = np.abs(grid.z["data"] - height).argmin()
+        plane = {
+            "x": grid.x["data"],
+            "y": grid.y["data"],
+            "data": grid.fields[name]["data"][k],
+            "field": name,
+            "title": "CAPPI %.1f km" % (grid.z["data"][k] / 1000.0),
+        }
+        if output_dir is not None:
+            _save_plane(plane, _product_name(volume, output_dir, "cappi.npz"))
+        return plane
+
+    cappi.__name__ = "cappi"
+    return cappi
+
+
+def maxz_stage(field=None, output_dir=None):
+    """
+    Stage taking the column maximum of the grid, as a dictionary of x, y
+    (meters) and data. With an output_dir, it is saved as <name>_maxz.npz.
+    """
+
+    def maxz(volume):
+        grid = _volume_grid(volume)
+        name = _reflectivity_field(grid, field)
+        plane = {
+            "x": grid.x["data"],
+            "y": grid.y["data"],
+            "data": np.ma.max(grid.fields[name]["data"], axis=0),
+            "field": name,
+            "title": "Maximum",
+        }
+        if output_dir is not None:
+            _save_plane(plane, _product_name(volume, output_dir, "maxz.npz"))
+        return plane
+
+    maxz.__name__ = "maxz"
+    return maxz
+
+
+def quicklook_stage(output_dir, vmin=-10.0, vmax=70.0, cmap="pyart_NWSRef"):
+    """
+    Stage plotting the maxz product, or else the cappi product, of a volume
+    as <output_dir>/<name>_quicklook.png. Figures are drawn without pyplot,
+    so they can be made in worker threads.
+    """
+
+    def quicklook(volume):
+        products = volume["products"]
+        plane = products.get("maxz", products.get("cappi"))
+        if plane is None:
+            raise ValueError("a maxz or cappi stage must come before quicklook")
+        fig = Figure(figsize=(6, 5))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        mesh = ax.pcolormesh(
+            plane["x"] / 1000.0,
+            plane["y"] / 1000.0,
+            plane["data"],
+            vmin=vmin,
+            vmax=vmax,
+            cmap=_colormap(cmap),
+            shading="auto",
+        )
+        fig.colorbar(mesh, ax=ax, label=plane["field"])
+        ax.set_xlabel("x (km)")
+        ax.set_ylabel("y (km)")
+        ax.set_aspect("equal")
+        ax.set_title(
+            "%s\n%s" % (os.path.basename(volume["filename"]), plane["title"])
+        )
+        filename = _product_name(volume, output_dir, "quicklook.png")
+        fig.savefig(filename, dpi=80)
+        return filename
+
+    quicklook.__name__ = "quicklook"
+    return quicklook
+
+
+def _timed(func, *args):
+    """Call func(*args), returning its result and run time in seconds."""
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+class IngestWatcher(object):
+    """
+    Asyncio pipeline decoding and processing files dropped in a directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to watch. Subdirectories are not watched.
+    stages : list of callable, optional
+        Product stages, run in order. Each is called in the executor with
+        the volume dictionary ('filename', 'kind', 'data', the decoded
+        Radar or Grid, and 'products', the results of the previous stages
+        by stage name) and its result is stored in 'products' under its
+        __name__.
+    pattern : str, optional
+        Shell pattern of the names of the files to take.
+    interval : float, optional
+        Seconds between polls of the directory.
+    settle : float or None, optional
+        Seconds the size and modification time of a file must stay the
+        same before it is taken. None uses interval.
+    atomic : bool, optional
+        True to take files as soon as they appear, for writers that
+        rename files into the directory when complete.
+    skip_existing : bool, optional
+        True to ignore the files already in the directory at start.
+    workers : int, optional
+        Number of volumes decoded at the same time, and of threads of the
+        executor created if executor is None.
+    queue_size : int, optional
+        Maximum number of volumes waiting before each stage.
+    executor : concurrent.futures.Executor or None, optional
+        Executor for decoding and stages. It must share memory with this
+        process (a ThreadPoolExecutor), as decoded volumes are not pickled.
+    on_report : callable or None, optional
+        Function called with the report of each volume.
+
+    """
+
+    def __init__(
+        self,
+        directory,
+        stages=(),
+        pattern="*",
+        interval=2.0,
+        settle=None,
+        atomic=False,
+        skip_existing=False,
+        workers=2,
+        queue_size=2,
+        executor=None,
+        on_report=None,
+    ):
+        self.directory = directory
+        self.stages = list(stages)
+        self.pattern = pattern
+        self.interval = interval
+        self.settle = interval if settle is None else settle
+        self.atomic = atomic
+        self.skip_existing = skip_existing
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = executor
+        self.on_report = on_report
+        self.reports = []
+        # files being written: path -> (size, mtime_ns, first seen, stable since)
+        self._pending = {}
+        # files taken and still in the directory, so they are not taken again
+        self._taken = set()
+        self._stopping = False
+
+    def _candidates(self):
+        """Files of the directory that can be taken, with their stat."""
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if (
+                    name.startswith(".")
+                    or name.endswith(_TEMPORARY_SUFFIXES)
+                    or not fnmatch.fnmatch(name, self.pattern)
+                    or not entry.is_file()
+                ):
+                    continue
+                files[entry.path] = entry.stat()
+        return files
+
+    def poll(self, now=None):
+        """
+        Check the directory once.
+
+        Returns
+        -------
+        complete : list of (str, float)
+            Files that became complete since the last poll, in name order,
+            with the time they were first seen.
+        """
+        now = time.time() if now is None else now
+        complete = []
+        files = self._candidates()
+        for path in sorted(files):
+            if path in self._taken:
+                continue
+            stat = files[path]
+            state = (stat.st_size, stat.st_mtime_ns)
+            previous = self._pending.get(path)
+            if previous is None:
+                first_seen = stable_since = now
+            else:
+                first_seen = previous[2]
+                stable_since = previous[3] if previous[:2] == state else now
+            if self.atomic or (stat.st_size and now - stable_since >= self.settle):
+                self._pending.pop(path, None)
+                self._taken.add(path)
+                complete.append((path, first_seen))
+            else:
+                self._pending[path] = state + (first_seen, stable_since)
+        # forget files removed before they were complete, or after they
+        # were taken (a new file with the same name is taken again)
+        for path in list(self._pending):
+            if path not in files:
+                del self._pending[path]
+        self._taken.intersection_update(files)
+        return complete
+
+    def stop(self):
+        """Stop watching, after the volumes already taken are processed."""
+        self._stopping = True
+
+    async def _watch(self, queue, max_files):
+        """Poll the directory and queue the complete files."""
+        if self.skip_existing:
+            self._taken.update(self._candidates())
+        count = 0
+        while not self._stopping:
+            complete = self.poll()
+            queued = 0
+            try:
+                for path, first_seen in complete:
+                    volume = {
+                        "filename": path,
+                        "kind": None,
+                        "data": None,
+                        "products": {},
+                        "detected": first_seen,
+                        "taken": time.time(),
+                        "seconds": {},
+                        "error": None,
+                    }
+                    # waits here while the pipeline is full
+                    await queue.put(volume)
+                    queued += 1
+                    count += 1
+                    if max_files is not None and count >= max_files:
+                        self._stopping = True
+                        break
+            finally:
+                # files left over after max_files, or when the run ends
+                # while waiting for room, are taken by a later poll
+                self._taken.difference_update([path for path, _ in complete[queued:]])
+            if not self._stopping:
+                await asyncio.sleep(self.interval)
+
+    async def _decode(self, loop, executor, inqueue, outqueue):
+        """Decode queued files in the executor."""
+        while True:
+            volume = await inqueue.get()
+            try:
+                volume["kind"] = await loop.run_in_executor(
+                    executor, detect_format, volume["filename"]
+                )
+                if volume["kind"] is None:
+                    raise ValueError("unknown file format")
+                data, seconds = await loop.run_in_executor(
+                    executor, _timed, read_file, volume["filename"], volume["kind"]
+                )
+                volume["data"] = data
+                volume["seconds"]["decode"] = seconds
+            except Exception as err:
+                volume["error"] = "decode: %s: %s" % (type(err).__name__, err)
+            await outqueue.put(volume)
+            inqueue.task_done()
+
+    async def _stage(self, loop, executor, stage, inqueue, outqueue):
+        """Run a stage on queued volumes in the executor."""
+        name = stage.__name__
+        while True:
+            volume = await inqueue.get()
+            if volume["error"] is None:
+                try:
+                    result, seconds = await loop.run_in_executor(
+                        executor, _timed, stage, volume
+                    )
+                    volume["products"][name] = result
+                    volume["seconds"][name] = seconds
+                except Exception as err:
+                    volume["error"] = "%s: %s: %s" % (name, type(err).__name__, err)
+            await outqueue.put(volume)
+            inqueue.task_done()
+
+    def _report(self, volume):
+        """Report of a volume that went through the pipeline."""
+        done = time.time()
+        products = {}
+        for name, product in volume["products"].items():
+            if isinstance(product, str):
+                products[name] = product
+        report = {
+            "filename": volume["filename"],
+            "kind": volume["kind"],
+            "status": "failed" if volume["error"] else "done",
+            "error": volume["error"],
+            "seconds": volume["seconds"],
+            "products": products,
+            "wait_seconds": volume["taken"] - volume["detected"],
+            "latency_seconds": done - volume["detected"],
+            "age_seconds": done - os.path.getmtime(volume["filename"])
+            if os.path.exists(volume["filename"])
+            else None,
+        }
+        return report
+
+    async def _finish(self, inqueue):
+        """Report volumes at the end of the pipeline, releasing their data."""
+        while True:
+            volume = await inqueue.get()
+            report = self._report(volume)
+            volume.clear()
+            self.reports.append(report)
+            if self.on_report is not None:
+                self.on_report(report)
+            inqueue.task_done()
+
+    async def run(self, max_files=None, timeout=None):
+        """
+        Watch the directory until stop is called, max_files files are
+        taken or timeout seconds have passed, and process the files taken.
+
+        Returns
+        -------
+        reports : list of dict
+            Reports of the volumes processed, in order of completion: file
+            name, kind, status ('done' or 'failed'), error, seconds of the
+            decode and of each stage, paths of the products that are files,
+            and the seconds from detection to being taken by the pipeline
+            (wait_seconds) and to the end of the pipeline (latency_seconds),
+            and from the file modification time to the end (age_seconds).
+        """
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._stopping = False
+        start = len(self.reports)
+
+        queues = [
+            asyncio.Queue(maxsize=self.queue_size)
+            for _ in range(len(self.stages) + 2)
+        ]
+        tasks = [
+            asyncio.ensure_future(self._decode(loop, executor, queues[0], queues[1]))
+            for _ in range(self.workers)
+        ]
+        for i, stage in enumerate(self.stages):
+            tasks.append(
+                asyncio.ensure_future(
+                    self._stage(loop, executor, stage, queues[i + 1], queues[i + 2])
+                )
+            )
+        tasks.append(asyncio.ensure_future(self._finish(queues[-1])))
+
+        watch = asyncio.ensure_future(self._watch(queues[0], max_files))
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, self.stop)
+        try:
+            await watch
+            # drain the pipeline, stage after stage
+            for queue in queues:
+                await queue.join()
+        finally:
+            # a timer left running would stop the next run of the watcher
+            if timer is not None:
+                timer.cancel()
+            watch.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(watch, *tasks, return_exceptions=True)
+            if self.executor is None:
+                executor.shutdown(wait=False)
+        return self.reports[start:]
+
+
+def _log_report(report):
+    """Print a line of a volume report."""
+    if report["status"] == "done":
+        stages = " ".join(
+            ["%s %.2f s" % item for item in report["seconds"].items()]
+        )
+        print(
+            "%-6s %s: latency %.2f s (%s)"
+            % ("ok", report["filename"], report["latency_seconds"], stages)
+        )
+    else:
+        print("%-6s %s (%s)" % ("FAILED", report["filename"], report["error"]))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Watch a directory and process the radar files dropped in it."
+    )
+    parser.add_argument("directory", help="directory to watch")
+    parser.add_argument(
+        "-o", "--output-dir", required=True, help="directory of the products"
+    )
+    parser.add_argument(
+        "--stages", nargs="*", default=["grid", "maxz", "quicklook"],
+        choices=["grid", "cappi", "maxz", "quicklook"],
+        help="product stages, in order (default: grid maxz quicklook)",
+    )
+    parser.add_argument(
+        "--pattern", default="*", help="shell pattern of the file names to take"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=2.0, help="seconds between polls"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=None,
+        help="seconds a file must be unchanged to be taken (default: interval)",
+    )
+    parser.add_argument(
+        "--atomic", action="store_true",
+        help="take files as soon as they appear (writers rename them in)",
+    )
+    parser.add_argument(
+        "--skip-existing", action="store_true",
+        help="ignore the files already in the directory",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=2, help="number of worker threads"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=2,
+        help="volumes waiting before each stage (default: 2)",
+    )
+    parser.add_argument(
+        "--max-files", type=int, default=None, help="stop after this many files"
+    )
+    parser.add_argument(
+        "--reports", default=None, help="append the reports to this JSON lines file"
+    )
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    factories = {
+        "grid": lambda: grid_stage(output_dir=args.output_dir),
+        "cappi": lambda: cappi_stage(output_dir=args.output_dir),
+        "maxz": lambda: maxz_stage(output_dir=args.output_dir),
+        "quicklook": lambda: quicklook_stage(args.output_dir),
+    }
+
+    def on_report(report):
+        _log_report(report)
+        if args.reports is not None:
+            with open(args.reports, "a") as f:
+                f.write(json.dumps(report) + "\n")
+
+    watcher = IngestWatcher(
+        args.directory,
+        [factories[name]() for name in args.stages],
+        pattern=args.pattern,
+        interval=args.interval,
+        settle=args.settle,
+        atomic=args.atomic,
+        skip_existing=args.skip_existing,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        on_report=on_report,
+    )
+    try:
+        reports = asyncio.run(watcher.run(max_files=args.max_files))
+    except KeyboardInterrupt:
+        return 1
+    return 1 if any([r["status"] == "failed" for r in reports]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,983 @@
+"""
+Quicklook images of PPI volumes, CAPPI grids and vertical profiles.
+
+Plotting a frame with RadarMapDisplay or GridMapDisplay creates a figure,
+cartopy axes, shapefile and coastline features and a colorbar, which takes
+longer than reading the file. QuicklookRenderer draws the parts of an
+image that only depend on the radar and the plot settings once: the
+background with the axes and the colorbar, and an overlay with latitude /
+longitude lines, range rings and the outlines of shapefiles (by default
+../dados/shapefiles/sao_paulo.shp) and, optionally, Natural Earth
+coastlines. These layouts are kept in memory and in `cache_dir`, keyed by
+the geometry of the frame, as the maps from image pixels to radar gates or
+grid cells.
+
+A frame is then the field mapped to colormap indices with a precomputed
+lookup table (Rainbow HDF5 fields read with quantized=True are mapped from
+their raw codes), gathered onto the pixels, colored and composited with
+the layout with numpy, and written as PNG with Pillow. `render_many`
+writes the frames from a pool of worker processes, which only color,
+composite and encode, while the main process reads the next frames.
+
+Accepted objects are:
+
+- PPI volumes (read_rainbow_hdf5, read_rainbow_vol, pyart.aux_io.read_gamic),
+  one sweep per frame, on an azimuthal equidistant map centered on the radar
+- grids (read_sipam_cappi, read_fcth_cappi), one level or the column
+  maximum per frame
+- vertically pointing radars and the (radar, melting layer) tuple of
+  read_mira, as a time-height image of a fixed time window
+
+Example
+-------
+>>> from quicklooks import QuicklookRenderer
+>>> from read_brazil_radar_py3 import read_rainbow_hdf5
+>>> renderer = QuicklookRenderer(cache_dir="/tmp/quicklooks")
+>>> radar = read_rainbow_hdf5("117BRX-20171115215006.HDF5")
+>>> renderer.render(radar, "ppi.png", sweep=0)
+>>> renderer.render_many(
+...     [(radar, "ppi_%02d.png" % i, {"sweep": i}) for i in range(radar.nsweeps)],
+...     workers=4,
+... )
+
+From the command line:
+
+    python quicklooks.py ../dados/radar/XPOL_CMP/*.HDF5 -o quicklooks --workers 4
+
+"""
+
+import argparse
+import datetime
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from array_cache import ArrayCache
+
+# Fields drawn when none is given, in order of preference
+DEFAULT_FIELDS = [
+    "corrected_reflectivity",
+    "reflectivity",
+    "DBZc",
+    "DBZ",
+    "Ze",
+    "Zg",
+]
+
+DEFAULT_OUTLINES = [
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "dados",
+        "shapefiles",
+        "sao_paulo.shp",
+    )
+]
+
+# Margins around the data box: top (title), right (colorbar), bottom, left
+MARGINS = (28, 90, 30, 52)
+
+BACKGROUND = (255, 255, 255)
+BOX_COLOR = (238, 238, 238)
+LINE_COLOR = (120, 120, 120, 160)
+OUTLINE_COLOR = (90, 90, 90, 255)
+COASTLINE_COLOR = (0, 0, 0, 255)
+TEXT_COLOR = (0, 0, 0)
+
+# Layouts and lookup tables of the worker processes, by key
+_worker_layouts = {}
+
+
+def _colormap(name):
+    """Colormap of a name, registering the Py-ART colormaps if needed."""
+    import matplotlib
+
+    if not isinstance(name, str):
+        return name
+    if name not in matplotlib.colormaps:
+        import pyart  # noqa: F401, registers the Py-ART colormaps
+    if name not in matplotlib.colormaps and name.startswith("pyart_"):
+        name = name[len("pyart_") :]
+    return matplotlib.colormaps[name]
+
+
+class ColormapLUT(object):
+    """
+    Colormap as a lookup table of RGBA colors.
+
+    Values are mapped to indices 1..ncolors, clipped to [vmin, vmax]; index
+    0 is missing data, which is left transparent.
+
+    Parameters
+    ----------
+    cmap : str or Colormap, optional
+        Colormap, with or without the pyart_ prefix of Py-ART 1.x.
+    vmin, vmax : float, optional
+        Limits of the colormap.
+    ncolors : int, optional
+        Number of colors, at most 255.
+    """
+
+    def __init__(self, cmap="pyart_NWSRef", vmin=-10.0, vmax=70.0, ncolors=255):
+        if not 1 <= ncolors <= 255:
+            raise ValueError("ncolors must be between 1 and 255: %s" % ncolors)
+        colormap = _colormap(cmap)
+        self.name = colormap.name
+        self.vmin = float(vmin)
+        self.vmax = float(vmax)
+        self.ncolors = ncolors
+        self.table = np.zeros((ncolors + 1, 4), dtype="uint8")
+        colors = colormap(np.linspace(0.0, 1.0, ncolors))
+        self.table[1:] = np.round(colors * 255).astype("uint8")
+
+    def key(self):
+        return (self.name, self.vmin, self.vmax, self.ncolors)
+
+    def index(self, data):
+        """
+        Colormap indices of data, as uint8, 0 where masked or not finite.
+        """
+        values = np.asarray(np.ma.getdata(data), dtype="float32")
+        scaled = (values - self.vmin) * (self.ncolors / (self.vmax - self.vmin))
+        with np.errstate(invalid="ignore"):
+            codes = np.clip(scaled, 0, self.ncolors - 1).astype("uint8")
+        codes += 1
+        invalid = ~np.isfinite(values)
+        mask = np.ma.getmask(data)
+        if mask is not np.ma.nomask:
+            invalid |= mask
+        codes[invalid] = 0
+        return codes
+
+    def index_codes(self, moment, sweep):
+        """
+        Colormap index of each raw code of a sweep of a QuantizedMoment, a
+        lookup table from the codes of the file to colormap indices.
+        """
+        ncodes = np.iinfo(moment.codes.dtype).max + 1
+        values = moment.offset[sweep] + np.arange(ncodes) * moment.scale[sweep]
+        table = self.index(values)
+        table[0] = 0
+        return table
+
+    def rgba(self, codes):
+        """RGBA colors of colormap indices."""
+        return self.table[codes]
+
+
+def _field_name(obj, field=None):
+    """Field of a radar or grid to draw."""
+    if field is not None:
+        return field
+    for name in DEFAULT_FIELDS:
+        if name in obj.fields:
+            return name
+    return list(obj.fields.keys())[0]
+
+
+def _kind(obj):
+    """'grid', 'vpt' or 'ppi' for the objects the renderer accepts."""
+    if hasattr(obj, "nx") and hasattr(obj, "z"):
+        return "grid"
+    if obj.scan_type == "vpt" or np.all(obj.elevation["data"] > 85.0):
+        return "vpt"
+    return "ppi"
+
+
+def _datetime(time_dic, value):
+    """Datetime of a value of a time dictionary."""
+    from netCDF4 import num2date
+
+    return num2date(
+        value,
+        time_dic["units"],
+        time_dic.get("calendar", "standard"),
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
+
+
+def _line_parts(geometry):
+    """Coordinates of the lines of a geometry, polygons as their rings."""
+    import shapely
+
+    if geometry.geom_type in ["Polygon", "MultiPolygon"]:
+        geometry = geometry.boundary
+    return [
+        shapely.get_coordinates(part)
+        for part in shapely.get_parts(geometry)
+        if not part.is_empty and part.geom_type != "Point"
+    ]
+
+
+def _file_version(filename):
+    """Path, size and modification time of a file."""
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+class _Layout(object):
+    """
+    Background and overlay of a frame geometry.
+
+    background is the (height, width, 3) uint8 image without data, box the
+    (top, left, height, width) of the data in it, and overlay_pixels,
+    overlay_rgb and overlay_alpha the flat indices in the box, colors and
+    opacity of the pixels drawn over the data.
+    """
+
+    def __init__(self, background, box, overlay_pixels, overlay_rgb, overlay_alpha):
+        self.background = background
+        self.box = tuple(int(b) for b in box)
+        self.overlay_pixels = overlay_pixels
+        self.overlay_rgb = overlay_rgb
+        self.overlay_alpha = overlay_alpha
+
+    @classmethod
+    def from_images(cls, background, box, overlay):
+        overlay = np.asarray(overlay)
+        alpha = overlay[..., 3].ravel()
+        pixels = np.flatnonzero(alpha)
+        return cls(
+            np.asarray(background.convert("RGB")),
+            box,
+            pixels.astype("int32"),
+            overlay[..., :3].reshape(-1, 3)[pixels],
+            alpha[pixels],
+        )
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls(
+                f["background"],
+                f["box"],
+                f["overlay_pixels"],
+                f["overlay_rgb"],
+                f["overlay_alpha"],
+            )
+
+    def arrays(self):
+        return {
+            "background": self.background,
+            "box": np.array(self.box),
+            "overlay_pixels": self.overlay_pixels,
+            "overlay_rgb": self.overlay_rgb,
+            "overlay_alpha": self.overlay_alpha,
+        }
+
+    def compose(self, codes, table):
+        """
+        Image of a frame, from the colormap indices of the pixels of the
+        box (-1 or 0 where there is no data) and the RGBA lookup table.
+        """
+        top, left, height, width = self.box
+        image = self.background.copy()
+        box = self.background[top : top + height, left : left + width]
+        box = box.reshape(-1, 3).copy()
+        codes = codes.ravel()
+        valid = np.flatnonzero(codes > 0)
+        colors = table[codes[valid]]
+        alpha = colors[:, 3:4].astype("uint16")
+        box[valid] = (
+            colors[:, :3] * alpha + box[valid] * (255 - alpha) + 127
+        ) // 255
+        if len(self.overlay_pixels):
+            alpha = self.overlay_alpha[:, np.newaxis].astype("uint16")
+            pixels = self.overlay_pixels
+            box[pixels] = (
+                self.overlay_rgb * alpha + box[pixels] * (255 - alpha) + 127
+            ) // 255
+        image[top : top + height, left : left + width] = box.reshape(height, width, 3)
+        return image
+
+
+def _write_frame(layout_file, codes, table, title, filename, compress_level):
+    """Color, composite and write a frame, in a worker process."""
+    layout = _worker_layouts.get(layout_file)
+    if layout is None:
+        layout = _worker_layouts[layout_file] = _Layout.load(layout_file)
+    _save_image(layout, codes, table, title, filename, compress_level)
+    return filename
+
+
+def _save_image(layout, codes, table, title, filename, compress_level):
+    image = Image.fromarray(layout.compose(codes, table))
+    if title:
+        ImageDraw.Draw(image).text(
+            (layout.box[1], 6), title, fill=TEXT_COLOR, font=ImageFont.load_default()
+        )
+    image.save(filename, compress_level=compress_level)
+
+
+class QuicklookRenderer(ArrayCache):
+    """
+    Renderer of quicklook images with cached layouts and pixel maps.
+
+    Parameters
+    ----------
+    field : str or None, optional
+        Field to draw. None draws the first of DEFAULT_FIELDS in the object,
+        or its first field.
+    cmap, vmin, vmax : optional
+        Colormap and its limits.
+    size : int, optional
+        Width of the map box of PPI and grid frames, in pixels. PPI maps are
+        square, grid maps keep the aspect of the grid.
+    vpt_size : tuple, optional
+        (width, height) of the box of vertically pointing frames.
+    max_range : float or None, optional
+        Half width of PPI maps, in meters. None uses the last gate.
+    outlines : list of str, optional
+        Shapefiles drawn over PPI and grid maps.
+    coastlines : str or None, optional
+        Scale of the Natural Earth coastlines drawn over the maps ('10m',
+        '50m' or '110m'), or None. Cartopy downloads them on first use.
+    grid_step : float or None, optional
+        Spacing of the latitude / longitude lines, in degrees.
+    ring_step : float or None, optional
+        Spacing of the range rings of PPI maps, in meters.
+    hours : float, optional
+        Time window of vertically pointing frames, starting at the first
+        ray of the object, floored to a multiple of the window.
+    max_height : float or None, optional
+        Top of vertically pointing frames, in meters. None uses the last
+        gate.
+    cache_dir : str or None, optional
+        Directory where layouts are stored. None keeps them in a temporary
+        directory, removed by `close`.
+    compress_level : int, optional
+        zlib level of the PNG files, 1 is fast and 9 small.
+    """
+
+    def __init__(
+        self,
+        field=None,
+        cmap="pyart_NWSRef",
+        vmin=-10.0,
+        vmax=70.0,
+        size=600,
+        vpt_size=(800, 300),
+        max_range=None,
+        outlines=DEFAULT_OUTLINES,
+        coastlines=None,
+        grid_step=1.0,
+        ring_step=50000.0,
+        hours=24.0,
+        max_height=None,
+        cache_dir=None,
+        compress_level=1,
+    ):
+        self.field = field
+        self.lut = ColormapLUT(cmap, vmin, vmax)
+        self.size = int(size)
+        self.vpt_size = tuple(int(s) for s in vpt_size)
+        self.max_range = max_range
+        self.outlines = [o for o in outlines if os.path.isfile(o)]
+        self.coastlines = coastlines
+        self.grid_step = grid_step
+        self.ring_step = ring_step
+        self.hours = float(hours)
+        self.max_height = max_height
+        self.compress_level = compress_level
+        self._tmpdir = None
+        if cache_dir is None:
+            self._tmpdir = cache_dir = tempfile.mkdtemp(prefix="quicklooks-")
+        elif not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        ArrayCache.__init__(self, cache_dir)
+        self._pixel_maps = {}
+        self._lines = {}
+
+    def close(self):
+        """Remove the temporary layout directory, if any."""
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _key(self, items):
+        sha = hashlib.sha1()
+        for item in items:
+            if isinstance(item, np.ndarray):
+                sha.update(repr(item.shape).encode())
+                sha.update(np.round(item.astype("float64"), 4).tobytes())
+            else:
+                sha.update(repr(item).encode())
+        return sha.hexdigest()
+
+    def _layout(self, definition, build):
+        """
+        Name of the layout file of a definition and the layout, from
+        memory, disk or build().
+        """
+        key = self._key(
+            definition
+            + [
+                self.lut.key(),
+                MARGINS,
+                [_file_version(o) for o in self.outlines],
+                self.coastlines,
+                self.grid_step,
+                self.ring_step,
+            ]
+        )
+        return self._path(key), self._cached(key, build)
+
+    def _to_arrays(self, layout):
+        return layout.arrays()
+
+    def _from_arrays(self, arrays):
+        return _Layout(**arrays)
+
+    # drawing of the layouts
+
+    def _canvas(self, width, height, label):
+        """Background of a box of (width, height) pixels, with the
+        colorbar of the field named label."""
+        top, right, bottom, left = MARGINS
+        image = Image.new("RGB", (left + width + right, top + height + bottom))
+        image.paste(BACKGROUND, (0, 0) + image.size)
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.load_default()
+        draw.rectangle(
+            [left, top, left + width - 1, top + height - 1], fill=BOX_COLOR
+        )
+        draw.rectangle(
+            [left - 1, top - 1, left + width, top + height], outline=TEXT_COLOR
+        )
+        # colorbar, from vmin at the bottom to vmax at the top
+        x0 = left + width + 12
+        rows = np.linspace(self.lut.ncolors, 1, height).round().astype("intp")
+        bar = np.repeat(self.lut.table[rows, np.newaxis, :3], 14, axis=1)
+        image.paste(Image.fromarray(np.ascontiguousarray(bar)), (x0, top))
+        draw.rectangle([x0 - 1, top - 1, x0 + 14, top + height], outline=TEXT_COLOR)
+        for value in np.linspace(self.lut.vmin, self.lut.vmax, 6):
+            y = top + (self.lut.vmax - value) / (self.lut.vmax - self.lut.vmin) * (
+                height - 1
+            )
+            draw.line([x0 + 14, y, x0 + 18, y], fill=TEXT_COLOR)
+            draw.text(
+                (x0 + 21, y), "%g" % value, fill=TEXT_COLOR, font=font, anchor="lm"
+            )
+        draw.text(
+            (left + width + right - 4, 6),
+            label,
+            fill=TEXT_COLOR,
+            font=font,
+            anchor="ra",
+        )
+        return image, draw, font
+
+    def _axis_ticks(self, draw, font, box, extent, step, scale=1e-3):
+        """Ticks along the bottom and left of a map box, in km from the
+        origin."""
+        top, left, height, width = box
+        x0, x1, y0, y1 = extent
+        if step is None:
+            return
+        for value in np.arange(np.ceil(x0 / step), np.floor(x1 / step) + 1) * step:
+            x = left + (value - x0) / (x1 - x0) * width
+            draw.line([x, top + height, x, top + height + 4], fill=TEXT_COLOR)
+            draw.text(
+                (x, top + height + 6),
+                "%g" % (value * scale),
+                fill=TEXT_COLOR,
+                font=font,
+                anchor="mt",
+            )
+        for value in np.arange(np.ceil(y0 / step), np.floor(y1 / step) + 1) * step:
+            y = top + (y1 - value) / (y1 - y0) * height
+            draw.line([left - 5, y, left - 1, y], fill=TEXT_COLOR)
+            draw.text(
+                (left - 7, y),
+                "%g" % (value * scale),
+                fill=TEXT_COLOR,
+                font=font,
+                anchor="rm",
+            )
+
+    def _geometries(self, shapefile):
+        """Line coordinates of the records of a shapefile, read once."""
+        version = _file_version(shapefile)
+        lines = self._lines.get(version)
+        if lines is None:
+            from region_masks import read_regions
+
+            _, geometries = read_regions(shapefile)
+            lines = []
+            for geometry in geometries:
+                lines.extend(_line_parts(geometry))
+            self._lines[version] = lines
+        return lines
+
+    def _coastline_lines(self):
+        from cartopy.io.shapereader import Reader, natural_earth
+
+        filename = natural_earth(self.coastlines, "physical", "coastline")
+        lines = []
+        for geometry in Reader(filename).geometries():
+            lines.extend(_line_parts(geometry))
+        return lines
+
+    def _map_layout(self, lat0, lon0, extent, width, height, label, rings=False):
+        """Layout of a map box of (width, height) pixels covering extent,
+        (xmin, xmax, ymin, ymax) in meters of the azimuthal equidistant
+        projection centered on (lat0, lon0)."""
+        from pyart.core.transforms import (
+            cartesian_to_geographic_aeqd,
+            geographic_to_cartesian_aeqd,
+        )
+
+        top, right, bottom, left = MARGINS
+        box = (top, left, height, width)
+        x0, x1, y0, y1 = extent
+        image, draw, font = self._canvas(width, height, label)
+        self._axis_ticks(draw, font, box, extent, self.ring_step)
+
+        overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        odraw = ImageDraw.Draw(overlay)
+
+        def to_pixels(lon, lat):
+            x, y = geographic_to_cartesian_aeqd(lon, lat, lon0, lat0)
+            return np.column_stack(
+                [(x - x0) / (x1 - x0) * width, (y1 - y) / (y1 - y0) * height]
+            )
+
+        # longitude / latitude bounds of the box, from points on its edges
+        t = np.linspace(0.0, 1.0, 50)
+        ex = np.concatenate([x0 + (x1 - x0) * t, np.full(50, x1), x0 + (x1 - x0) * t])
+        ey = np.concatenate([np.full(50, y0), y0 + (y1 - y0) * t, np.full(50, y1)])
+        ex = np.concatenate([ex, np.full(50, x0)])
+        ey = np.concatenate([ey, y0 + (y1 - y0) * t])
+        lons, lats = cartesian_to_geographic_aeqd(ex, ey, lon0, lat0)
+        bounds = (lons.min(), lats.min(), lons.max(), lats.max())
+
+        if self.grid_step:
+            step = self.grid_step
+            fine = np.linspace(bounds[1], bounds[3], 100)
+            for lon in np.arange(np.ceil(bounds[0] / step) * step, bounds[2], step):
+                points = to_pixels(np.full(100, lon), fine)
+                odraw.line(points.ravel().tolist(), fill=LINE_COLOR, width=1)
+            fine = np.linspace(bounds[0], bounds[2], 100)
+            for lat in np.arange(np.ceil(bounds[1] / step) * step, bounds[3], step):
+                points = to_pixels(fine, np.full(100, lat))
+                odraw.line(points.ravel().tolist(), fill=LINE_COLOR, width=1)
+        if rings and self.ring_step:
+            cx = -x0 / (x1 - x0) * width
+            cy = y1 / (y1 - y0) * height
+            for radius in np.arange(self.ring_step, max(-x0, x1) + 1, self.ring_step):
+                rx = radius / (x1 - x0) * width
+                ry = radius / (y1 - y0) * height
+                odraw.ellipse(
+                    [cx - rx, cy - ry, cx + rx, cy + ry], outline=LINE_COLOR, width=1
+                )
+
+        sources = [(self._geometries(o), OUTLINE_COLOR) for o in self.outlines]
+        if self.coastlines:
+            sources.append((self._coastline_lines(), COASTLINE_COLOR))
+        for lines, color in sources:
+            for coords in lines:
+                inside = (
+                    (coords[:, 0] >= bounds[0])
+                    & (coords[:, 0] <= bounds[2])
+                    & (coords[:, 1] >= bounds[1])
+                    & (coords[:, 1] <= bounds[3])
+                )
+                if len(coords) < 2 or not np.any(inside):
+                    continue
+                points = to_pixels(coords[:, 0], coords[:, 1])
+                odraw.line(points.ravel().tolist(), fill=color, width=1)
+        return _Layout.from_images(image, box, overlay)
+
+    def _vpt_layout(self, width, height, max_height, label):
+        top, right, bottom, left = MARGINS
+        box = (top, left, height, width)
+        image, draw, font = self._canvas(width, height, label)
+        # time ticks every hours / 8 along the bottom, as HH:MM from the start
+        for hour in np.linspace(0.0, self.hours, 9):
+            x = left + hour / self.hours * (width - 1)
+            draw.line([x, top + height, x, top + height + 4], fill=TEXT_COLOR)
+            minutes = int(round(hour * 60))
+            draw.text(
+                (x, top + height + 6),
+                "%02d:%02d" % divmod(minutes, 60),
+                fill=TEXT_COLOR,
+                font=font,
+                anchor="mt",
+            )
+        overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        odraw = ImageDraw.Draw(overlay)
+        step = 1000.0 if max_height <= 6000.0 else 2000.0
+        for value in np.arange(0.0, max_height + 1.0, step):
+            y = (1.0 - value / max_height) * height
+            draw.line([left - 5, top + y, left - 1, top + y], fill=TEXT_COLOR)
+            draw.text(
+                (left - 7, top + y),
+                "%g km" % (value / 1000.0),
+                fill=TEXT_COLOR,
+                font=font,
+                anchor="rm",
+            )
+            odraw.line([0, y, width, y], fill=LINE_COLOR, width=1)
+        return _Layout.from_images(image, box, overlay)
+
+    # pixel maps and frames
+
+    def _pixel_map(self, key, build):
+        pixels = self._pixel_maps.get(key)
+        if pixels is None:
+            if len(self._pixel_maps) >= 64:
+                self._pixel_maps.pop(next(iter(self._pixel_maps)))
+            pixels = self._pixel_maps[key] = build()
+        return pixels
+
+    def _ppi_frame(self, radar, field, sweep):
+        from cross_sections import AzimuthIndex
+
+        start = int(radar.sweep_start_ray_index["data"][sweep])
+        end = int(radar.sweep_end_ray_index["data"][sweep])
+        azimuth = np.asarray(radar.azimuth["data"][start : end + 1], dtype="float64")
+        elevation = float(np.mean(radar.elevation["data"][start : end + 1]))
+        rng = np.asarray(radar.range["data"], dtype="float64")
+        max_range = self.max_range or rng[-1]
+        size = self.size
+        lat0 = float(np.asarray(radar.latitude["data"]).ravel()[0])
+        lon0 = float(np.asarray(radar.longitude["data"]).ravel()[0])
+        extent = (-max_range, max_range, -max_range, max_range)
+
+        def build():
+            # flat index into the (rays, gates) data of the sweep of each
+            # pixel, -1 outside the sweep
+            centers = (np.arange(size) + 0.5) / size * 2 * max_range - max_range
+            x, y = np.meshgrid(centers, centers[::-1])
+            ground = np.hypot(x, y).ravel()
+            pixel_azimuth = np.degrees(np.arctan2(x, y)).ravel()
+            spacing = np.diff(np.sort(np.mod(azimuth, 360.0)))
+            az_tol = 1.5 * max(np.median(spacing) if len(spacing) else 1.0, 0.1)
+            index = AzimuthIndex(azimuth, [0], [len(azimuth) - 1])
+            rays = index.nearest(pixel_azimuth, az_tol)[0][:, 0]
+            gate_spacing = rng[1] - rng[0] if len(rng) > 1 else 1.0
+            slant = ground / np.cos(np.radians(elevation))
+            gates = np.round((slant - rng[0]) / gate_spacing).astype("intp")
+            valid = (rays >= 0) & (gates >= 0) & (gates < len(rng))
+            pixels = np.where(valid, rays * len(rng) + gates, -1)
+            return pixels.astype("int32").reshape(size, size)
+
+        geometry = [
+            "ppi",
+            np.round(azimuth, 2),
+            np.round(elevation, 1),
+            rng[[0, -1]],
+            len(rng),
+            max_range,
+            size,
+        ]
+        pixels = self._pixel_map(self._key(geometry), build)
+        layout = self._layout(
+            ["ppi", lat0, lon0, extent, size],
+            lambda: self._map_layout(
+                lat0, lon0, extent, size, size, self._label(radar, field), rings=True
+            ),
+        )
+        codes = self._sweep_codes(radar.fields[field], sweep, start, end)
+        title = "%s %s  %.1f deg  %s" % (
+            self._name(radar),
+            _datetime(radar.time, radar.time["data"][start]).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+            radar.fixed_angle["data"][sweep],
+            field,
+        )
+        return layout, self._gather(codes, pixels), title
+
+    def _sweep_codes(self, field_dic, sweep, start, end):
+        """Colormap indices of the (rays, gates) of a sweep."""
+        moment = getattr(field_dic, "moment", None)
+        if moment is not None and moment.codes.dtype.itemsize <= 2:
+            table = self.lut.index_codes(moment, sweep)
+            return table[moment.codes[start : end + 1]]
+        return self.lut.index(field_dic["data"][start : end + 1])
+
+    def _grid_frame(self, grid, field, level):
+        nx, ny = grid.nx, grid.ny
+        x = np.asarray(grid.x["data"], dtype="float64")
+        y = np.asarray(grid.y["data"], dtype="float64")
+        dx = (x[-1] - x[0]) / max(nx - 1, 1)
+        dy = (y[-1] - y[0]) / max(ny - 1, 1)
+        extent = (x[0] - dx / 2, x[-1] + dx / 2, y[0] - dy / 2, y[-1] + dy / 2)
+        width = self.size
+        aspect = (extent[3] - extent[2]) / (extent[1] - extent[0])
+        height = max(1, int(round(width * aspect)))
+        lat0 = float(np.asarray(grid.origin_latitude["data"]).ravel()[0])
+        lon0 = float(np.asarray(grid.origin_longitude["data"]).ravel()[0])
+
+        def build():
+            # flat index of the (y, x) cell of each pixel, rows from north
+            columns = ((np.arange(width) + 0.5) / width * nx).astype("intp")
+            rows = ((np.arange(height)[::-1] + 0.5) / height * ny).astype("intp")
+            pixels = rows[:, np.newaxis] * nx + columns[np.newaxis, :]
+            return pixels.astype("int32")
+
+        pixels = self._pixel_map(self._key(["grid", nx, ny, width, height]), build)
+        layout = self._layout(
+            ["grid", lat0, lon0, np.array(extent), width, height],
+            lambda: self._map_layout(
+                lat0, lon0, extent, width, height, self._label(grid, field)
+            ),
+        )
+        data = grid.fields[field]["data"]
+        if level == "max":
+            plane = np.ma.max(data, axis=0)
+            where = "column max"
+        else:
+            plane = data[level]
+            where = "%g km" % (grid.z["data"][level] / 1000.0)
+        title = "%s  %s  %s" % (
+            _datetime(grid.time, grid.time["data"][0]).strftime("%Y-%m-%d %H:%M:%S"),
+            where,
+            field,
+        )
+        return layout, self._gather(self.lut.index(plane), pixels), title
+
+    def _vpt_frame(self, radar, field):
+        width, height = self.vpt_size
+        rng = np.asarray(radar.range["data"], dtype="float64")
+        max_height = float(self.max_height or rng[-1])
+        times = np.asarray(radar.time["data"], dtype="float64")
+        window = self.hours * 3600.0
+        first = _datetime(radar.time, times[0])
+        midnight = first.replace(hour=0, minute=0, second=0, microsecond=0)
+        offset = (first - midnight).total_seconds() % window
+        start = times[0] - offset
+
+        # last ray in each column, and gate of each row
+        columns = np.floor((times - start) / window * width).astype("intp")
+        column_ray = np.full(width, -1, dtype="intp")
+        valid = (columns >= 0) & (columns < width)
+        column_ray[columns[valid]] = np.flatnonzero(valid)
+        heights = (np.arange(height)[::-1] + 0.5) / height * max_height
+        gate_spacing = rng[1] - rng[0] if len(rng) > 1 else 1.0
+        row_gate = np.round((heights - rng[0]) / gate_spacing).astype("intp")
+        row_gate[(row_gate < 0) | (row_gate >= len(rng))] = -1
+        pixels = column_ray[np.newaxis, :] * len(rng) + row_gate[:, np.newaxis]
+        pixels[(column_ray[np.newaxis, :] < 0) | (row_gate[:, np.newaxis] < 0)] = -1
+
+        layout = self._layout(
+            ["vpt", width, height, self.hours, max_height],
+            lambda: self._vpt_layout(
+                width, height, max_height, self._label(radar, field)
+            ),
+        )
+        codes = self.lut.index(radar.fields[field]["data"])
+        title = "%s %s  %s" % (
+            self._name(radar),
+            (first - datetime.timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M"),
+            field,
+        )
+        return layout, self._gather(codes, pixels), title
+
+    @staticmethod
+    def _gather(codes, pixels):
+        """Colormap indices of the pixels, 0 where there is no data."""
+        codes = codes.ravel()
+        return np.where(pixels >= 0, codes[np.maximum(pixels, 0)], 0).astype("uint8")
+
+    @staticmethod
+    def _label(obj, field):
+        units = obj.fields[field].get("units", "")
+        return "%s (%s)" % (field, units) if units else field
+
+    @staticmethod
+    def _name(radar):
+        name = radar.metadata.get("instrument_name", "")
+        if isinstance(name, bytes):
+            name = name.decode("utf-8", "replace")
+        return str(name)
+
+    def frame(self, obj, field=None, sweep=0, level=0, title=None):
+        """
+        Layout and colormap indices of a frame.
+
+        Parameters
+        ----------
+        obj : Radar, Grid or tuple
+            PPI volume, grid or vertically pointing radar, or the (radar,
+            melting layer) tuple of read_mira.
+        field : str or None, optional
+            Field to draw, None uses the field of the renderer.
+        sweep : int, optional
+            Sweep of PPI volumes.
+        level : int or 'max', optional
+            Level of grids, or 'max' for the column maximum.
+        title : str or None, optional
+            Title of the frame, None builds one from the object.
+
+        Returns
+        -------
+        layout_file : str
+            Name of the layout file in cache_dir.
+        layout : object
+            The layout.
+        codes : array
+            uint8 colormap indices of the pixels of the data box.
+        title : str
+        """
+        if isinstance(obj, tuple):
+            obj = obj[0]
+        field = _field_name(obj, field or self.field)
+        kind = _kind(obj)
+        if kind == "grid":
+            (layout_file, layout), codes, default = self._grid_frame(obj, field, level)
+        elif kind == "vpt":
+            (layout_file, layout), codes, default = self._vpt_frame(obj, field)
+        else:
+            (layout_file, layout), codes, default = self._ppi_frame(obj, field, sweep)
+        return layout_file, layout, codes, default.strip() if title is None else title
+
+    def render(self, obj, filename, **kwargs):
+        """
+        Write a frame as PNG, in this process. See `frame` for the
+        keyword arguments.
+        """
+        _, layout, codes, title = self.frame(obj, **kwargs)
+        _save_image(layout, codes, self.lut.table, title, filename, self.compress_level)
+        return filename
+
+    def render_many(self, items, workers=None):
+        """
+        Write many frames as PNG from a pool of worker processes.
+
+        Parameters
+        ----------
+        items : iterable
+            (obj, filename) or (obj, filename, kwargs) tuples, see `frame`
+            for the keyword arguments. It may be a generator reading the
+            objects, as frames are only prepared a few at a time.
+        workers : int or None, optional
+            Number of worker processes, None uses the number of CPUs. 0
+            writes the frames in this process.
+
+        Returns
+        -------
+        filenames : list
+            Names of the files written, in the order of items.
+        """
+        if workers == 0:
+            return [
+                self.render(item[0], item[1], **(item[2] if len(item) > 2 else {}))
+                for item in items
+            ]
+        workers = workers or os.cpu_count()
+        filenames = []
+        pending = []
+        with ProcessPoolExecutor(workers) as executor:
+            for item in items:
+                options = item[2] if len(item) > 2 else {}
+                layout_file, _, codes, title = self.frame(item[0], **options)
+                pending.append(
+                    executor.submit(
+                        _write_frame,
+                        layout_file,
+                        codes,
+                        self.lut.table,
+                        title,
+                        item[1],
+                        self.compress_level,
+                    )
+                )
+                # bound the frames waiting in memory
+                if len(pending) >= 2 * workers:
+                    filenames.append(pending.pop(0).result())
+            filenames.extend([future.result() for future in pending])
+        return filenames
+
+
+def _frames(filenames, args):
+    """(obj, filename, kwargs) of every frame of the files."""
+    from batch_ingest import read_file
+
+    for filename in filenames:
+        obj = read_file(filename)
+        base = os.path.join(args.output, os.path.basename(filename).split(".")[0])
+        kind = _kind(obj)
+        if kind == "ppi":
+            sweeps = range(obj.nsweeps) if args.sweep is None else [args.sweep]
+            for sweep in sweeps:
+                yield obj, "%s_%02d.png" % (base, sweep), {"sweep": sweep}
+        elif kind == "grid":
+            yield obj, base + ".png", {"level": args.level}
+        else:
+            yield obj, base + ".png", {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write quicklook PNG images of radar files."
+    )
+    parser.add_argument("files", nargs="+", help="radar files")
+    parser.add_argument("-o", "--output", default=".", help="output directory")
+    parser.add_argument("--field", default=None, help="field to draw")
+    parser.add_argument("--cmap", default="pyart_NWSRef")
+    parser.add_argument("--vmin", type=float, default=-10.0)
+    parser.add_argument("--vmax", type=float, default=70.0)
+    parser.add_argument("--size", type=int, default=600, help="map size in pixels")
+    parser.add_argument(
+        "--sweep", type=int, default=None, help="only this sweep of PPI volumes"
+    )
+    parser.add_argument(
+        "--level",
+        default="0",
+        help="level of grids, or 'max' for the column maximum",
+    )
+    parser.add_argument(
+        "--outlines",
+        nargs="*",
+        default=DEFAULT_OUTLINES,
+        help="shapefiles drawn over the maps",
+    )
+    parser.add_argument(
+        "--coastlines", default=None, help="Natural Earth scale (10m, 50m, 110m)"
+    )
+    parser.add_argument("--cache-dir", default=None, help="layout cache directory")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    if args.level != "max":
+        args.level = int(args.level)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    start = time.perf_counter()
+    with QuicklookRenderer(
+        field=args.field,
+        cmap=args.cmap,
+        vmin=args.vmin,
+        vmax=args.vmax,
+        size=args.size,
+        outlines=args.outlines,
+        coastlines=args.coastlines,
+        cache_dir=args.cache_dir,
+    ) as renderer:
+        filenames = renderer.render_many(_frames(args.files, args), args.workers)
+        print(
+            "%d images in %.2f s, layouts %s"
+            % (len(filenames), time.perf_counter() - start, renderer.stats())
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
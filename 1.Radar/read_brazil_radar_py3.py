@@ -1,17 +1,425 @@
 # -*- coding: UTF-8 -*-
 # Originally developed by Timothy Lang (https://github.com/tjlang)
 # Adapted for Python 3 by Camila Lopes (camila.lopes@iag.usp.br)
+#
+# Py-ART is only imported when a Radar object is built (read_rainbow_hdf5),
+# so iter_rainbow_sweeps, QuantizedField and the decoding functions need
+# only numpy and h5py.
 
 from __future__ import print_function
 import numpy as np
 import h5py
-from pyart.core import Radar
-from pyart.config import FileMetadata
-from pyart.io.common import make_time_unit_str
 import datetime as dt
+import itertools
+from collections.abc import MutableMapping
 
+from reader_trace import span, traced
 
-def _initial_process(r):
+# Field names of the moment datasets
+FIELD_NAMES = {
+    'moment_0': 'corrected_reflectivity',
+    'moment_1': 'reflectivity',
+    'moment_2': 'velocity',
+    'moment_3': 'spectrum_width',
+    'moment_4': 'differential_reflectivity',
+    'moment_5': 'filtered_differential_phase',
+    'moment_6': 'differential_phase',
+    'moment_7': 'specific_differential_phase',
+    'moment_8': 'cross_correlation_ratio'}
+
+
+def _attr(obj, name):
+    """
+    Returns the value of an HDF5 attribute, unwrapping the single-element
+    arrays that some Rainbow to HDF5 conversions store instead of scalars.
+    """
+    value = obj.attrs[name]
+    if np.ndim(value) > 0:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def _time_unit_str(dtobj):
+    """
+    Returns a time unit string from a datetime object, as
+    pyart.io.common.make_time_unit_str.
+    """
+    return 'seconds since ' + dtobj.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _scan_labels(r):
+    """
+    Returns the names of the scan groups in an h5py.File object, sorted
+    by sweep number (scan0, scan1, ..., scan10, ...).
+    """
+    return sorted([key for key in r.keys() if key[:4] == 'scan'],
+                  key=lambda key: int(key[4:]))
+
+
+def _decode_moment(dset, out, bad=-32768):
+    """
+    Decodes the raw UV8/UV16 codes of a moment dataset into physical
+    values, writing them in place into `out`. Zero codes are missing data
+    and are set to `bad`.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        Moment dataset (e.g. r['scan0']['moment_0']).
+    out : numpy.ndarray
+        View of the output buffer for this sweep, with at least as many
+        gates as the dataset.
+    bad : float, optional
+        Value used for missing data.
+    """
+    if str(_attr(dset, 'format')) == 'UV8':
+        div = 254.0
+    else:
+        div = 65534.0
+    vmin = _attr(dset, 'dyn_range_min')
+    vmax = _attr(dset, 'dyn_range_max')
+    with span('read', dataset=dset.name) as s:
+        raw = dset[()]
+        s.alloc(raw)
+    ngates = raw.shape[1]
+    with span('decode', dataset=dset.name):
+        np.multiply(raw, (vmax - vmin) / div, out=out[:, :ngates])
+        out[:, :ngates] += vmin
+        out[:, :ngates][raw == 0] = bad
+
+
+def _sweep_info(scan):
+    """
+    Reads the ray angles and the PRF-derived parameters of one sweep.
+
+    Parameters
+    ----------
+    scan : h5py.Group
+        Scan group (e.g. r['scan0']).
+
+    Returns
+    -------
+    info : dict
+        Azimuth and elevation of each ray, fixed angle, unambiguous range
+        [m] and Nyquist velocity [m/s] of the sweep.
+    """
+    rayhead = scan['ray_header'][()]
+    names = rayhead.dtype.names
+    prf = _attr(scan['how'], 'PRF')
+    wl = _attr(scan['how'], 'radar_wave_length')
+    # Fixed angle is the elevation of a PPI and the azimuth of an RHI
+    if str(_attr(scan['what'], 'scan_type')).lower() == 'rhi':
+        fixed_angle = np.median(rayhead[names[0]])
+    elif 'elevation' in scan['how'].attrs:
+        fixed_angle = _attr(scan['how'], 'elevation')
+    else:
+        fixed_angle = np.median(rayhead[names[2]])
+    return {
+        'azimuths': rayhead[names[0]],
+        'elevations': rayhead[names[2]],
+        'fixed_angle': fixed_angle,
+        'unambiguous_range': 3e8 / (2 * prf),
+        'nyquist_velocity': prf * wl / 4.0}
+
+
+def _volume_duration(r, slabs):
+    """
+    Returns the start time and the total duration in seconds of a volume.
+    The last sweep lacks completion time, so its duration is inferred from
+    a linear fit to scan speed and time for each sweep. If the fit is
+    degenerate (e.g. a single sweep or the same scan speed in every
+    sweep), the last sweep's angular span over its scan speed is used.
+    """
+    stamps = np.array(
+        [str(_attr(r[slab]['how'], 'timestamp')).rstrip('Z')
+         for slab in slabs], dtype='datetime64[ms]')
+    speeds = np.array([_attr(r[slab]['how'], 'scan_speed')
+                       for slab in slabs], dtype='float64')
+    x = np.diff(stamps).astype('float64') / 1e3
+    y = speeds[:-1]
+    dsec = np.nan
+    if len(x) > 1 and np.ptp(x) > 0:
+        m, b = np.polyfit(x, y, 1)
+        if m != 0:
+            dsec = np.round((speeds[-1] - b) / m)
+    if not np.isfinite(dsec) or dsec <= 0 or \
+            (len(x) > 0 and dsec > 2 * np.max(x)):
+        how = r[slabs[-1]]['how']
+        nrays = r[slabs[-1]]['ray_header'].shape[0]
+        sweep_span = nrays * _attr(how, 'angle_step')
+        dsec = np.round(sweep_span / speeds[-1])
+    totsec = np.sum(x) + dsec
+    dstart = stamps[0].astype(dt.datetime)
+    return dstart, totsec
+
+
+def _ray_times(rays, total_rays, totsec):
+    """
+    Returns the time of each ray in seconds since the volume start, with
+    the volume duration spread evenly over all rays (truncated to whole
+    microseconds).
+    """
+    return np.floor(np.asarray(rays) * 1e6 * totsec / total_rays) / 1e6
+
+
+def _read_moment(r, mom, slabs, ray_start, total_rays, ngates, bad=-32768):
+    """
+    Reads and decodes one moment of every sweep into a single masked
+    array of shape (total_rays, ngates).
+
+    Parameters
+    ----------
+    r : h5py.File
+        Open h5py.File object from which to ingest data
+    mom : str
+        Moment dataset name (e.g. 'moment_0').
+    slabs : list of str
+        Scan group names, in sweep order.
+    ray_start : array of int
+        Index of the first ray of each sweep.
+    total_rays, ngates : int
+        Shape of the output array.
+    bad : float, optional
+        Value used for missing data.
+
+    Returns
+    -------
+    data : numpy.ma.MaskedArray
+        Decoded moment, masked where data is missing.
+    """
+    with span('field', moment=mom) as s:
+        data = np.full((total_rays, ngates), bad, dtype='float64')
+        s.alloc(data)
+        for i, slab in enumerate(slabs):
+            dset = r[slab][mom]
+            sweep = slice(ray_start[i], ray_start[i] + dset.shape[0])
+            _decode_moment(dset, data[sweep], bad)
+        with span('mask', moment=mom) as m:
+            data = np.ma.masked_where(data == bad, data, copy=False)
+            m.alloc(data.mask)
+    return data
+
+
+class _MomentExtractor(object):
+    """
+    Callable that reads one moment from a Rainbow HDF5 file on demand,
+    for use with a LazyLoadDict. The file is opened only during the read,
+    so no handle is kept open while the field is not accessed.
+    """
+
+    def __init__(self, fname, mom, slabs, ray_start, total_rays, ngates):
+        self.fname = fname
+        self.mom = mom
+        self.slabs = slabs
+        self.ray_start = ray_start
+        self.total_rays = total_rays
+        self.ngates = ngates
+
+    def __call__(self):
+        with span('read_rainbow_hdf5', file=self.fname, lazy=True):
+            with h5py.File(self.fname, 'r') as r:
+                return _read_moment(r, self.mom, self.slabs, self.ray_start,
+                                    self.total_rays, self.ngates)
+
+
+def _read_moment_codes(r, mom, slabs, ray_start, total_rays, ngates):
+    """
+    Reads the raw UV8/UV16 codes of one moment of every sweep, without
+    scaling, into a QuantizedMoment.
+
+    Parameters
+    ----------
+    r : h5py.File
+        Open h5py.File object from which to ingest data
+    mom : str
+        Moment dataset name (e.g. 'moment_0').
+    slabs : list of str
+        Scan group names, in sweep order.
+    ray_start : array of int
+        Index of the first ray of each sweep.
+    total_rays, ngates : int
+        Shape of the code array.
+
+    Returns
+    -------
+    moment : QuantizedMoment
+        Raw codes with the scale and offset of each sweep.
+    """
+    formats = [str(_attr(r[slab][mom], 'format')) for slab in slabs]
+    with span('field', moment=mom, quantized=True) as s:
+        if all([fmt == 'UV8' for fmt in formats]):
+            codes = np.zeros((total_rays, ngates), dtype='uint8')
+        else:
+            codes = np.zeros((total_rays, ngates), dtype='uint16')
+        s.alloc(codes)
+        nrays = np.zeros(len(slabs), dtype='int')
+        scale = np.zeros(len(slabs))
+        offset = np.zeros(len(slabs))
+        for i, slab in enumerate(slabs):
+            dset = r[slab][mom]
+            if formats[i] == 'UV8':
+                div = 254.0
+            else:
+                div = 65534.0
+            nrays[i] = dset.shape[0]
+            vmin = _attr(dset, 'dyn_range_min')
+            vmax = _attr(dset, 'dyn_range_max')
+            scale[i] = (vmax - vmin) / div
+            offset[i] = vmin
+            # Padding gates stay zero, i.e. missing
+            with span('read', dataset=dset.name):
+                dset.read_direct(codes, dest_sel=np.s_[
+                    ray_start[i]:ray_start[i] + nrays[i], :dset.shape[1]])
+    return QuantizedMoment(codes, scale, offset, ray_start, nrays)
+
+
+class QuantizedMoment(object):
+    """
+    Raw integer codes of one moment of a Rainbow HDF5 volume, with the
+    scale and offset of each sweep. A code of zero means missing data,
+    any other code decodes to offset + code * scale.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        uint8 or uint16 codes, shape (total_rays, ngates).
+    scale, offset : array of float
+        Scale and offset of each sweep.
+    ray_start, nrays : array of int
+        Index of the first ray and number of rays of each sweep.
+    """
+
+    def __init__(self, codes, scale, offset, ray_start, nrays):
+        self.codes = codes
+        self.scale = np.asarray(scale)
+        self.offset = np.asarray(offset)
+        self.ray_start = np.asarray(ray_start)
+        self.nrays = np.asarray(nrays)
+
+    @property
+    def nbytes(self):
+        """Memory used by the codes, in bytes."""
+        return self.codes.nbytes
+
+    def decode(self, sweep=None, dtype='float32'):
+        """
+        Decode the codes of the whole volume, or of a single sweep.
+
+        Parameters
+        ----------
+        sweep : int, optional
+            Sweep number to decode. None decodes all sweeps.
+        dtype : str, optional
+            Floating point type of the output.
+
+        Returns
+        -------
+        data : numpy.ma.MaskedArray
+            Decoded moment, masked where the code is zero.
+        """
+        if sweep is None:
+            codes = self.codes
+            scale = np.repeat(self.scale, self.nrays)[:, np.newaxis]
+            offset = np.repeat(self.offset, self.nrays)[:, np.newaxis]
+        else:
+            start = self.ray_start[sweep]
+            codes = self.codes[start:start + self.nrays[sweep]]
+            scale = self.scale[sweep]
+            offset = self.offset[sweep]
+        with span('decode', sweep=sweep) as s:
+            data = codes.astype(dtype)
+            data *= np.asarray(scale, dtype=dtype)
+            data += np.asarray(offset, dtype=dtype)
+            data = np.ma.masked_where(codes == 0, data, copy=False)
+            s.alloc(data.data, data.mask)
+        return data
+
+    def __call__(self):
+        return self.decode()
+
+
+class QuantizedField(MutableMapping):
+    """
+    Field dictionary backed by a QuantizedMoment. The 'data' key is
+    decoded to float32 when first accessed, and can be dropped again with
+    `release`. Single sweeps can be decoded with `get_sweep` without
+    decoding the whole volume.
+
+    It behaves as Py-ART's LazyLoadDict (set_lazy, copy, ...), without
+    importing Py-ART. Setting 'data' to a new array, as done by
+    Radar.extract_sweeps on a copy, detaches the field from its codes.
+
+    Parameters
+    ----------
+    dic : dict
+        Field metadata (long_name, units, ...).
+    moment : QuantizedMoment, optional
+        Raw codes of the field. None for a plain lazy field dictionary.
+    """
+
+    def __init__(self, dic, moment=None):
+        self._dic = dic
+        self._lazyload = {}
+        self.moment = moment
+        if moment is not None:
+            self.set_lazy('data', moment)
+
+    def __setitem__(self, key, value):
+        self._dic[key] = value
+        self._lazyload.pop(key, None)
+        if key == 'data':
+            self.moment = None
+
+    def __getitem__(self, key):
+        if key in self._lazyload:
+            self._dic[key] = self._lazyload.pop(key)()
+        return self._dic[key]
+
+    def __delitem__(self, key):
+        if key in self._lazyload:
+            del self._lazyload[key]
+        else:
+            del self._dic[key]
+        if key == 'data':
+            self.moment = None
+
+    def __iter__(self):
+        return itertools.chain(self._dic.copy(), self._lazyload.copy())
+
+    def __len__(self):
+        return len(self._dic) + len(self._lazyload)
+
+    def set_lazy(self, key, value_callable):
+        """Set a key to load from a callable object when first accessed."""
+        self._dic.pop(key, None)
+        self._lazyload[key] = value_callable
+
+    def copy(self):
+        """
+        Return a copy of the dictionary sharing the codes, without
+        decoding lazy keys.
+        """
+        dic = self.__class__(self._dic.copy())
+        dic.moment = self.moment
+        for key, value_callable in self._lazyload.items():
+            dic.set_lazy(key, value_callable)
+        return dic
+
+    def get_sweep(self, sweep, dtype='float32'):
+        """Return the decoded data of a single sweep."""
+        if self.moment is None:
+            raise ValueError('Field is not backed by a QuantizedMoment')
+        return self.moment.decode(sweep, dtype)
+
+    def release(self):
+        """Drop the decoded data, keeping only the codes in memory."""
+        if self.moment is not None:
+            self.set_lazy('data', self.moment)
+
+
+def _initial_process(r, moments=None, quantized=False):
     """
     Performs initial processing of radar data from h5py.File object.
     Gathers all necessary fields and metadata and condenses them to
@@ -21,6 +429,12 @@ def _initial_process(r):
     ----------
     r : h5py.File
         Open h5py.File object from which to ingest data
+    moments : list of str, optional
+        Moment datasets to decode (e.g. ['moment_1', 'moment_2']). None
+        decodes all moments in the file.
+    quantized : bool, optional
+        True to keep the raw codes of each moment as a QuantizedMoment
+        instead of decoding them to a masked float64 array.
 
     Returns
     -------
@@ -29,110 +443,71 @@ def _initial_process(r):
     """
     # Initialize key variables
     bad = -32768
-    elcnt = 0
-    azimuths = []
-    elevations = []
-    urg = []
-    nyq = []
-    momlab = []
+    slabs = _scan_labels(r)
+    momlab = [key for key in r['scan0'].keys() if key[:6] == 'moment']
+    if moments is None:
+        moments = momlab
+
+    # Read the shape of every sweep up front, so each moment is allocated
+    # once with the total number of rays and the longest range
+    with span('metadata', sweeps=len(slabs)):
+        nrays = np.array([r[slab]['moment_0'].shape[0] for slab in slabs])
+        ngates = max([r[slab]['moment_0'].shape[1] for slab in slabs])
+        ray_start = np.concatenate([[0], np.cumsum(nrays)[:-1]])
+        total_rays = int(np.sum(nrays))
+
+        azimuths = np.empty(total_rays)
+        elevations = np.empty(total_rays)
+        urg = np.empty(total_rays)
+        nyq = np.empty(total_rays)
+        fixed = np.empty(len(slabs))
+
+        for i, slab in enumerate(slabs):
+            # Process each scan, gather and keep track of relevant metadata
+            sweep = slice(ray_start[i], ray_start[i] + nrays[i])
+            info = _sweep_info(r[slab])
+            azimuths[sweep] = info['azimuths']
+            elevations[sweep] = info['elevations']
+            urg[sweep] = info['unambiguous_range']
+            nyq[sweep] = info['nyquist_velocity']
+            fixed[i] = info['fixed_angle']
+        dstart, totsec = _volume_duration(r, slabs)
+
+    # Process each moment separately, filling each sweep's rows of a
+    # preallocated volume
     data = {}
-    for key in r.keys():
-        if key[:4] == 'scan':
-            elcnt += 1
-    for key in r['scan0'].keys():
-        if key[:6] == 'moment':
-            momlab.append(key)
-            data[key] = []
-    shp = np.shape(r['scan0']['moment_0'])
-    x = []
-    y = []
-
-    for i in range(elcnt):
-        # Process each scan, gather and keep track of relevant metadata
-        si = str(i)
-        slab = 'scan' + si
-        rayhead = np.array(r[slab]['ray_header'])
-        az = np.array([rayhead[j][0] for j in range(len(rayhead))])
-        azimuths.append(az)
-        el = np.array([rayhead[j][2] for j in range(len(rayhead))])
-        elevations.append(el)
-        prf = r[slab]['how'].attrs['PRF'][0]
-        wl = r[slab]['how'].attrs['radar_wave_length'][0]
-        ur = el * 0 + 3e8 / (2 * prf)
-        urg.append(ur)
-        ny = el * 0 + prf * wl / 4.0
-        nyq.append(ny)
-
-        # Process each moment separately for each scan
-        for mom in momlab:
-            if str(r[slab][mom].attrs['format'][0]) == 'UV8':
-                div = 254.0
-            else:
-                div = 65534.0
-            if np.size(data[mom]) > 0:
-                # After first sweep, fill in data out to all available ranges
-                tmp = np.zeros(shp)
-                shp_new = np.shape(r[slab][mom])
-                tmp[:, :shp_new[1]] = np.array(r[slab][mom])[:, :]
-                invalid = tmp
-                tmp = r[slab][mom].attrs['dyn_range_min'][0] + \
-                    tmp * (r[slab][mom].attrs['dyn_range_max'][0] -
-                           r[slab][mom].attrs['dyn_range_min'][0]) / div
-                tmp[np.where(invalid == 0)] = bad
-                data[mom] = np.append(data[mom], tmp, axis=0)
-            else:
-                # First sweep - assumed to be longest possible range
-                data[mom] = np.array(r[slab][mom])
-                invalid = data[mom]
-                data[mom] = r[slab][mom].attrs['dyn_range_min'][0] + \
-                    data[mom] * (r[slab][mom].attrs['dyn_range_max'][0] -
-                                 r[slab][mom].attrs['dyn_range_min'][0]) / div
-                data[mom][np.where(invalid == 0)] = bad
-            data[mom] = np.ma.masked_where(data[mom] == bad, data[mom])
-
-        # Last sweep lacks completion time, need to infer from linear fit
-        # to scan speed and time for each sweep.
-        if i < elcnt - 1:
-            dt1 = dt.datetime.strptime(
-                str(r['scan' + str(i)]['how'].attrs['timestamp'][0]),
-                '%Y-%m-%dT%H:%M:%S.000Z')
-            dt2 = dt.datetime.strptime(
-                str(r['scan' + str(i+1)]['how'].attrs['timestamp'][0]),
-                '%Y-%m-%dT%H:%M:%S.000Z')
-            x.append((dt2-dt1).total_seconds())
-            y.append(r['scan' + str(i)]['how'].attrs['scan_speed'][0])
-        if i == elcnt - 1:
-            m, b = np.polyfit(x, y, 1)
-            dsec = np.round(
-                (r['scan' + str(i)]['how'].attrs['scan_speed'][0] - b) / m)
-            totsec = np.sum(x) + dsec
+    for mom in moments:
+        if quantized:
+            data[mom] = _read_moment_codes(r, mom, slabs, ray_start,
+                                           total_rays, ngates)
+        else:
+            data[mom] = _read_moment(r, mom, slabs, ray_start, total_rays,
+                                     ngates, bad)
 
     # Finalize all arrays, add to protoradar dictionary
-    azimuths = np.concatenate(azimuths)
-    elevations = np.concatenate(elevations)
-    nyq = np.concatenate(nyq)
-    urg = np.concatenate(urg)
-    dstart = dt.datetime.strptime(
-            str(r['scan0']['how'].attrs['timestamp'][0]),
-            '%Y-%m-%dT%H:%M:%S.000Z')
-    dtime = np.array(
-        [dstart + dt.timedelta(microseconds=int(j*1e6*totsec/len(azimuths)))
-         for j in np.arange(len(azimuths))])
-    rng = r['scan0']['how'].attrs['range_step'][0] + \
-        r['scan0']['how'].attrs['range_step'][0] * \
-        np.arange(np.shape(data['moment_0'])[1])
+    range_step = _attr(r['scan0']['how'], 'range_step')
+    rng = range_step + range_step * np.arange(ngates)
     protoradar = {}
     protoradar['azimuths'] = azimuths
     protoradar['elevations'] = elevations
     protoradar['fields'] = data
-    protoradar['datetime'] = dtime
+    protoradar['start_time'] = dstart
+    protoradar['time'] = _ray_times(np.arange(total_rays), total_rays, totsec)
+    protoradar['fixed_angle'] = fixed
     protoradar['range'] = np.array(rng, dtype='f4')
     protoradar['unambiguous_range'] = urg
     protoradar['nyquist_velocity'] = nyq
+    protoradar['moments'] = momlab
+    protoradar['scans'] = slabs
+    protoradar['ray_start'] = ray_start
+    protoradar['nrays'] = nrays
+    protoradar['ngates'] = ngates
     return protoradar
 
 
-def read_rainbow_hdf5(fname):
+@traced
+def read_rainbow_hdf5(fname, exclude_fields=None, include_fields=None,
+                      delay_field_loading=False, quantized=False, cache=None):
     """
     Ingest a Brazilian radar HDF5 file into Py-ART. Requires h5py.
 
@@ -140,6 +515,33 @@ def read_rainbow_hdf5(fname):
     ----------
     fname : str
         Name of Brazilian HDF5 radar file
+    exclude_fields : list or None, optional
+        List of fields to exclude from the radar object (e.g.
+        ['spectrum_width']). Excluded moments are not read from the file.
+        Set to None to include all fields specified by include_fields.
+    include_fields : list or None, optional
+        List of fields to include from the radar object (e.g.
+        ['reflectivity', 'velocity']). Set to None to include all fields
+        not specified by exclude_fields.
+    delay_field_loading : bool, optional
+        True to delay loading of field data until it is first accessed.
+        Each field dictionary is then a LazyLoadDict whose 'data' key
+        reads and scales that moment from the file when requested. The
+        file is reopened for each lazy read, so it must not be moved or
+        removed while the Radar object is in use.
+    quantized : bool, optional
+        True to keep each moment in memory as its raw uint8/uint16 codes
+        with the scale and offset of each sweep. Each field is then a
+        QuantizedField, whose 'data' is decoded to float32 only when first
+        accessed (see QuantizedField.get_sweep and QuantizedField.release).
+        This takes precedence over delay_field_loading.
+    cache : DecodeCache or None, optional
+        Cache of decoded files (see decode_cache.DecodeCache). If given,
+        the Radar object is read from the cache when this file was
+        already read with the same options, with the field data
+        memory-mapped from disk, and stored in it otherwise. Field data
+        is then never delayed, as the cached arrays are already loaded
+        on demand.
 
     Returns
     -------
@@ -147,26 +549,42 @@ def read_rainbow_hdf5(fname):
         Py-ART Radar object, ready for processing, diplay, gridding,
         and writing to file
     """
-    # Field names
-    field_names = {
-        'moment_0': 'corrected_reflectivity',
-        'moment_1': 'reflectivity',
-        'moment_2': 'velocity',
-        'moment_3': 'spectrum_width',
-        'moment_4': 'differential_reflectivity',
-        'moment_5': 'filtered_differential_phase',
-        'moment_6': 'differential_phase',
-        'moment_7': 'specific_differential_phase',
-        'moment_8': 'cross_correlation_ratio'}
+    if cache is not None:
+        with span('cache'):
+            return cache.fetch(fname, read_rainbow_hdf5,
+                               exclude_fields=exclude_fields,
+                               include_fields=include_fields,
+                               quantized=quantized)
+
+    from pyart.config import FileMetadata
+    from pyart.core import Radar
+    from pyart.lazydict import LazyLoadDict
+
+    field_names = FIELD_NAMES
     filemetadata = FileMetadata('cfradial', field_names, None,
-                                False, None)
+                                False, exclude_fields, include_fields)
+    moments = [key for key in field_names.keys()
+               if filemetadata.get_field_name(key) is not None]
 
-    r = h5py.File(fname)
-    pr = _initial_process(r)
+    # Read all metadata (and the field data, if not delayed) while the
+    # file is open, it is closed before building the Radar object
+    with span('open'):
+        r = h5py.File(fname, 'r')
+    with r:
+        moments = [key for key in moments if key in r['scan0']]
+        if delay_field_loading and not quantized:
+            pr = _initial_process(r, moments=[])
+        else:
+            pr = _initial_process(r, moments=moments, quantized=quantized)
+        scan_type = str(_attr(r['scan0']['what'], 'scan_type')).lower()
+        location = dict([(lab, np.atleast_1d(r['where'].attrs[lab]))
+                         for lab in ['lat', 'lon', 'height']])
+        units = dict([(key, str(_attr(r['scan0'][key], 'unit')))
+                      for key in moments])
 
     # fixed_angle
     fixed_angle = filemetadata('fixed_angle')
-    fixed_angle['data'] = np.unique(pr['elevations'])
+    fixed_angle['data'] = pr['fixed_angle']
 
     # elevation
     elevation = filemetadata('elevation')
@@ -183,7 +601,6 @@ def read_rainbow_hdf5(fname):
 
     # sweep_mode
     sweep_mode = filemetadata('sweep_mode')
-    scan_type = str(r['scan0']['what'].attrs['scan_type'][0]).lower()
     if scan_type in ['ppi', 'rhi']:
         sweep_mode['data'] = np.array(nsweeps * ['manual_' + scan_type])
     else:  # Guessing that if not RHI or PPI, then a pointing scan
@@ -192,29 +609,22 @@ def read_rainbow_hdf5(fname):
     # sweep_start_ray_index, sweep_end_ray_index
     sweep_start_ray_index = filemetadata('sweep_start_ray_index')
     sweep_end_ray_index = filemetadata('sweep_end_ray_index')
-    ssri = []
-    ssre = []
-    for ang in fixed_angle['data']:
-        index = np.where(pr['elevations'] == ang)[0]
-        ssri.append(np.min(index))
-        ssre.append(np.max(index))
-    sweep_start_ray_index['data'] = np.array(ssri, dtype='int')
-    sweep_end_ray_index['data'] = np.array(ssre, dtype='int')
+    sweep_start_ray_index['data'] = np.array(pr['ray_start'], dtype='int')
+    sweep_end_ray_index['data'] = np.array(
+        pr['ray_start'] + pr['nrays'] - 1, dtype='int')
 
     # radar location
     latitude = filemetadata('latitude')
     longitude = filemetadata('longitude')
     altitude = filemetadata('altitude')
-    latitude['data'] = np.array(r['where'].attrs['lat'])
-    longitude['data'] = np.array(r['where'].attrs['lon'])
-    altitude['data'] = np.array(r['where'].attrs['height'])
+    latitude['data'] = location['lat']
+    longitude['data'] = location['lon']
+    altitude['data'] = location['height']
 
     # time
     _time = filemetadata('time')
-    start_time = pr['datetime'][0]
-    _time['units'] = make_time_unit_str(start_time)
-    _time['data'] = np.array(
-        [(dti-start_time).total_seconds() for dti in pr['datetime']])
+    _time['units'] = _time_unit_str(pr['start_time'])
+    _time['data'] = pr['time']
 
     # range
     _range = filemetadata('range')
@@ -231,16 +641,23 @@ def read_rainbow_hdf5(fname):
         tmpdic['data'] = pr[lab]
 
     # fields
-    keys = [k for k in field_names.keys()]
     fields = {}
-    for key in keys:
+    for key in moments:
         field_name = filemetadata.get_field_name(key)
-        fields[field_name] = {}
-        fields[field_name]['data'] = pr['fields'][key]
+        if quantized:
+            fields[field_name] = QuantizedField(
+                {}, pr['fields'][key])
+        elif delay_field_loading:
+            fields[field_name] = LazyLoadDict({})
+            fields[field_name].set_lazy('data', _MomentExtractor(
+                fname, key, pr['scans'], pr['ray_start'],
+                len(pr['azimuths']), pr['ngates']))
+        else:
+            fields[field_name] = {}
+            fields[field_name]['data'] = pr['fields'][key]
         fields[field_name]['long_name'] = field_name
         fields[field_name]['standard_name'] = field_name.replace('_', ' ')
-        fields[field_name]['units'] = str(
-            r['scan0'][key].attrs['unit'][0])
+        fields[field_name]['units'] = units[key]
         fields[field_name]['coordinates'] = 'elevation azimuth range'
 
     # metadata
@@ -248,10 +665,91 @@ def read_rainbow_hdf5(fname):
     metadata['source'] = 'Brazil Radar'
     metadata['original_container'] = fname
 
-    return Radar(
-        _time, _range, fields, metadata, scan_type,
-        latitude, longitude, altitude,
-        sweep_number, sweep_mode, fixed_angle, sweep_start_ray_index,
-        sweep_end_ray_index,
-        azimuth, elevation,
-        instrument_parameters=instrument_parameters)
\ No newline at end of file
+    with span('construct'):
+        radar = Radar(
+            _time, _range, fields, metadata, scan_type,
+            latitude, longitude, altitude,
+            sweep_number, sweep_mode, fixed_angle, sweep_start_ray_index,
+            sweep_end_ray_index,
+            azimuth, elevation,
+            instrument_parameters=instrument_parameters)
+    return radar
+
+
+def iter_rainbow_sweeps(fname, fields=None):
+    """
+    Iterate over the sweeps of a Brazilian radar HDF5 file, decoding one
+    sweep at a time. Only one sweep is held in memory, so processing can
+    start before the rest of the volume is read.
+
+    Parameters
+    ----------
+    fname : str
+        Name of Brazilian HDF5 radar file
+    fields : list or None, optional
+        Field names to decode (e.g. ['reflectivity', 'velocity']). None
+        decodes all fields in the file.
+
+    Yields
+    ------
+    sweep : dict
+        Dictionary with the sweep number and fixed angle, the azimuth,
+        elevation and time (seconds since 'time_units') of each ray, the
+        range of each gate, the Nyquist velocity and unambiguous range of
+        each ray, and the decoded fields, as masked arrays of shape
+        (rays, gates).
+    """
+    bad = -32768
+    with h5py.File(fname, 'r') as r:
+        with span('iter_rainbow_sweeps', file=fname):
+            with span('metadata'):
+                slabs = _scan_labels(r)
+                moments = [key for key in FIELD_NAMES.keys()
+                           if key in r['scan0'] and
+                           (fields is None or FIELD_NAMES[key] in fields)]
+                nrays = np.array([r[slab]['moment_0'].shape[0]
+                                  for slab in slabs])
+                ray_start = np.concatenate([[0], np.cumsum(nrays)[:-1]])
+                total_rays = int(np.sum(nrays))
+                dstart, totsec = _volume_duration(r, slabs)
+
+        for i, slab in enumerate(slabs):
+            # The span covers the sweep but not the consumer of the yield
+            with span('iter_rainbow_sweeps', file=fname, sweep=i):
+                sweep = _iter_sweep(r, slab, i, moments, bad)
+                sweep['time'] = _ray_times(
+                    np.arange(ray_start[i], ray_start[i] + nrays[i]),
+                    total_rays, totsec)
+                sweep['time_units'] = _time_unit_str(dstart)
+            yield sweep
+
+
+def _iter_sweep(r, slab, i, moments, bad=-32768):
+    """
+    Reads and decodes one sweep for iter_rainbow_sweeps, without the ray
+    times.
+    """
+    info = _sweep_info(r[slab])
+    shape = r[slab]['moment_0'].shape
+    nrays = shape[0]
+    range_step = _attr(r[slab]['how'], 'range_step')
+    sweep = {}
+    sweep['sweep_number'] = i
+    sweep['fixed_angle'] = info['fixed_angle']
+    sweep['azimuth'] = info['azimuths']
+    sweep['elevation'] = info['elevations']
+    sweep['range'] = np.array(
+        range_step + range_step * np.arange(shape[1]), dtype='f4')
+    sweep['nyquist_velocity'] = np.full(nrays, info['nyquist_velocity'])
+    sweep['unambiguous_range'] = np.full(nrays, info['unambiguous_range'])
+    sweep['fields'] = {}
+    for mom in moments:
+        with span('field', moment=mom) as s:
+            data = np.empty(shape, dtype='float64')
+            s.alloc(data)
+            _decode_moment(r[slab][mom], data, bad)
+            with span('mask', moment=mom) as m:
+                data = np.ma.masked_where(data == bad, data, copy=False)
+                m.alloc(data.mask)
+        sweep['fields'][FIELD_NAMES[mom]] = data
+    return sweep
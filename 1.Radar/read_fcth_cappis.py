@@ -0,0 +1,259 @@
+"""
+Reading FCTH CAPPI (level 2) binary files.
+
+Data source: http://ftp.cptec.inpe.br/chuva/glm_vale_paraiba/experimental/level_2/eq_radar/esp_banda_s/st_cth/
+
+The files are raw little-endian float32 grids of nz x 500 x 500 points
+(z, y and x axes), with 1 x 1 km horizontal resolution centered on the
+radar, written with the y axis inverted. Full volumes (RADL*.dat) have 15
+levels every 1 km from 2 km of height; single CAPPIs
+(cappi_<field>_<height>_<YYYYMMDD>_<hhmm>.dat.gz) have one level, at the
+height in meters given in the file name. Values of 100 or more and -99
+are missing data.
+
+"""
+
+import datetime
+import glob
+import gzip
+import os
+import re
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from reader_trace import traced
+
+# FCTH radar (Ponte Nova, Salesopolis - SP) location
+FCTH_LATITUDE = -23.600795
+FCTH_LONGITUDE = -45.972790
+FCTH_ALTITUDE = 928.0
+
+# Grid layout
+NY, NX = 500, 500
+DX = DY = 1000.0
+VOLUME_HEIGHTS = 2000.0 + 1000.0 * np.arange(15)
+
+# Field names of the file name codes
+FIELD_NAMES = {
+    "CZ": "corrected_reflectivity",
+    "Z": "reflectivity",
+}
+
+_CAPPI_NAME = re.compile(r"cappi_([A-Za-z]+)_(\d+)_(\d{8})_(\d{4})\.dat")
+_RADL_NAME = re.compile(r"RADL\d{6}(\d{14})\.dat")
+
+# Decompression chunk of .dat.gz files, in bytes
+_CHUNK = 2**20
+
+
+def _parse_name(filename):
+    """
+    Field code, height in meters (None for volumes) and time of a CAPPI
+    file, from its name.
+    """
+    name = os.path.basename(filename)
+    match = _CAPPI_NAME.match(name)
+    if match is not None:
+        code, height, day, hour = match.groups()
+        time = datetime.datetime.strptime(day + hour, "%Y%m%d%H%M")
+        return code, float(height), time
+    match = _RADL_NAME.match(name)
+    if match is not None:
+        time = datetime.datetime.strptime(match.group(1), "%Y%m%d%H%M%S")
+        return "Z", None, time
+    raise ValueError("Unknown FCTH CAPPI file name: " + filename)
+
+
+def _file_levels(filename):
+    """
+    Number of levels of a CAPPI file, from its (uncompressed) size.
+    """
+    if filename.endswith(".gz"):
+        # the last 4 bytes of a gzip file are the uncompressed size
+        with open(filename, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            size = struct.unpack("<I", f.read(4))[0]
+    else:
+        size = os.path.getsize(filename)
+    level = NY * NX * 4
+    if size == 0 or size % level:
+        raise ValueError(
+            "%s has %d bytes, not a multiple of a %d x %d level"
+            % (filename, size, NY, NX)
+        )
+    return size // level
+
+
+def _level_index(heights, z_levels):
+    """
+    Index of the levels nearest to the requested heights.
+    """
+    if z_levels is None:
+        return np.arange(len(heights))
+    z_levels = np.atleast_1d(z_levels)
+    return np.abs(heights[np.newaxis, :] - z_levels[:, np.newaxis]).argmin(axis=1)
+
+
+def _read_gzip_levels(filename, zindex):
+    """
+    Decompress the levels zindex of a .dat.gz file, in chunks, straight
+    into a preallocated array. Levels are read in file order, skipped
+    levels are decompressed into a scratch buffer.
+    """
+    data = np.empty((len(zindex), NY, NX), dtype="<f4")
+    scratch = np.empty((NY, NX), dtype="<f4")
+    wanted = dict((k, i) for i, k in enumerate(zindex))
+    with gzip.open(filename, "rb") as f:
+        for k in range(max(zindex) + 1):
+            if k in wanted:
+                buf = memoryview(data[wanted[k]]).cast("B")
+            else:
+                buf = memoryview(scratch).cast("B")
+            for start in range(0, len(buf), _CHUNK):
+                chunk = buf[start : start + _CHUNK]
+                while len(chunk):
+                    nread = f.readinto(chunk)
+                    if not nread:
+                        raise ValueError("%s is truncated" % filename)
+                    chunk = chunk[nread:]
+    # repeated levels are read once
+    for i, k in enumerate(zindex):
+        if wanted[k] != i:
+            data[i] = data[wanted[k]]
+    return data
+
+
+@traced
+def read_fcth_cappi(filename, z_levels=None, field=None, heights=None):
+    """
+    Read an FCTH CAPPI binary file (.dat or .dat.gz) into a Grid.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .dat or .dat.gz file.
+    z_levels : list or None, optional
+        Heights in meters of the levels to read, each matched to the
+        nearest level of the grid. None reads all levels.
+    field : str or None, optional
+        Name of the field in the Grid. None names it from the field code
+        in the file name (reflectivity for volumes).
+    heights : array or None, optional
+        Heights in meters of all levels of the file. None uses 2 to 16 km
+        for 15-level volumes and the height in the file name for single
+        CAPPIs.
+
+    Returns
+    -------
+    grid : Grid
+        Grid object, with the y axis from south to north. Plain .dat files
+        are memory-mapped and only the selected levels are read.
+
+    """
+    # Py-ART is imported on first use, importing this module needs only numpy
+    from pyart.config import get_metadata
+    from pyart.core.grid import Grid
+
+    code, name_height, time = _parse_name(filename)
+    nz = _file_levels(filename)
+    if heights is None:
+        if nz == len(VOLUME_HEIGHTS):
+            heights = VOLUME_HEIGHTS
+        elif nz == 1 and name_height is not None:
+            heights = np.array([name_height])
+        else:
+            raise ValueError(
+                "Heights of the %d levels of %s are unknown" % (nz, filename)
+            )
+    heights = np.asarray(heights, dtype="float64")
+    if len(heights) != nz:
+        raise ValueError("%s has %d levels, not %d" % (filename, nz, len(heights)))
+    zindex = _level_index(heights, z_levels)
+
+    if filename.endswith(".gz"):
+        data = _read_gzip_levels(filename, zindex)
+    else:
+        cube = np.memmap(filename, dtype="<f4", mode="r", shape=(nz, NY, NX))
+        data = cube[zindex]
+    # the grid was written with the y axis inverted
+    data = np.flip(data, axis=1)
+    data = np.ma.masked_where((data >= 100) | (data == -99), data, copy=False)
+
+    if field is None:
+        field = FIELD_NAMES.get(code, code)
+    fields = {field: get_metadata(field)}
+    fields[field].pop("coordinates", None)
+    fields[field]["data"] = data
+
+    _time = get_metadata("grid_time")
+    _time["units"] = "seconds since " + time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    _time["data"] = np.array([0.0])
+
+    origin_latitude = get_metadata("origin_latitude")
+    origin_latitude["data"] = np.array([FCTH_LATITUDE])
+    origin_longitude = get_metadata("origin_longitude")
+    origin_longitude["data"] = np.array([FCTH_LONGITUDE])
+    origin_altitude = get_metadata("origin_altitude")
+    origin_altitude["data"] = np.array([FCTH_ALTITUDE])
+
+    x = get_metadata("x")
+    x["data"] = (np.arange(NX) - (NX - 1) / 2.0) * DX
+    y = get_metadata("y")
+    y["data"] = (np.arange(NY) - (NY - 1) / 2.0) * DY
+    z = get_metadata("z")
+    z["data"] = heights[zindex]
+
+    metadata = {
+        "source": "FCTH S-band radar CAPPI",
+        "original_container": os.path.basename(filename),
+    }
+
+    return Grid(
+        _time,
+        fields,
+        metadata,
+        origin_latitude,
+        origin_longitude,
+        origin_altitude,
+        x,
+        y,
+        z,
+    )
+
+
+@traced
+def read_fcth_cappis(
+    filenames, z_levels=None, field=None, heights=None, workers=None
+):
+    """
+    Read many FCTH CAPPI files, in parallel.
+
+    Parameters
+    ----------
+    filenames : list of str or str
+        Files to read, or a directory whose .dat and .dat.gz files are
+        read in name order.
+    z_levels, field, heights :
+        See read_fcth_cappi.
+    workers : int or None, optional
+        Number of processes reading files. None reads them in this process.
+
+    Returns
+    -------
+    grids : list of Grid
+        Grid objects, in the order of filenames.
+
+    """
+    if isinstance(filenames, str):
+        filenames = sorted(
+            glob.glob(os.path.join(filenames, "*.dat"))
+            + glob.glob(os.path.join(filenames, "*.dat.gz"))
+        )
+    reader = partial(read_fcth_cappi, z_levels=z_levels, field=field, heights=heights)
+    if workers is None:
+        return list(map(reader, filenames))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(reader, filenames))
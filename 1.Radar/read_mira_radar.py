@@ -2,16 +2,122 @@
 # http://arm-doe.github.io/pyart/_modules/pyart/aux_io/arm_vpt.html
 
 
+import calendar
+import datetime
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import netCDF4
 import numpy as np
-from skimage.measure import block_reduce
 
-from pyart.io import cfradial
-from pyart.config import FileMetadata
-from pyart.core.radar import Radar
-from pyart.util import join_radar
+from reader_trace import span, traced
+
+
+def _ncvar_slice_to_dict(ncvar, index):
+    """
+    Convert part of a NetCDF variable to a dictionary, reading only the
+    hyperslab given by `index`. Same as cfradial._ncvar_to_dict otherwise.
+    """
+    d = dict(
+        [
+            (k, getattr(ncvar, k))
+            for k in ncvar.ncattrs()
+            if k not in ["scale_factor", "add_offset"]
+        ]
+    )
+    d["data"] = np.atleast_1d(ncvar[index])
+    return d
+
+
+def _epoch_seconds(value):
+    """Seconds since 1970-01-01 of a datetime (UTC if naive) or a number."""
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return float(value)
+
+
+def _mira_slices(ncvars, time_range=None, range_limits=None):
+    """
+    Index slices of the time and range dimensions inside the requested
+    (start, end) time window and (min, max) range limits, found from the
+    coordinate variables only.
+    """
+    tslice = slice(None)
+    rslice = slice(None)
+    if time_range is not None:
+        times = ncvars["time"][:]
+        start, end = [_epoch_seconds(t) for t in time_range]
+        tslice = slice(
+            np.searchsorted(times, start, side="left"),
+            np.searchsorted(times, end, side="right"),
+        )
+    if range_limits is not None:
+        ranges = ncvars["range"][:]
+        rslice = slice(
+            np.searchsorted(ranges, range_limits[0], side="left"),
+            np.searchsorted(ranges, range_limits[1], side="right"),
+        )
+    return tslice, rslice
+
+
+def _block_mean(data, res):
+    """
+    Average blocks of `res` consecutive rays (first axis), ignoring masked
+    and NaN values, in float32. The last block averages the remaining
+    rays when the number of rays is not a multiple of `res`.
+
+    Parameters
+    ----------
+    data : array or masked array
+        Data to average, in linear units, with time as the first axis.
+    res : int
+        Number of rays in each block.
+
+    Returns
+    -------
+    mean : masked array
+        Block averages, masked where a block has no valid data.
+    """
+    values = np.ma.filled(np.ma.asarray(data).astype(np.float32), np.nan)
+    valid = ~np.isnan(values)
+    values[~valid] = 0
+
+    nrays = values.shape[0]
+    nfull = nrays // res
+    nblocks = -(-nrays // res)
+    shape = (nblocks,) + values.shape[1:]
+    sums = np.empty(shape, dtype=np.float32)
+    counts = np.empty(shape, dtype=np.int32)
+    block_shape = (nfull, res) + values.shape[1:]
+    sums[:nfull] = values[: nfull * res].reshape(block_shape).sum(axis=1)
+    counts[:nfull] = valid[: nfull * res].reshape(block_shape).sum(axis=1)
+    if nblocks > nfull:
+        # ragged tail block
+        sums[nfull] = values[nfull * res :].sum(axis=0)
+        counts[nfull] = valid[nfull * res :].sum(axis=0)
+
+    empty = counts == 0
+    counts[empty] = 1
+    sums /= counts
+    return np.ma.masked_array(sums, mask=empty)
+
+
+def _to_db(data):
+    """
+    Convert a masked array from linear units to dB (10*log10) in place,
+    masking non-positive values.
+    """
+    values = np.ma.getdata(data)
+    invalid = ~(values > 0)
+    values[invalid] = 1
+    np.log10(values, out=values)
+    values *= 10
+    if np.any(invalid):
+        data[invalid] = np.ma.masked
 
 
+@traced
 def read_mira(
     filename,
     for_quicklooks=False,
@@ -21,6 +127,9 @@ def read_mira(
     file_field_names=False,
     exclude_fields=None,
     include_fields=None,
+    time_range=None,
+    range_limits=None,
+    cache=None,
 ):
     """
     Read MIRA-35C NetCDF ingest data.
@@ -53,12 +162,43 @@ def read_mira(
         List of fields to include from the radar object. This is applied
         after the `file_field_names` and `field_names` parameters. Set
         to None to include all fields not specified by exclude_fields.
+    time_range : tuple or None, optional
+        (start, end) of the rays to read, inclusive, as datetime objects
+        (UTC if naive) or seconds since 1970-01-01. Only this window is
+        read from the file. None reads all rays.
+    range_limits : tuple or None, optional
+        (min, max) range of the gates to read, inclusive, in meters. Only
+        these gates are read from the file. None reads all gates.
+    cache : DecodeCache or None, optional
+        Cache of decoded files (see decode_cache.DecodeCache). If given,
+        the Radar object is read from the cache when this file was
+        already read with the same options, with the field data
+        memory-mapped from disk, and stored in it otherwise.
 
     Returns
     -------
     radar : Radar
         Radar object.
     """
+    if cache is not None:
+        with span("cache"):
+            return cache.fetch(
+                filename,
+                read_mira,
+                for_quicklooks=for_quicklooks,
+                ql_res=ql_res,
+                field_names=field_names,
+                additional_metadata=additional_metadata,
+                file_field_names=file_field_names,
+                exclude_fields=exclude_fields,
+                include_fields=include_fields,
+                time_range=time_range,
+                range_limits=range_limits,
+            )
+
+    # Py-ART is imported on first use, importing this module needs only netCDF4
+    from pyart.config import FileMetadata
+    from pyart.core.radar import Radar
 
     # create metadata retrieval object
     filemetadata = FileMetadata(
@@ -71,7 +211,8 @@ def read_mira(
     )
 
     # read the data
-    ncobj = netCDF4.Dataset(filename)
+    with span("open"):
+        ncobj = netCDF4.Dataset(filename)
     ncvars = ncobj.variables
 
     # 4.1 Global attribute -> move to metadata dictionary
@@ -79,12 +220,13 @@ def read_mira(
     metadata["n_gates_vary"] = "false"
 
     # 4.2 Dimensions
+    # Index slices of the requested time and range window, all time x range
+    # variables are read only within them
+    tslice, rslice = _mira_slices(ncvars, time_range, range_limits)
+
     # If averaging, increase temporal resolution with res
     if for_quicklooks:
-        orig_res = round(
-            float(ncobj.hrd[ncobj.hrd.find("AVE") + 4 : ncobj.hrd.find("\nC")])
-        )
-        res = round(ql_res * 60 / orig_res)
+        res = _quicklook_factor(ncobj, ql_res)
 
     # 4.3 Global variable -> move to metadata dictionary
     if "volume_number" in ncvars:
@@ -106,14 +248,15 @@ def read_mira(
             metadata[var] = default_value
 
     # 4.4 coordinate variables -> create attribute dictionaries
-    time = cfradial._ncvar_to_dict(ncvars["time"])
+    time = _ncvar_slice_to_dict(ncvars["time"], tslice)
     time["units"] = "seconds since 1970-01-01 00:00:00"
     time["data"] = np.array(
         np.ma.MaskedArray.tolist(time["data"]), dtype="int64"
     )
-    _range = cfradial._ncvar_to_dict(ncvars["range"])
+    _range = _ncvar_slice_to_dict(ncvars["range"], rslice)
     if for_quicklooks:
         time["data"] = time["data"][::res]
+    nrays = len(time["data"])
 
     # 4.5 Ray dimension variables
 
@@ -180,9 +323,7 @@ def read_mira(
     sweep_start_ray_index["data"] = np.array([0], dtype=np.int32)
 
     sweep_end_ray_index = filemetadata("sweep_end_ray_index")
-    sweep_end_ray_index["data"] = np.array(
-        [ncvars["time"].size - 1], dtype=np.int32
-    )
+    sweep_end_ray_index["data"] = np.array([nrays - 1], dtype=np.int32)
 
     # first sweep mode determines scan_type
     # this module is specific to vertically-pointing data
@@ -192,10 +333,10 @@ def read_mira(
     # this section also required some changes since the initial NetCDF did not
     # contain any sensor pointing variables
     azimuth = filemetadata("azimuth")
-    azimuth["data"] = 0.0 * np.ones(ncvars["time"].size, dtype=np.float32)
+    azimuth["data"] = 0.0 * np.ones(nrays, dtype=np.float32)
 
     elevation = filemetadata("elevation")
-    elevation["data"] = 90.0 * np.ones(ncvars["time"].size, dtype=np.float32)
+    elevation["data"] = 90.0 * np.ones(nrays, dtype=np.float32)
 
     # 4.9 Moving platform geo-reference variables
 
@@ -212,18 +353,18 @@ def read_mira(
             if include_fields is not None and not key in include_fields:
                 continue
             field_name = key
-        fields[field_name] = cfradial._ncvar_to_dict(ncvars[key])
+        with span("read", field=key) as sp:
+            fields[field_name] = _ncvar_slice_to_dict(ncvars[key], (tslice, rslice))
+            sp.alloc(fields[field_name]["data"])
         if for_quicklooks:
-            fields[field_name]["data"] = block_reduce(
-                fields[field_name]["data"],
-                block_size=(res, 1),
-                func=np.nanmean,
-                cval=1e20,
-            )
+            with span("average", field=key) as sp:
+                fields[field_name]["data"] = _block_mean(
+                    fields[field_name]["data"], res
+                )
+                sp.alloc(fields[field_name]["data"])
         if field_name in ("SNRg", "SNR", "Ze", "Zg", "Z", "LDRg", "LDR"):
-            fields[field_name]["data"] = 10 * np.log10(
-                fields[field_name]["data"]
-            )
+            with span("decode", field=key):
+                _to_db(fields[field_name]["data"])
             fields[field_name]["units"] = "dBZ"
 
     # 4.5 instrument_parameters sub-convention -> instrument_parameters dict
@@ -239,16 +380,14 @@ def read_mira(
 
     prf = float(ncvars["prf"][:])
     prt = filemetadata("prt")
-    prt["data"] = (1.0 / prf) * np.ones(ncvars["time"].size, dtype=np.float32)
+    prt["data"] = (1.0 / prf) * np.ones(nrays, dtype=np.float32)
 
     v_nq = float(ncvars["NyquistVelocity"][:])
     nyquist_velocity = filemetadata("nyquist_velocity")
-    nyquist_velocity["data"] = (
-        v_nq * np.ones(ncvars["time"].size, dtype=np.float32),
-    )
+    nyquist_velocity["data"] = v_nq * np.ones(nrays, dtype=np.float32)
     samples = int(ncvars["nave"][:])
     n_samples = filemetadata("n_samples")
-    n_samples["data"] = samples * np.ones(ncvars["time"].size, dtype=np.int32)
+    n_samples["data"] = samples * np.ones(nrays, dtype=np.int32)
 
     # 4.6 radar_parameters sub-convention -> instrument_parameters dict
     # this section needed multiple changes and/or additions since the
@@ -285,35 +424,21 @@ def read_mira(
         "units": ncvars["MeltHeiDB"].units,
         "yrange": ncvars["MeltHeiDB"].yrange,
     }
-    if for_quicklooks:
-        melthei["data"] = block_reduce(
-            ncvars["MeltHei"][:],
-            block_size=(res,),
-            func=np.nanmean,
-            cval=np.nanmean(ncvars["MeltHei"][:]),
-        )
-        melthei_det["data"] = block_reduce(
-            ncvars["MeltHeiDet"][:],
-            block_size=(res,),
-            func=np.nanmean,
-            cval=np.nanmean(ncvars["MeltHeiDet"][:]),
-        )
-        melthei_db["data"] = block_reduce(
-            ncvars["MeltHeiDB"][:],
-            block_size=(res,),
-            func=np.nanmean,
-            cval=np.nanmean(ncvars["MeltHeiDB"][:]),
-        )
-    else:
-        melthei["data"] = ncvars["MeltHei"][:]
-        melthei_det["data"] = ncvars["MeltHeiDet"][:]
-        melthei_db["data"] = ncvars["MeltHeiDB"][:]
+    with span("read", field="MeltHei"):
+        if for_quicklooks:
+            melthei["data"] = _block_mean(ncvars["MeltHei"][tslice], res)
+            melthei_det["data"] = _block_mean(ncvars["MeltHeiDet"][tslice], res)
+            melthei_db["data"] = _block_mean(ncvars["MeltHeiDB"][tslice], res)
+        else:
+            melthei["data"] = ncvars["MeltHei"][tslice]
+            melthei_det["data"] = ncvars["MeltHeiDet"][tslice]
+            melthei_db["data"] = ncvars["MeltHeiDB"][tslice]
 
     # close NetCDF object
     ncobj.close()
 
-    return (
-        Radar(
+    with span("construct"):
+        radar = Radar(
             time,
             _range,
             fields,
@@ -330,31 +455,213 @@ def read_mira(
             azimuth,
             elevation,
             instrument_parameters=instrument_parameters,
-        ),
-        (melthei, melthei_det, melthei_db),
+        )
+    return radar, (melthei, melthei_det, melthei_db)
+
+
+def _quicklook_factor(ncobj, ql_res):
+    """
+    Number of rays averaged together for quicklooks with a resolution of
+    ql_res minutes, from the averaging time in the file header.
+    """
+    orig_res = round(
+        float(ncobj.hrd[ncobj.hrd.find("AVE") + 4 : ncobj.hrd.find("\nC")])
     )
+    return round(ql_res * 60 / orig_res)
+
+
+def _mira_dims(
+    filename, for_quicklooks=False, ql_res=5, time_range=None, range_limits=None
+):
+    """
+    Number of rays and gates returned by read_mira for a file, read from
+    the file dimensions and coordinates only.
+    """
+    with netCDF4.Dataset(filename) as ncobj:
+        tslice, rslice = _mira_slices(ncobj.variables, time_range, range_limits)
+        nrays = len(range(len(ncobj.dimensions["time"]))[tslice])
+        ngates = len(range(len(ncobj.dimensions["range"]))[rslice])
+        if for_quicklooks:
+            nrays = len(range(0, nrays, _quicklook_factor(ncobj, ql_res)))
+    return nrays, ngates
+
+
+def _allocate_like(dic, shape, masked=None):
+    """
+    Copy of a variable dictionary with an empty data array of the given
+    shape. The new array is masked if `masked` is True, or if it is None
+    and the original array is masked.
+    """
+    from pyart.config import get_fillvalue
+
+    new_dic = dict([(k, v) for k, v in dic.items() if k != "data"])
+    data = np.asarray(dic["data"])
+    if masked is None:
+        masked = isinstance(dic["data"], np.ma.MaskedArray)
+    if masked:
+        new_dic["data"] = np.ma.masked_all(shape, dtype=data.dtype)
+        new_dic["data"].set_fill_value(get_fillvalue())
+    else:
+        new_dic["data"] = np.empty(shape, dtype=data.dtype)
+    return new_dic
 
 
-def read_multi_mira(filenames, for_quicklooks=False, ql_res=5):
+@traced
+def read_multi_mira(
+    filenames,
+    for_quicklooks=False,
+    ql_res=5,
+    workers=None,
+    time_range=None,
+    range_limits=None,
+):
     """
     Read and join multiple MIRA-35C radar files
 
+    The dimensions of all files are read first, so the time x range
+    arrays are allocated once and filled in file order. As in
+    pyart.util.join_radar, each file is kept as a sweep and only fields
+    present in all files are kept.
+
     Parameters
     ----------
     filenames : list of filenames
-
+    for_quicklooks : bool, optional
+        True if data is for quicklooks, averaging according to ql_res.
+    ql_res : int, optional
+        If for_quicklooks is true, data resolution in minutes.
+    workers : int or None, optional
+        Number of worker processes reading files in parallel. None reads
+        the files one by one in this process.
+    time_range : tuple or None, optional
+        (start, end) time window to read, see read_mira. Files without
+        rays inside the window are skipped.
+    range_limits : tuple or None, optional
+        (min, max) range of the gates to read in meters, see read_mira.
 
     Returns
     -------
     radar : Py-ART radar object
+    melt_hei : tuple of dicts
+        Melting layer height (MeltHei, MeltHeiDet and MeltHeiDB).
     """
-
-    radar, melt_hei = read_mira(filenames[0], for_quicklooks, ql_res)
-    for i in range(1, len(filenames)):
-        radar_i, melt_hei_i = read_mira(filenames[i], for_quicklooks, ql_res)
-        radar = join_radar(radar, radar_i)
-        for j in range(3):
-            melt_hei[j]["data"] = np.ma.append(
-                melt_hei[j]["data"], melt_hei_i[j]["data"]
+    from pyart.core.radar import Radar
+
+    with span("metadata"):
+        dims = [
+            _mira_dims(f, for_quicklooks, ql_res, time_range, range_limits)
+            for f in filenames
+        ]
+    filenames = [f for f, d in zip(filenames, dims) if d[0] > 0]
+    dims = [d for d in dims if d[0] > 0]
+    if len(filenames) == 0:
+        raise ValueError("No rays inside the requested time range")
+    nrays = np.array([d[0] for d in dims])
+    ngates = max([d[1] for d in dims])
+    ray_start = np.concatenate([[0], np.cumsum(nrays)[:-1]])
+    total_rays = int(np.sum(nrays))
+    ray_params = ("prt", "nyquist_velocity", "n_samples")
+
+    reader = partial(
+        read_mira,
+        for_quicklooks=for_quicklooks,
+        ql_res=ql_res,
+        time_range=time_range,
+        range_limits=range_limits,
+    )
+    executor = None
+    if workers is None:
+        results = map(reader, filenames)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(reader, filenames)
+
+    try:
+        for i, (radar_i, melt_hei_i) in enumerate(results):
+            if i == 0:
+                # the first file is the template for all metadata
+                first = radar_i
+                time = _allocate_like(radar_i.time, (total_rays,))
+                azimuth = _allocate_like(radar_i.azimuth, (total_rays,))
+                elevation = _allocate_like(radar_i.elevation, (total_rays,))
+                instrument_parameters = dict(radar_i.instrument_parameters)
+                for key in ray_params:
+                    instrument_parameters[key] = _allocate_like(
+                        radar_i.instrument_parameters[key], (total_rays,)
+                    )
+                fields = {}
+                for key, field in radar_i.fields.items():
+                    fields[key] = _allocate_like(
+                        field, (total_rays, ngates), masked=True
+                    )
+                melt_hei = tuple(
+                    _allocate_like(m, (total_rays,)) for m in melt_hei_i
+                )
+                sweeps = {
+                    "sweep_number": [],
+                    "sweep_mode": [],
+                    "fixed_angle": [],
+                    "sweep_start_ray_index": [],
+                    "sweep_end_ray_index": [],
+                }
+
+            rays = slice(ray_start[i], ray_start[i] + nrays[i])
+            time["data"][rays] = radar_i.time["data"]
+            azimuth["data"][rays] = radar_i.azimuth["data"]
+            elevation["data"][rays] = radar_i.elevation["data"]
+            for key in ray_params:
+                instrument_parameters[key]["data"][rays] = (
+                    radar_i.instrument_parameters[key]["data"]
+                )
+            for key in list(fields.keys()):
+                if key not in radar_i.fields:
+                    warnings.warn(
+                        "Field %s not present in all files (missing in %s), "
+                        "skipped" % (key, filenames[i])
+                    )
+                    del fields[key]
+                    continue
+                data = radar_i.fields[key]["data"]
+                fields[key]["data"][rays, : data.shape[1]] = data
+            for j in range(3):
+                melt_hei[j]["data"][rays] = melt_hei_i[j]["data"]
+            if radar_i.ngates == ngates:
+                _range = radar_i.range
+            sweeps["sweep_number"].append(radar_i.sweep_number["data"])
+            sweeps["sweep_mode"].append(radar_i.sweep_mode["data"])
+            sweeps["fixed_angle"].append(radar_i.fixed_angle["data"])
+            sweeps["sweep_start_ray_index"].append(
+                radar_i.sweep_start_ray_index["data"] + ray_start[i]
             )
+            sweeps["sweep_end_ray_index"].append(
+                radar_i.sweep_end_ray_index["data"] + ray_start[i]
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for key in sweeps:
+        dic = dict(getattr(first, key))
+        dic["data"] = np.concatenate(sweeps[key])
+        sweeps[key] = dic
+
+    with span("construct"):
+        radar = Radar(
+            time,
+            _range,
+            fields,
+            first.metadata,
+            first.scan_type,
+            first.latitude,
+            first.longitude,
+            first.altitude,
+            sweeps["sweep_number"],
+            sweeps["sweep_mode"],
+            sweeps["fixed_angle"],
+            sweeps["sweep_start_ray_index"],
+            sweeps["sweep_end_ray_index"],
+            azimuth,
+            elevation,
+            instrument_parameters=instrument_parameters,
+        )
     return radar, melt_hei
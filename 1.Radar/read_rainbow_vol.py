@@ -0,0 +1,343 @@
+# -*- coding: UTF-8 -*-
+"""
+Reading Rainbow 5 volumes stored as one .vol file per moment (e.g. the
+FCTH radar files 2017031418273000dBZ.vol, ...ZDR.vol, ...V.vol), merging
+all moments into a single Py-ART Radar object. Requires wradlib.
+
+The moment files are decoded in parallel with wrl.io.read_rainbow, their
+sweep and ray geometry is checked, and the Radar object is built as by
+read_rainbow_hdf5 for the HDF5 conversion of the same volume (same field
+names, range gates and sweep layout).
+
+Example
+-------
+>>> from read_rainbow_vol import read_rainbow_vol
+>>> radar = read_rainbow_vol("../dados/radar/FCTH/2017031418273000", workers=4)
+
+"""
+
+from __future__ import print_function
+import datetime as dt
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from reader_trace import span, traced
+
+# Field names of the Rainbow data types, as in read_rainbow_hdf5
+FIELD_NAMES = {
+    'dBZ': 'corrected_reflectivity',
+    'dBuZ': 'reflectivity',
+    'V': 'velocity',
+    'W': 'spectrum_width',
+    'ZDR': 'differential_reflectivity',
+    'PhiDP': 'filtered_differential_phase',
+    'uPhiDP': 'differential_phase',
+    'KDP': 'specific_differential_phase',
+    'RhoHV': 'cross_correlation_ratio'}
+
+UNITS = {
+    'dBZ': 'dBZ',
+    'dBuZ': 'dBZ',
+    'V': 'm/s',
+    'W': 'm/s',
+    'ZDR': 'dB',
+    'PhiDP': 'deg',
+    'uPhiDP': 'deg',
+    'KDP': 'deg/km',
+    'RhoHV': 'unitless'}
+
+
+def _param(sl, pargroup, name, default=None):
+    """
+    Returns a slice parameter, falling back to the scan parameter group.
+    """
+    value = sl.get(name)
+    if value is None:
+        value = pargroup.get(name, default)
+    return value
+
+
+def _decode_vol(fname):
+    """
+    Decodes one moment file into raw codes and sweep metadata.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the Rainbow .vol file.
+
+    Returns
+    -------
+    vol : dict
+        Data type, scan type, sensor location and wavelength, and a list
+        with one dictionary per sweep holding the raw codes, their scale,
+        the ray angles and the sweep timing and range parameters.
+    """
+    from wradlib.io import read_rainbow
+
+    with span('read', file=fname):
+        volume = read_rainbow(fname, loaddata=True)['volume']
+    scan = volume['scan']
+    pargroup = scan['pargroup']
+    slices = scan['slice']
+    if isinstance(slices, dict):
+        slices = [slices]
+    sensor = volume['sensorinfo']
+
+    sweeps = []
+    for sl in slices:
+        slicedata = sl['slicedata']
+        rayinfo = slicedata['rayinfo']
+        if isinstance(rayinfo, dict):
+            rayinfo = [rayinfo]
+        angles = dict([(ray['@refid'], ray) for ray in rayinfo])
+        start = angles['startangle']
+        start = start['data'] * 360.0 / 2 ** float(start['@depth'])
+        anglestep = float(_param(sl, pargroup, 'anglestep'))
+        if 'stopangle' in angles:
+            stop = angles['stopangle']
+            stop = stop['data'] * 360.0 / 2 ** float(stop['@depth'])
+            stop[start - stop > 5] += 360
+            angle = ((start + stop) / 2.0) % 360
+        else:
+            if int(_param(sl, pargroup, 'antdirection', 0)):
+                anglestep = -anglestep
+            angle = (start + anglestep / 2.0) % 360
+
+        raw = slicedata['rawdata']
+        depth = int(raw['@depth'])
+        vmin = float(raw['@min'])
+        vmax = float(raw['@max'])
+        sweeps.append({
+            'codes': raw['data'],
+            'scale': (vmax - vmin) / (2 ** depth - 2),
+            'offset': vmin,
+            'angle': angle,
+            'fixed_angle': float(sl['posangle']),
+            'start': dt.datetime.strptime(
+                slicedata['@date'] + slicedata['@time'], '%Y-%m-%d%H:%M:%S'),
+            'ray_time': abs(anglestep) / float(_param(sl, pargroup,
+                                                      'antspeed')),
+            'range_step': float(_param(sl, pargroup, 'rangestep')) * 1000,
+            'start_range': float(_param(sl, pargroup, 'start_range', 0))
+            * 1000,
+            'prf': float(_param(sl, pargroup, 'highprf'))})
+    return {
+        'type': raw['@type'],
+        'scan_type': 'rhi' if volume['@type'] == 'ele' else 'ppi',
+        'location': dict([(lab, np.atleast_1d(float(sensor[lab])))
+                          for lab in ['lat', 'lon', 'alt']]),
+        'wavelength': float(sensor['wavelen']),
+        'sweeps': sweeps}
+
+
+def _check_geometry(vols, fnames):
+    """
+    Raises ValueError if the moment files do not share the sweep and ray
+    geometry of the first one.
+    """
+    first = vols[0]
+    for vol, fname in zip(vols[1:], fnames[1:]):
+        if len(vol['sweeps']) != len(first['sweeps']):
+            raise ValueError('%s has %d sweeps, %s has %d' % (
+                fname, len(vol['sweeps']), fnames[0], len(first['sweeps'])))
+        for i, (sw, sw0) in enumerate(zip(vol['sweeps'], first['sweeps'])):
+            same = (sw['codes'].shape == sw0['codes'].shape and
+                    sw['fixed_angle'] == sw0['fixed_angle'] and
+                    sw['range_step'] == sw0['range_step'] and
+                    sw['start_range'] == sw0['start_range'] and
+                    np.array_equal(sw['angle'], sw0['angle']))
+            if not same:
+                raise ValueError('Sweep %d of %s differs from %s' % (
+                    i, fname, fnames[0]))
+
+
+@traced
+def read_rainbow_vol(prefix, exclude_fields=None, include_fields=None,
+                     workers=None):
+    """
+    Ingest the moment files of a Rainbow 5 volume into Py-ART, decoding
+    them in parallel. Requires wradlib.
+
+    Parameters
+    ----------
+    prefix : str or list of str
+        Common part of the moment file names, including the directory and
+        timestamp (e.g. '../dados/radar/FCTH/2017031418273000'), so that
+        the files are prefix + '<moment>.vol'. A list of file names can
+        also be given.
+    exclude_fields : list or None, optional
+        List of fields to exclude from the radar object (e.g.
+        ['spectrum_width']). Excluded moments are not decoded.
+        Set to None to include all fields specified by include_fields.
+    include_fields : list or None, optional
+        List of fields to include from the radar object (e.g.
+        ['reflectivity', 'velocity']). Set to None to include all fields
+        not specified by exclude_fields.
+    workers : int or None, optional
+        Number of processes decoding the moment files. None decodes them
+        one after the other in this process.
+
+    Returns
+    -------
+    Radar : pyart.core.radar.Radar
+        Py-ART Radar object, ready for processing, diplay, gridding,
+        and writing to file
+    """
+    # Py-ART is imported here, the decoding workers do not need it
+    from pyart.config import FileMetadata
+    from pyart.core import Radar
+    from pyart.io.common import make_time_unit_str
+
+    field_names = FIELD_NAMES
+    filemetadata = FileMetadata('cfradial', field_names, None,
+                                False, exclude_fields, include_fields)
+
+    if isinstance(prefix, str):
+        fnames = sorted(glob.glob(prefix + '*.vol'))
+        dtypes = [os.path.basename(f)[len(os.path.basename(prefix)):-4]
+                  for f in fnames]
+    else:
+        fnames = list(prefix)
+        dtypes = [None] * len(fnames)
+    # Skip the files of excluded moments before decoding them
+    fnames = [f for f, t in zip(fnames, dtypes)
+              if t is None or filemetadata.get_field_name(t) is not None]
+    if not fnames:
+        raise ValueError('No moment files to read for %s' % prefix)
+
+    if workers is None:
+        vols = [_decode_vol(f) for f in fnames]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            vols = list(executor.map(_decode_vol, fnames))
+    keep = [filemetadata.get_field_name(vol['type']) is not None
+            for vol in vols]
+    vols = [vol for vol, k in zip(vols, keep) if k]
+    fnames = [f for f, k in zip(fnames, keep) if k]
+    if not vols:
+        raise ValueError('No moment files to read for %s' % prefix)
+    _check_geometry(vols, fnames)
+
+    first = vols[0]
+    sweeps = first['sweeps']
+    nrays = np.array([sw['codes'].shape[0] for sw in sweeps])
+    ray_start = np.concatenate([[0], np.cumsum(nrays)[:-1]])
+    total_rays = int(nrays.sum())
+    ngates = max([sw['codes'].shape[1] for sw in sweeps])
+    dstart = sweeps[0]['start']
+
+    # Ray angles, times and PRF-derived parameters of each sweep
+    angles = np.empty(total_rays)
+    fixed = np.empty(len(sweeps))
+    times = np.empty(total_rays)
+    urg = np.empty(total_rays)
+    nyq = np.empty(total_rays)
+    for i, sw in enumerate(sweeps):
+        sweep = slice(ray_start[i], ray_start[i] + nrays[i])
+        angles[sweep] = sw['angle']
+        fixed[i] = sw['fixed_angle']
+        offset = (sw['start'] - dstart).total_seconds()
+        times[sweep] = offset + sw['ray_time'] * (np.arange(nrays[i]) + 0.5)
+        urg[sweep] = 3e8 / (2 * sw['prf'])
+        nyq[sweep] = sw['prf'] * first['wavelength'] / 4.0
+
+    # fixed_angle
+    fixed_angle = filemetadata('fixed_angle')
+    fixed_angle['data'] = fixed
+
+    # elevation and azimuth, the ray angles are azimuths of a PPI and
+    # elevations of an RHI
+    elevation = filemetadata('elevation')
+    azimuth = filemetadata('azimuth')
+    scan_type = first['scan_type']
+    fixed_rays = np.repeat(fixed, nrays)
+    if scan_type == 'rhi':
+        elevation['data'] = angles
+        azimuth['data'] = fixed_rays
+    else:
+        elevation['data'] = fixed_rays
+        azimuth['data'] = angles
+
+    # sweep_number
+    sweep_number = filemetadata('sweep_number')
+    nsweeps = len(sweeps)
+    sweep_number['data'] = np.arange(nsweeps, dtype='int32')
+
+    # sweep_mode
+    sweep_mode = filemetadata('sweep_mode')
+    sweep_mode['data'] = np.array(nsweeps * ['manual_' + scan_type])
+
+    # sweep_start_ray_index, sweep_end_ray_index
+    sweep_start_ray_index = filemetadata('sweep_start_ray_index')
+    sweep_end_ray_index = filemetadata('sweep_end_ray_index')
+    sweep_start_ray_index['data'] = np.array(ray_start, dtype='int')
+    sweep_end_ray_index['data'] = np.array(ray_start + nrays - 1, dtype='int')
+
+    # radar location
+    latitude = filemetadata('latitude')
+    longitude = filemetadata('longitude')
+    altitude = filemetadata('altitude')
+    latitude['data'] = first['location']['lat']
+    longitude['data'] = first['location']['lon']
+    altitude['data'] = first['location']['alt']
+
+    # time
+    _time = filemetadata('time')
+    _time['units'] = make_time_unit_str(dstart)
+    _time['data'] = times
+
+    # range
+    range_step = sweeps[0]['range_step']
+    _range = filemetadata('range')
+    _range['data'] = np.array(sweeps[0]['start_range'] + range_step +
+                              range_step * np.arange(ngates), dtype='f4')
+    _range['meters_to_center_of_first_gate'] = _range['data'][0] / 2.0
+    _range['meters_between_gates'] = range_step
+    _range['spacing_is_constant'] = 1
+
+    # instrument_parameters
+    instrument_parameters = {}
+    for lab, values in [('nyquist_velocity', nyq),
+                        ('unambiguous_range', urg)]:
+        instrument_parameters[lab] = filemetadata(lab)
+        instrument_parameters[lab]['data'] = values
+
+    # fields, each decoded into a preallocated volume, the padding gates
+    # of shorter sweeps stay missing
+    fields = {}
+    for vol in vols:
+        field_name = filemetadata.get_field_name(vol['type'])
+        data = np.full((total_rays, ngates), -32768.0)
+        mask = np.ones((total_rays, ngates), dtype=bool)
+        for i, sw in enumerate(vol['sweeps']):
+            codes = sw['codes']
+            sweep = np.s_[ray_start[i]:ray_start[i] + nrays[i],
+                          :codes.shape[1]]
+            np.multiply(codes, sw['scale'], out=data[sweep])
+            data[sweep] += sw['offset'] - sw['scale']
+            np.equal(codes, 0, out=mask[sweep])
+        data[mask] = -32768.0
+        fields[field_name] = {}
+        fields[field_name]['data'] = np.ma.MaskedArray(data, mask=mask,
+                                                       copy=False)
+        fields[field_name]['long_name'] = field_name
+        fields[field_name]['standard_name'] = field_name.replace('_', ' ')
+        fields[field_name]['units'] = UNITS.get(vol['type'], '')
+        fields[field_name]['coordinates'] = 'elevation azimuth range'
+
+    # metadata
+    metadata = filemetadata('metadata')
+    metadata['source'] = 'Brazil Radar'
+    metadata['original_container'] = ', '.join(fnames)
+
+    return Radar(
+        _time, _range, fields, metadata, scan_type,
+        latitude, longitude, altitude,
+        sweep_number, sweep_mode, fixed_angle, sweep_start_ray_index,
+        sweep_end_ray_index,
+        azimuth, elevation,
+        instrument_parameters=instrument_parameters)
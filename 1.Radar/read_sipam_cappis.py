@@ -6,21 +6,158 @@ Data source: https://adc.arm.gov/discovery/#/results/id::3900_macro_sipam-s-band
 Adapted from pyart.io.read_grid source code
 (https://arm-doe.github.io/pyart/_modules/pyart/io/grid_io.html)
 
+Py-ART is only imported when a Grid is built (read_sipam_cappi), so
+read_sipam_cappi_stack needs only netCDF4.
+
 @author: Camila Lopes (camila.lopes@iag.usp.br)
 
 """
 
 import datetime
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import netCDF4
 import numpy as np
 
-from pyart.core.grid import Grid
-from pyart.io.cfradial import _ncvar_to_dict, _create_ncvar
-from pyart.io.common import _test_arguments
+from reader_trace import span, traced
+
+
+def _ncvar_attrs(ncvar):
+    """
+    Attributes of a NetCDF variable, without the scaling parameters, as
+    the dictionary of pyart.io.cfradial._ncvar_to_dict without 'data'.
+    """
+    return dict(
+        [
+            (k, getattr(ncvar, k))
+            for k in ncvar.ncattrs()
+            if k not in ["scale_factor", "add_offset"]
+        ]
+    )
+
+
+def _geographic_to_aeqd(lon, lat, lon_0, lat_0, R=6370997.0):
+    """
+    Azimuthal equidistant x and y in meters of longitudes and latitudes,
+    on a sphere, as pyart.core.transforms.geographic_to_cartesian_aeqd.
+    """
+    lon = np.deg2rad(np.atleast_1d(lon))
+    lat = np.deg2rad(np.atleast_1d(lat))
+    lon_0 = np.deg2rad(lon_0)
+    lat_0 = np.deg2rad(lat_0)
+    cos_c = np.sin(lat_0) * np.sin(lat) + np.cos(lat_0) * np.cos(lat) * np.cos(
+        lon - lon_0
+    )
+    c = np.arccos(np.clip(cos_c, -1, 1))
+    # k = c / sin(c), which tends to 1 at the center
+    k = np.ones_like(c)
+    k[c != 0] = c[c != 0] / np.sin(c[c != 0])
+    x = R * k * np.cos(lat) * np.sin(lon - lon_0)
+    y = (
+        R
+        * k
+        * (
+            np.cos(lat_0) * np.sin(lat)
+            - np.sin(lat_0) * np.cos(lat) * np.cos(lon - lon_0)
+        )
+    )
+    return x, y
+
+
+def _sipam_index(dset, z_levels=None, bbox=None):
+    """
+    Index of the z0, y0 and x0 dimensions to read for the requested levels
+    and bounding box. Contiguous selections are returned as slices, so
+    they are read as a single hyperslab.
+
+    Parameters
+    ----------
+    dset : netCDF4.Dataset
+        Open SIPAM CAPPI file.
+    z_levels : list or None
+        Heights in meters, each matched to the nearest level.
+    bbox : tuple or None
+        (lon_min, lat_min, lon_max, lat_max) of the region to read.
+
+    Returns
+    -------
+    zindex, yindex, xindex : slice or array of int
+        Index of each dimension.
+    """
+    zindex = slice(None)
+    yindex = slice(None)
+    xindex = slice(None)
+    if z_levels is not None:
+        heights = dset.variables["z0"][:] * 1000
+        levels = np.unique(
+            [np.argmin(np.abs(heights - level)) for level in np.atleast_1d(z_levels)]
+        )
+        if np.all(np.diff(levels) == 1):
+            zindex = slice(levels[0], levels[-1] + 1)
+        else:
+            zindex = levels
+    if bbox is not None:
+        # the grid is an azimuthal equidistant projection, so the box edges
+        # are sampled to find its extent in x and y
+        lon_min, lat_min, lon_max, lat_max = bbox
+        edge = np.linspace(0, 1, 33)
+        ones = np.ones(33)
+        lons = lon_min + (lon_max - lon_min) * np.concatenate(
+            [edge, ones, edge[::-1], 0 * ones]
+        )
+        lats = lat_min + (lat_max - lat_min) * np.concatenate(
+            [0 * ones, edge, ones, edge[::-1]]
+        )
+        grid_mapping = dset.variables["grid_mapping_0"]
+        xs, ys = _geographic_to_aeqd(
+            lons,
+            lats,
+            grid_mapping.longitude_of_projection_origin,
+            grid_mapping.latitude_of_projection_origin,
+        )
+        x0 = dset.variables["x0"][:] * 1000
+        y0 = dset.variables["y0"][:] * 1000
+        xindex = slice(
+            np.searchsorted(x0, xs.min(), side="left"),
+            np.searchsorted(x0, xs.max(), side="right"),
+        )
+        yindex = slice(
+            np.searchsorted(y0, ys.min(), side="left"),
+            np.searchsorted(y0, ys.max(), side="right"),
+        )
+    return zindex, yindex, xindex
+
+
+class _SlabExtractor(object):
+    """
+    Class facilitating on demand extraction of part of a NetCDF variable.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+        NetCDF Variable from which data will be extracted.
+    index : tuple
+        Index of the hyperslab to read.
+
+    """
+
+    def __init__(self, ncvar, index):
+        """initialize the object."""
+        self.ncvar = ncvar
+        self.index = index
 
+    def __call__(self):
+        """Return an array containing the hyperslab of the variable."""
+        with span("read", field=self.ncvar.name) as sp:
+            data = self.ncvar[self.index]
+            sp.alloc(data)
+        return data
 
+
+@traced
 def read_sipam_cappi(
     filename,
     exclude_fields=[
@@ -35,6 +172,10 @@ def read_sipam_cappi(
         "grid_mapping_0",
     ],
     include_fields=None,
+    z_levels=None,
+    bbox=None,
+    delay_field_loading=False,
+    cache=None,
     **kwargs
 ):
     """
@@ -56,6 +197,25 @@ def read_sipam_cappi(
         List of fields to include from the radar object. This is applied
         after the `file_field_names` and `field_names` parameters. Set
         to None to include all fields not specified by exclude_fields.
+    z_levels : list or None, optional
+        Heights in meters of the levels to read, each matched to the
+        nearest level of the grid. None reads all levels.
+    bbox : tuple or None, optional
+        (lon_min, lat_min, lon_max, lat_max) of the region to read. Only
+        the x and y rows and columns covering it are read. None reads the
+        whole grid.
+    delay_field_loading : bool, optional
+        True to delay loading of field data from the file until the 'data'
+        key in a particular field dictionary is accessed. In this case
+        the field attribute of the returned Grid object will contain
+        LazyLoadDict objects not dict objects, and the file is kept open
+        until all fields are loaded.
+    cache : DecodeCache or None, optional
+        Cache of decoded files (see decode_cache.DecodeCache). If given,
+        the Grid object is read from the cache when this file was already
+        read with the same options, with the field data memory-mapped
+        from disk, and stored in it otherwise. Field data is then never
+        delayed, as the cached arrays are already loaded on demand.
 
     Returns
     -------
@@ -63,9 +223,24 @@ def read_sipam_cappi(
         Grid object containing gridded data.
 
     """
+    from pyart.core.grid import Grid
+    from pyart.io.cfradial import _ncvar_to_dict
+    from pyart.io.common import _test_arguments
+
     # test for non empty kwargs
     _test_arguments(kwargs)
 
+    if cache is not None:
+        with span("cache"):
+            return cache.fetch(
+                filename,
+                read_sipam_cappi,
+                exclude_fields=exclude_fields,
+                include_fields=include_fields,
+                z_levels=z_levels,
+                bbox=bbox,
+            )
+
     if exclude_fields is None:
         exclude_fields = []
 
@@ -94,7 +269,8 @@ def read_sipam_cappi(
         "ProjectionCoordinateSystem",
     ]
 
-    dset = netCDF4.Dataset(filename, mode="r")
+    with span("open"):
+        dset = netCDF4.Dataset(filename, mode="r")
 
     # metadata
     metadata = dict([(k, getattr(dset, k)) for k in dset.ncattrs()])
@@ -112,14 +288,17 @@ def read_sipam_cappi(
         "units": "degree_E",
     }
     origin_altitude = None
+    # index of the requested levels and region, only these parts of the
+    # fields are read
+    zindex, yindex, xindex = _sipam_index(dset, z_levels, bbox)
     x = _ncvar_to_dict(dset.variables["x0"])
-    x["data"] = x["data"] * 1000
+    x["data"] = x["data"][xindex] * 1000
     x["units"] = "m"
     y = _ncvar_to_dict(dset.variables["y0"])
-    y["data"] = y["data"] * 1000
+    y["data"] = y["data"][yindex] * 1000
     y["units"] = "m"
     z = _ncvar_to_dict(dset.variables["z0"])
-    z["data"] = z["data"] * 1000
+    z["data"] = z["data"][zindex] * 1000
     z["units"] = "m"
 
     # projection
@@ -140,7 +319,8 @@ def read_sipam_cappi(
 
     # check all non-reserved variables, those with the correct shape
     # are added to the field dictionary, if a wrong sized field is
-    # detected a warning is raised
+    # detected a warning is raised. The selection and shape are checked
+    # before any data is read.
     field_keys = [k for k in dset.variables if k not in reserved_variables]
     for field in field_keys:
         if field in exclude_fields:
@@ -148,15 +328,19 @@ def read_sipam_cappi(
         if include_fields is not None:
             if field not in include_fields:
                 continue
-        field_dic = _ncvar_to_dict(dset.variables[field])
-        if field_dic["data"].shape == field_shape_with_time:
-            field_dic["data"].shape = field_shape
-            fields[field] = field_dic
-        else:
-            bad_shape = field_dic["data"].shape
+        ncvar = dset.variables[field]
+        if ncvar.shape != field_shape_with_time:
             warnings.warn(
-                "Field %s skipped due to incorrect shape %s" % (field, bad_shape)
+                "Field %s skipped due to incorrect shape %s" % (field, ncvar.shape)
             )
+            continue
+        extractor = _SlabExtractor(ncvar, (0, zindex, yindex, xindex))
+        field_dic = _ncvar_to_dict(ncvar, lazydict=True)
+        field_dic.set_lazy("data", extractor)
+        if not delay_field_loading:
+            # read the data now, into a plain dictionary
+            field_dic = dict(field_dic)
+        fields[field] = field_dic
 
     # radar_ variables
     if "radar_latitude" in dset.variables:
@@ -199,23 +383,209 @@ def read_sipam_cappi(
     else:
         radar_time = None
 
-    dset.close()
-
-    return Grid(
-        time,
-        fields,
-        metadata,
-        origin_latitude,
-        origin_longitude,
-        origin_altitude,
-        x,
-        y,
-        z,
-        projection=projection,
-        radar_latitude=radar_latitude,
-        radar_longitude=radar_longitude,
-        radar_altitude=radar_altitude,
-        radar_name=radar_name,
-        radar_time=radar_time,
+    if not delay_field_loading:
+        dset.close()
+
+    with span("construct"):
+        grid = Grid(
+            time,
+            fields,
+            metadata,
+            origin_latitude,
+            origin_longitude,
+            origin_altitude,
+            x,
+            y,
+            z,
+            projection=projection,
+            radar_latitude=radar_latitude,
+            radar_longitude=radar_longitude,
+            radar_altitude=radar_altitude,
+            radar_name=radar_name,
+            radar_time=radar_time,
+        )
+    return grid
+
+
+def _read_cappi_slab(filename, fields, z_levels=None, bbox=None):
+    """
+    Read the requested levels and region of some fields of a SIPAM CAPPI
+    file as plain float32 arrays (NaN where data is missing), with the
+    file time and the full grid coordinates for geometry checks.
+    """
+    with span("file", file=filename), netCDF4.Dataset(filename, mode="r") as dset:
+        index = (0,) + _sipam_index(dset, z_levels, bbox)
+        time = dset.variables["time"]
+        grid_mapping = dset.variables["grid_mapping_0"]
+        geometry = {
+            "x0": dset.variables["x0"][:],
+            "y0": dset.variables["y0"][:],
+            "z0": dset.variables["z0"][:],
+            "origin": (
+                grid_mapping.latitude_of_projection_origin,
+                grid_mapping.longitude_of_projection_origin,
+            ),
+        }
+        date = netCDF4.num2date(
+            time[0],
+            time.units,
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        data = {}
+        for field in fields:
+            with span("read", field=field):
+                slab = dset.variables[field][index]
+            with span("decode", field=field) as sp:
+                data[field] = np.ma.filled(slab.astype(np.float32), np.nan)
+                sp.alloc(data[field])
+    return np.datetime64(date, "s"), geometry, data
+
+
+@traced
+def read_sipam_cappi_stack(
+    filenames,
+    fields=None,
+    z_levels=None,
+    bbox=None,
+    workers=None,
+    memmap_dir=None,
+    as_xarray=False,
+):
+    """
+    Read a sequence of SIPAM CAPPI files into (time, z, y, x) cubes, one
+    per field, without building a Grid for each file.
+
+    Each cube is allocated once as float32 (NaN where data is missing),
+    optionally as a memory-mapped .npy file, and filled in file order.
+    All files must have the same grid as the first one.
+
+    Parameters
+    ----------
+    filenames : list of str
+        SIPAM CAPPI files (sbmn_cappi_*.nc), in time order.
+    fields : list or None, optional
+        Fields to read. None reads all (time, z0, y0, x0) variables of the
+        first file.
+    z_levels : list or None, optional
+        Heights in meters of the levels to read, see read_sipam_cappi.
+    bbox : tuple or None, optional
+        (lon_min, lat_min, lon_max, lat_max) of the region to read, see
+        read_sipam_cappi.
+    workers : int or None, optional
+        Number of worker processes reading files in parallel. None reads
+        the files one by one in this process.
+    memmap_dir : str or None, optional
+        Directory where each cube is stored as a memory-mapped <field>.npy
+        file, so stacks larger than memory can be built. None keeps the
+        cubes in memory.
+    as_xarray : bool, optional
+        True to return an xarray.Dataset wrapping the cubes (without
+        copying them) instead of a dictionary.
+
+    Returns
+    -------
+    stack : dict or xarray.Dataset
+        Dictionary with 'time' (datetime64 array), 'x', 'y', 'z'
+        dictionaries (in meters) and 'fields', a dictionary of field
+        dictionaries whose 'data' is the (time, z, y, x) cube.
+
+    """
+    # geometry, fields and attributes from the first file
+    with span("metadata"), netCDF4.Dataset(filenames[0], mode="r") as dset:
+        zindex, yindex, xindex = _sipam_index(dset, z_levels, bbox)
+        coords = {}
+        for dim, var in [("x", "x0"), ("y", "y0"), ("z", "z0")]:
+            coords[dim] = _ncvar_attrs(dset.variables[var])
+            coords[dim]["data"] = dset.variables[var][:]
+            coords[dim]["units"] = "m"
+        coords["x"]["data"] = coords["x"]["data"][xindex] * 1000
+        coords["y"]["data"] = coords["y"]["data"][yindex] * 1000
+        coords["z"]["data"] = coords["z"]["data"][zindex] * 1000
+        dims = ("time", "z0", "y0", "x0")
+        if fields is None:
+            fields = [
+                k for k, v in dset.variables.items() if v.dimensions == dims
+            ]
+        attrs = {}
+        for field in fields:
+            attrs[field] = _ncvar_attrs(dset.variables[field])
+            attrs[field].pop("_FillValue", None)
+
+    shape = (
+        len(filenames),
+        len(coords["z"]["data"]),
+        len(coords["y"]["data"]),
+        len(coords["x"]["data"]),
     )
+    cubes = {}
+    with span("allocate") as sp:
+        for field in fields:
+            if memmap_dir is None:
+                cubes[field] = np.empty(shape, dtype=np.float32)
+                sp.alloc(cubes[field])
+            else:
+                cubes[field] = np.lib.format.open_memmap(
+                    os.path.join(memmap_dir, field + ".npy"),
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=shape,
+                )
+    times = np.empty(len(filenames), dtype="datetime64[s]")
+
+    reader = partial(_read_cappi_slab, fields=fields, z_levels=z_levels, bbox=bbox)
+    executor = None
+    if workers is None:
+        results = map(reader, filenames)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(reader, filenames)
+    try:
+        for i, (date, geometry, data) in enumerate(results):
+            if i == 0:
+                first = geometry
+            else:
+                for key in ["x0", "y0", "z0", "origin"]:
+                    if not np.array_equal(geometry[key], first[key]):
+                        raise ValueError(
+                            "Grid %s of %s differs from %s"
+                            % (key, filenames[i], filenames[0])
+                        )
+            times[i] = date
+            for field in fields:
+                cubes[field][i] = data[field]
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
+    if as_xarray:
+        import xarray as xr
+
+        data_vars = {}
+        for field in fields:
+            data_vars[field] = (
+                ("time", "z", "y", "x"),
+                cubes[field],
+                dict(attrs[field]),
+            )
+        return xr.Dataset(
+            data_vars,
+            coords={
+                "time": times,
+                "z": coords["z"]["data"],
+                "y": coords["y"]["data"],
+                "x": coords["x"]["data"],
+            },
+        )
+
+    stack_fields = {}
+    for field in fields:
+        stack_fields[field] = dict(attrs[field])
+        stack_fields[field]["data"] = cubes[field]
+    return {
+        "time": times,
+        "x": coords["x"],
+        "y": coords["y"],
+        "z": coords["z"],
+        "fields": stack_fields,
+    }
@@ -0,0 +1,334 @@
+"""
+Reader for the RHI products of the X-band radar operated by INPE during
+RELAMPAGO (../dados/radar/XPOL_RELAMPAGO).
+
+Each moment of an RHI is stored in its own file, named
+AAA_YYYYMMDDhhmmsscc<moment>.rhi.PROD, where AAA is the azimuth of the RHI
+in degrees, e.g. 000_2018112713280700dBZ.rhi.PROD. A file is a raw
+little-endian float32 image of 400 x 500 pixels (800000 bytes) of a
+vertical cross section along the azimuth of the RHI:
+
+* columns are horizontal distances from the radar, 200 m each, from
+  0 to 100 km;
+* rows are heights above the radar, 50 m each, from 20 km (first row)
+  down to 0 km (last row);
+* pixels without data are -9999.
+
+The products do not carry any geometry, so the radar location and the
+range gates are taken from a volume (117BRX-*.HDF5) of the same radar,
+read with read_rainbow_hdf5. The rays of the RHI are rebuilt at the
+elevations of the RHI scans (0 to 60 degrees every 0.5 degree) by taking
+the image pixel of each gate. Products are memory-mapped and only the
+pixels of the gates are read, when a field is first accessed.
+
+Example
+-------
+>>> from glob import glob
+>>> from read_xpol_rhi import read_xpol_rhi, read_xpol_rhi_batch
+>>> files = glob("../dados/radar/XPOL_RELAMPAGO/000_*.rhi.PROD")
+>>> volume = "../dados/radar/XPOL_RELAMPAGO/117BRX-20181127130002.HDF5"
+>>> radar = read_xpol_rhi(files, volume)
+>>> radars = read_xpol_rhi_batch(glob("RHI/*/*.rhi.PROD"), volume)
+
+"""
+
+import datetime
+import os
+import re
+
+import numpy as np
+
+from read_brazil_radar_py3 import read_rainbow_hdf5
+from reader_trace import traced
+
+# Layout of the .rhi.PROD files
+PROD_SHAPE = (400, 500)
+PROD_DTYPE = "<f4"
+PROD_FILL = -9999.0
+PROD_DX = 200.0
+PROD_DZ = 50.0
+PROD_BYTES = PROD_SHAPE[0] * PROD_SHAPE[1] * np.dtype(PROD_DTYPE).itemsize
+
+# Elevations of the RHI scans, in degrees
+RHI_ELEVATIONS = np.arange(0, 60.25, 0.5)
+
+# Field names of the moment files
+FIELD_NAMES = {
+    "dBZ": "reflectivity",
+    "dBuZ": "unfiltered_reflectivity",
+    "V": "velocity",
+    "W": "spectrum_width",
+    "ZDR": "differential_reflectivity",
+    "PhiDP": "differential_phase",
+    "KDP": "specific_differential_phase",
+    "RhoHV": "cross_correlation_ratio",
+}
+
+_PROD_NAME = re.compile(r"(\d{3})_(\d{14})(\d{2})(\w+)\.rhi\.PROD$")
+
+
+def _parse_name(filename):
+    """
+    Azimuth, time and moment of a product file, from its name.
+    """
+    match = _PROD_NAME.search(os.path.basename(filename))
+    if match is None:
+        raise ValueError("Not an RHI product file name: " + filename)
+    azimuth, stamp, hundredths, moment = match.groups()
+    time = datetime.datetime.strptime(stamp, "%Y%m%d%H%M%S")
+    time += datetime.timedelta(milliseconds=10 * int(hundredths))
+    return float(azimuth), time, moment
+
+
+def _check_size(filename):
+    """
+    Raise ValueError if a file does not have the size of an RHI product.
+    """
+    size = os.path.getsize(filename)
+    if size != PROD_BYTES:
+        raise ValueError(
+            "%s has %d bytes, RHI products have %d" % (filename, size, PROD_BYTES)
+        )
+
+
+def map_rhi_product(filename):
+    """
+    Memory-map an RHI product file, without reading it.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .rhi.PROD file.
+
+    Returns
+    -------
+    image : np.memmap
+        Read-only (400, 500) float32 image, heights from top to bottom and
+        distances from left to right, with -9999 where there is no data.
+    """
+    _check_size(filename)
+    return np.memmap(filename, dtype=PROD_DTYPE, mode="r", shape=PROD_SHAPE)
+
+
+class _ProductExtractor(object):
+    """
+    Object for reading the gates of an RHI from a product file.
+    """
+
+    def __init__(self, filename, rows, cols, outside):
+        self.filename = filename
+        self.rows = rows
+        self.cols = cols
+        self.outside = outside
+
+    def __call__(self):
+        """Return the gate data, masked where there is no data."""
+        data = map_rhi_product(self.filename)[self.rows, self.cols]
+        return np.ma.masked_where(
+            self.outside | (data == PROD_FILL), data, copy=False
+        )
+
+
+def _rhi_geometry(volume_file, elevations):
+    """
+    Radar location and range gates of a volume file, and the image pixel
+    (row, column) of each gate of the RHI rays. The pixels depend only on
+    the horizontal distance and height of the gates, not on the azimuth.
+    """
+    from pyart.core.transforms import antenna_to_cartesian
+
+    volume = read_rainbow_hdf5(volume_file, include_fields=[])
+    ranges = volume.range["data"]
+    nrays = len(elevations)
+
+    x, y, z = antenna_to_cartesian(
+        ranges[np.newaxis, :] / 1000.0,
+        np.zeros((nrays, 1)),
+        np.asarray(elevations, dtype="float64")[:, np.newaxis],
+    )
+    # gates of the horizontal ray can be a few mm below the radar height
+    z = np.maximum(z, 0)
+    rows = PROD_SHAPE[0] - 1 - np.floor(z / PROD_DZ).astype("intp")
+    cols = np.floor(np.hypot(x, y) / PROD_DX).astype("intp")
+    outside = (rows < 0) | (cols >= PROD_SHAPE[1])
+    rows[outside] = 0
+    cols[outside] = 0
+    return {
+        "range": volume.range,
+        "latitude": volume.latitude,
+        "longitude": volume.longitude,
+        "altitude": volume.altitude,
+        "rows": rows,
+        "cols": cols,
+        "outside": outside,
+    }
+
+
+def _make_radar(filenames, azimuth, time, geometry, elevations, filemetadata):
+    """
+    Build the Radar object of one RHI from its product files.
+    """
+    from pyart.core.radar import Radar
+    from pyart.io.common import make_time_unit_str
+    from pyart.lazydict import LazyLoadDict
+
+    nrays = len(elevations)
+
+    # the products have no ray times, all rays take the RHI time
+    _time = filemetadata("time")
+    _time["units"] = make_time_unit_str(time)
+    _time["data"] = np.zeros(nrays, dtype="float64")
+
+    elevation = filemetadata("elevation")
+    elevation["data"] = np.asarray(elevations, dtype="float32")
+    _azimuth = filemetadata("azimuth")
+    _azimuth["data"] = np.full(nrays, azimuth, dtype="float32")
+
+    fixed_angle = filemetadata("fixed_angle")
+    fixed_angle["data"] = np.array([azimuth], dtype="float32")
+    sweep_number = filemetadata("sweep_number")
+    sweep_number["data"] = np.array([0], dtype="int32")
+    sweep_mode = filemetadata("sweep_mode")
+    sweep_mode["data"] = np.array(["rhi"])
+    sweep_start_ray_index = filemetadata("sweep_start_ray_index")
+    sweep_start_ray_index["data"] = np.array([0], dtype="int32")
+    sweep_end_ray_index = filemetadata("sweep_end_ray_index")
+    sweep_end_ray_index["data"] = np.array([nrays - 1], dtype="int32")
+
+    fields = {}
+    for filename in filenames:
+        moment = _parse_name(filename)[2]
+        field_name = filemetadata.get_field_name(moment)
+        if field_name is None:
+            continue
+        fields[field_name] = LazyLoadDict(filemetadata(field_name))
+        fields[field_name].set_lazy(
+            "data",
+            _ProductExtractor(
+                filename, geometry["rows"], geometry["cols"], geometry["outside"]
+            ),
+        )
+
+    metadata = filemetadata("metadata")
+    metadata["source"] = "INPE X-band radar, RELAMPAGO"
+    metadata["original_container"] = os.path.dirname(os.path.abspath(filenames[0]))
+
+    return Radar(
+        _time,
+        dict(geometry["range"]),
+        fields,
+        metadata,
+        "rhi",
+        dict(geometry["latitude"]),
+        dict(geometry["longitude"]),
+        dict(geometry["altitude"]),
+        sweep_number,
+        sweep_mode,
+        fixed_angle,
+        sweep_start_ray_index,
+        sweep_end_ray_index,
+        _azimuth,
+        elevation,
+    )
+
+
+@traced
+def read_xpol_rhi_batch(
+    filenames,
+    volume_file,
+    exclude_fields=None,
+    include_fields=None,
+    elevations=RHI_ELEVATIONS,
+):
+    """
+    Read many RHI product files, grouping them into one Radar per RHI.
+
+    The volume file is read and the gate pixels are computed once, so the
+    cost of each RHI is that of building its Radar object.
+    Product files are only checked and grouped here, they are
+    memory-mapped when a field is first accessed.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Product files (.rhi.PROD) of any number of RHIs, each RHI with one
+        file per moment.
+    volume_file : str
+        Volume file (117BRX-*.HDF5) of the same radar, from which the
+        radar location and range gates are taken.
+    exclude_fields : list or None, optional
+        List of fields to exclude from the radar objects. Set to None to
+        include all fields specified by include_fields.
+    include_fields : list or None, optional
+        List of fields to include from the radar objects. Set to None to
+        include all fields not specified by exclude_fields.
+    elevations : array, optional
+        Elevations of the rays to build, in degrees.
+
+    Returns
+    -------
+    radars : list of Radar
+        One Radar object per RHI, in time order.
+    """
+    from pyart.config import FileMetadata
+
+    filemetadata = FileMetadata(
+        "cfradial", FIELD_NAMES, None, False, exclude_fields, include_fields
+    )
+
+    scans = {}
+    for filename in filenames:
+        azimuth, time, _ = _parse_name(filename)
+        scans.setdefault((time, azimuth), []).append(filename)
+
+    geometry = _rhi_geometry(volume_file, elevations)
+    radars = []
+    for time, azimuth in sorted(scans):
+        files = sorted(scans[(time, azimuth)])
+        for filename in files:
+            _check_size(filename)
+        radars.append(
+            _make_radar(files, azimuth, time, geometry, elevations, filemetadata)
+        )
+    return radars
+
+
+@traced
+def read_xpol_rhi(
+    filenames,
+    volume_file,
+    exclude_fields=None,
+    include_fields=None,
+    elevations=RHI_ELEVATIONS,
+):
+    """
+    Read the product files of one RHI into a Radar object.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Product files (.rhi.PROD) of the RHI, one per moment.
+    volume_file : str
+        Volume file (117BRX-*.HDF5) of the same radar, from which the
+        radar location and range gates are taken.
+    exclude_fields : list or None, optional
+        List of fields to exclude from the radar object. Set to None to
+        include all fields specified by include_fields.
+    include_fields : list or None, optional
+        List of fields to include from the radar object. Set to None to
+        include all fields not specified by exclude_fields.
+    elevations : array, optional
+        Elevations of the rays to build, in degrees.
+
+    Returns
+    -------
+    radar : Radar
+        Radar object with one RHI sweep. Fields are LazyLoadDicts, read
+        from the memory-mapped products when first accessed.
+    """
+    radars = read_xpol_rhi_batch(
+        filenames, volume_file, exclude_fields, include_fields, elevations
+    )
+    if len(radars) != 1:
+        raise ValueError("Files are from %d different RHIs" % len(radars))
+    return radars[0]
@@ -0,0 +1,321 @@
+"""
+Per-stage instrumentation of the radar readers.
+
+The readers in this folder mark the stages of a read with named spans:
+opening the file, reading each field or sweep, decoding the raw values,
+masking and building the Radar or Grid object. Spans are only recorded
+while a Trace is active. Otherwise `span` returns a shared object that
+does nothing, so the readers run at their normal speed.
+
+Each finished span is passed to the sinks of the active traces as a
+dictionary with:
+
+- name, and path: the names of the enclosing spans and its own, joined
+  by "/" (e.g. "read_rainbow_hdf5/field/decode")
+- pid, start (seconds since 1970) and seconds, its duration
+- rchar and read_bytes, the bytes read by the process during the span
+  through read calls and from storage (from /proc/self/io, Linux only)
+- allocated and arrays, the bytes and number of arrays the reader
+  allocated in it
+- error, the exception type, if the span raised
+- its attributes (file, field, sweep, ...)
+
+A sink is a callable taking the event, a logging.Logger (events are
+logged at DEBUG level) or the name of a JSON lines file. Spans of worker
+processes forked while a trace is active (e.g. read_multi_mira with
+`workers`) are written to the JSON lines files and loggers, but are not
+passed to callables nor kept in Trace.events.
+
+Example
+-------
+>>> from reader_trace import Trace
+>>> from read_brazil_radar_py3 import read_rainbow_hdf5
+>>> with Trace("trace.jsonl") as trace:
+...     radar = read_rainbow_hdf5("117BRX-20171115215006.HDF5")
+>>> trace.summary()
+
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+# active traces, spans are only recorded when this is not empty
+_traces = []
+_local = threading.local()
+
+
+def process_io():
+    """(rchar, read_bytes) of this process, from /proc/self/io."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters.get("rchar", 0), counters.get("read_bytes", 0)
+
+
+def _stack():
+    """Spans open in this thread, innermost last."""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _NullSpan(object):
+    """Span returned when no trace is active, does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def alloc(self, *arrays):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """Span recorded for the active traces, see `span`."""
+
+    def __init__(self, name, attrs, traces):
+        self.name = name
+        self.attrs = attrs
+        self.traces = traces
+        self.io = any([trace.io for trace in traces])
+        self.allocated = 0
+        self.arrays = 0
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.path = stack[-1].path + "/" + self.name
+        else:
+            self.path = self.name
+        stack.append(self)
+        if self.io:
+            self.io_start = process_io()
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.clock
+        _stack().pop()
+        event = {
+            "name": self.name,
+            "path": self.path,
+            "pid": os.getpid(),
+            "start": self.start,
+            "seconds": seconds,
+            "allocated": self.allocated,
+            "arrays": self.arrays,
+        }
+        if self.io:
+            rchar, read_bytes = process_io()
+            event["rchar"] = rchar - self.io_start[0]
+            event["read_bytes"] = read_bytes - self.io_start[1]
+        if exc_type is not None:
+            event["error"] = exc_type.__name__
+        event.update(self.attrs)
+        for trace in self.traces:
+            trace.emit(event)
+        return False
+
+    def alloc(self, *arrays):
+        """Count arrays allocated by the reader in this span."""
+        for array in arrays:
+            self.allocated += array.nbytes
+            self.arrays += 1
+
+    def set(self, **attrs):
+        """Add attributes to the span."""
+        self.attrs.update(attrs)
+
+
+def span(name, **attrs):
+    """
+    Context manager marking a stage of a reader.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage (open, read, decode, mask, construct, ...).
+    **attrs
+        Attributes of the span, e.g. the file, field or sweep. They must
+        be JSON serializable.
+
+    Returns
+    -------
+    span : context manager
+        Its `alloc(*arrays)` method counts arrays allocated in the span,
+        and `set(**attrs)` adds attributes. Both do nothing, as the span
+        itself, when no trace is active.
+    """
+    if not _traces:
+        return _NULL_SPAN
+    return _Span(name, attrs, list(_traces))
+
+
+def traced(func):
+    """
+    Decorator wrapping each call of a reader in a span named after it,
+    with the file (or the number of files) read as attribute.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _traces:
+            return func(*args, **kwargs)
+        attrs = {}
+        if args and isinstance(args[0], (str, os.PathLike)):
+            attrs["file"] = os.fspath(args[0])
+        elif args and isinstance(args[0], (list, tuple)):
+            attrs["files"] = len(args[0])
+        with _Span(name, attrs, list(_traces)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class _JSONLinesSink(object):
+    """Appends events to a JSON lines file, one write per event."""
+
+    def __init__(self, filename):
+        # O_APPEND keeps the lines of forked worker processes whole
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __call__(self, event):
+        os.write(self.fd, (json.dumps(event, default=str) + "\n").encode())
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Trace(object):
+    """
+    Records the spans of the readers while active, as a context manager
+    or between `start` and `stop`.
+
+    Parameters
+    ----------
+    *sinks : callable, logging.Logger or str
+        Where each event is sent: a callable taking the event dictionary,
+        a logger (at DEBUG level) or the name of a JSON lines file, to
+        which events are appended.
+    io : bool, optional
+        True to record the bytes read in each span, from /proc/self/io.
+        This costs two small reads of /proc per span.
+    keep : bool, optional
+        True to keep the events in `events`, for `summary`.
+    """
+
+    def __init__(self, *sinks, io=True, keep=True):
+        self.io = io
+        self.keep = keep
+        self.events = []
+        self._files = []
+        self.sinks = []
+        for sink in sinks:
+            if isinstance(sink, logging.Logger):
+                self.sinks.append(functools.partial(_log_event, sink))
+            elif isinstance(sink, (str, os.PathLike)):
+                self._files.append(os.fspath(sink))
+            else:
+                self.sinks.append(sink)
+        self._writers = []
+
+    def start(self):
+        """Start recording spans."""
+        if self in _traces:
+            return self
+        self._writers = [_JSONLinesSink(f) for f in self._files]
+        _traces.append(self)
+        return self
+
+    def stop(self):
+        """Stop recording spans and close the JSON lines files."""
+        if self in _traces:
+            _traces.remove(self)
+        for writer in self._writers:
+            writer.close()
+        self._writers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def emit(self, event):
+        """Send an event to the sinks."""
+        if self.keep:
+            self.events.append(event)
+        for sink in self.sinks:
+            sink(event)
+        for writer in self._writers:
+            writer(event)
+
+    def summary(self):
+        """
+        Totals of the kept events by span path.
+
+        Returns
+        -------
+        summary : dict
+            For each path, from the slowest, the number of spans and the
+            total seconds, bytes read and bytes and arrays allocated.
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(
+                event["path"],
+                {"count": 0, "seconds": 0.0, "rchar": 0, "allocated": 0, "arrays": 0},
+            )
+            total["count"] += 1
+            for key in ["seconds", "rchar", "allocated", "arrays"]:
+                total[key] += event.get(key, 0)
+        return dict(
+            sorted(totals.items(), key=lambda item: item[1]["seconds"], reverse=True)
+        )
+
+
+def _log_event(logger, event):
+    attrs = dict([(k, v) for k, v in event.items() if k not in _EVENT_KEYS])
+    logger.debug(
+        "%s %.6f s read %d B allocated %d B %s",
+        event["path"],
+        event["seconds"],
+        event.get("rchar", 0),
+        event["allocated"],
+        attrs,
+        extra={"span": event},
+    )
+
+
+_EVENT_KEYS = [
+    "name",
+    "path",
+    "pid",
+    "start",
+    "seconds",
+    "allocated",
+    "arrays",
+    "rchar",
+    "read_bytes",
+]
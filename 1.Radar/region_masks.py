@@ -0,0 +1,355 @@
+"""
+Region masks of grids from shapefiles.
+
+RegionMasker rasterizes the polygons of a shapefile (e.g.
+../dados/shapefiles/sao_paulo.shp or ne_10m_admin_1_states_provinces.shp)
+onto the cells of a grid once, into a label array: 0 outside every
+polygon and i + 1 inside the i-th selected record. Each polygon is tested
+against the cells inside its bounding box only (found with a binary search
+on the cells sorted by longitude), with the vectorized point-in-polygon
+test of shapely. Label arrays are cached in memory and optionally on disk,
+keyed by the cell coordinates, the contents of the shapefile and the
+record selection, so masking another frame of the same grid, or computing
+statistics per region, costs a few array operations.
+
+Example
+-------
+>>> from region_masks import RegionMasker
+>>> from read_fcth_cappis import read_fcth_cappi
+>>> masker = RegionMasker(cache_dir="/tmp/region_masks")
+>>> grid = read_fcth_cappi("cappi_CZ_16000_20170314_1827.dat.gz")
+>>> regions = masker.grid_regions(grid, "../dados/shapefiles/sao_paulo.shp")
+>>> regions.apply(grid)
+>>> regions.statistics(grid.fields["corrected_reflectivity"]["data"])
+>>> states = masker.grid_regions(
+...     grid,
+...     "../dados/shapefiles/ne_10m_admin_1_states_provinces.shp",
+...     attribute="name",
+...     where={"admin": "Brazil"},
+... )
+
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import shapely
+from cartopy.io.shapereader import Reader
+from scipy import ndimage
+
+from array_cache import ArrayCache
+
+
+def _shapefile_hash(shapefile):
+    """SHA1 of the .shp and .dbf files of a shapefile."""
+    base = shapefile[:-4] if shapefile.endswith(".shp") else shapefile
+    sha = hashlib.sha1()
+    for ext in [".shp", ".dbf"]:
+        if os.path.isfile(base + ext):
+            with open(base + ext, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_regions(shapefile, attribute=None, where=None, encoding="latin-1"):
+    """
+    Read the polygons of a shapefile.
+
+    Parameters
+    ----------
+    shapefile : str
+        Name of the shapefile, with or without .shp.
+    attribute : str or None, optional
+        Attribute naming the regions. None names them by record number.
+    where : dict or None, optional
+        Keep only the records whose attributes have these values.
+    encoding : str, optional
+        Encoding of the .dbf file.
+
+    Returns
+    -------
+    names : list of str
+        Name of each region.
+    geometries : list of shapely geometries
+        Polygons of each region.
+    """
+    # pyshp logs a warning for each polygon whose rings have the wrong
+    # orientation, as in sao_paulo.shp; they are still read correctly.
+    # Geometries are converted when first accessed, so the loop is inside.
+    logger = logging.getLogger("shapefile")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    names = []
+    geometries = []
+    try:
+        for i, record in enumerate(Reader(shapefile, encoding=encoding).records()):
+            if where is not None and any(
+                [record.attributes.get(k) != v for k, v in where.items()]
+            ):
+                continue
+            if record.geometry is None:
+                continue
+            if attribute is None:
+                names.append(str(i))
+            else:
+                names.append(str(record.attributes[attribute]))
+            geometries.append(record.geometry)
+    finally:
+        logger.setLevel(level)
+    return names, geometries
+
+
+def rasterize(longitude, latitude, geometries):
+    """
+    Label of each cell: 0 outside every geometry, i + 1 inside the i-th.
+    Cells on the boundary of a geometry are inside it. Where geometries
+    overlap, the last one wins.
+    """
+    x = np.asarray(longitude, dtype="float64").ravel()
+    y = np.asarray(latitude, dtype="float64").ravel()
+    order = np.argsort(x, kind="stable")
+    xs = x[order]
+    ys = y[order]
+    labels = np.zeros(x.size, dtype="int32")
+    for i, geometry in enumerate(geometries):
+        x0, y0, x1, y1 = geometry.bounds
+        start = np.searchsorted(xs, x0, side="left")
+        stop = np.searchsorted(xs, x1, side="right")
+        index = start + np.nonzero((ys[start:stop] >= y0) & (ys[start:stop] <= y1))[0]
+        if len(index) == 0:
+            continue
+        shapely.prepare(geometry)
+        inside = shapely.intersects_xy(geometry, xs[index], ys[index])
+        labels[order[index[inside]]] = i + 1
+    return labels.reshape(np.shape(longitude))
+
+
+class RegionMask(object):
+    """
+    Regions of a shapefile rasterized onto a grid.
+
+    Attributes
+    ----------
+    labels : array of int32
+        Label of each cell (y, x): 0 outside every region, i + 1 inside
+        region i.
+    names : list of str
+        Name of each region.
+
+    """
+
+    def __init__(self, labels, names):
+        self.labels = labels
+        self.names = list(names)
+
+    def _codes(self, regions):
+        """Labels of a list of region names or indices, or of all regions."""
+        if regions is None:
+            return np.arange(1, len(self.names) + 1)
+        codes = []
+        for region in regions:
+            if isinstance(region, str):
+                codes.extend([i + 1 for i, n in enumerate(self.names) if n == region])
+            else:
+                codes.append(int(region) + 1)
+        return np.array(codes, dtype="int32")
+
+    def mask(self, regions=None):
+        """
+        Boolean (y, x) array, True inside the regions (names or indices).
+        None selects all regions.
+        """
+        if regions is None:
+            return self.labels > 0
+        lookup = np.zeros(len(self.names) + 1, dtype=bool)
+        lookup[self._codes(regions)] = True
+        return lookup[self.labels]
+
+    def apply(self, grid, fields=None, regions=None):
+        """
+        Mask the fields of a Grid outside the regions, in place.
+
+        Parameters
+        ----------
+        grid : Grid
+            Grid whose cells were rasterized.
+        fields : list of str or None, optional
+            Fields to mask. None masks all fields.
+        regions : list or None, optional
+            Names or indices of the regions to keep. None keeps all.
+        """
+        outside = ~self.mask(regions)
+        if fields is None:
+            fields = list(grid.fields)
+        for name in fields:
+            data = np.ma.asarray(grid.fields[name]["data"])
+            mask = np.ma.getmaskarray(data) | outside
+            grid.fields[name]["data"] = np.ma.MaskedArray(
+                np.ma.getdata(data), mask=mask, copy=False
+            )
+
+    def statistics(self, data, regions=None):
+        """
+        Statistics of data in each region.
+
+        Parameters
+        ----------
+        data : array
+            Array whose last two dimensions are the (y, x) cells, e.g. a
+            field of a Grid. Masked values and NaN are ignored.
+        regions : list or None, optional
+            Names or indices of the regions. None uses all regions.
+
+        Returns
+        -------
+        stats : dict
+            Dictionary of region name to a dictionary of the number of
+            cells, of valid values ('count') and their fraction
+            ('coverage'), 'mean', 'min', 'max' and 'sum'. Statistics of
+            regions without valid values are NaN.
+        """
+        data = np.ma.asarray(data)
+        labels = np.broadcast_to(self.labels, data.shape).ravel()
+        values = np.ma.getdata(data).astype("float64").ravel()
+        valid = ~np.ma.getmaskarray(data).ravel() & np.isfinite(values)
+        nlabels = len(self.names) + 1
+        cells = np.bincount(labels, minlength=nlabels)
+        valid_labels = np.where(valid, labels, 0)
+        count = np.bincount(valid_labels, minlength=nlabels)
+        total = np.bincount(
+            valid_labels, weights=np.where(valid, values, 0), minlength=nlabels
+        )
+        codes = self._codes(regions)
+        minimum = np.atleast_1d(ndimage.minimum(values, valid_labels, codes))
+        maximum = np.atleast_1d(ndimage.maximum(values, valid_labels, codes))
+
+        stats = {}
+        for code, vmin, vmax in zip(codes, minimum, maximum):
+            n = count[code]
+            stats[self.names[code - 1]] = {
+                "cells": int(cells[code]),
+                "count": int(n),
+                "coverage": float(n / cells[code]) if cells[code] else np.nan,
+                "mean": float(total[code] / n) if n else np.nan,
+                "min": float(vmin) if n else np.nan,
+                "max": float(vmax) if n else np.nan,
+                "sum": float(total[code]),
+            }
+        return stats
+
+
+class RegionMasker(ArrayCache):
+    """
+    Cached rasterization of shapefile regions onto grids.
+
+    Parameters
+    ----------
+    cache_dir : str or None, optional
+        Directory where label arrays are stored. None keeps them in memory
+        only.
+    encoding : str, optional
+        Encoding of the .dbf files.
+
+    """
+
+    def __init__(self, cache_dir=None, encoding="latin-1"):
+        ArrayCache.__init__(self, cache_dir)
+        self.encoding = encoding
+        self._hashes = {}
+
+    def _shapefile_hash(self, shapefile):
+        """Hash of a shapefile, computed again only if its .shp or .dbf
+        changed."""
+        base = shapefile[:-4] if shapefile.endswith(".shp") else shapefile
+        version = [os.path.abspath(base)]
+        for ext in [".shp", ".dbf"]:
+            if os.path.isfile(base + ext):
+                stat = os.stat(base + ext)
+                version.extend([stat.st_size, stat.st_mtime_ns])
+            else:
+                version.extend([None, None])
+        version = tuple(version)
+        if version not in self._hashes:
+            self._hashes[version] = _shapefile_hash(base)
+        return self._hashes[version]
+
+    def _key(self, cells, shapefile, attribute, where):
+        """Key of the cells (a list of arrays and values), the shapefile
+        contents and the selection."""
+        sha = hashlib.sha1()
+        for item in cells:
+            if isinstance(item, np.ndarray):
+                sha.update(repr(item.shape).encode())
+                sha.update(np.round(item.astype("float64"), 6).tobytes())
+            else:
+                sha.update(repr(item).encode())
+        sha.update(self._shapefile_hash(shapefile).encode())
+        selection = sorted(where.items()) if where is not None else None
+        sha.update(repr((attribute, selection, self.encoding)).encode())
+        return sha.hexdigest()
+
+    def _to_arrays(self, regions):
+        """Arrays of the labels and names of regions."""
+        return {"labels": regions.labels, "names": np.array(regions.names)}
+
+    def _from_arrays(self, arrays):
+        """Regions of the arrays of their labels and names."""
+        return RegionMask(arrays["labels"], arrays["names"].tolist())
+
+    def regions(self, longitude, latitude, shapefile, attribute=None, where=None):
+        """
+        Regions of a shapefile on cells given by their coordinates.
+
+        Parameters
+        ----------
+        longitude, latitude : array
+            Coordinates of the cells in degrees, 2D arrays.
+        shapefile : str
+            Name of the shapefile, with or without .shp.
+        attribute, where :
+            See read_regions.
+
+        Returns
+        -------
+        regions : RegionMask
+            Label array of the cells and region names. The label array is
+            shared by all calls with the same key and must not be changed.
+        """
+        key = self._key(
+            [np.asarray(longitude), np.asarray(latitude)], shapefile, attribute, where
+        )
+        return self._regions(
+            key, lambda: (longitude, latitude), shapefile, attribute, where
+        )
+
+    def _regions(self, key, coordinates, shapefile, attribute, where):
+        """Regions of a key, rasterized on coordinates() if not cached."""
+
+        def build():
+            names, geometries = read_regions(shapefile, attribute, where, self.encoding)
+            longitude, latitude = coordinates()
+            return RegionMask(rasterize(longitude, latitude, geometries), names)
+
+        return self._cached(key, build)
+
+    def grid_regions(self, grid, shapefile, attribute=None, where=None):
+        """
+        Regions of a shapefile on the (y, x) cells of a Grid, e.g. from
+        read_sipam_cappi or read_fcth_cappi. See regions. The cache key is
+        the grid definition (origin, x and y axes and projection), so the
+        coordinates of the cells are only computed when rasterizing.
+        """
+        definition = [
+            np.asarray(grid.origin_latitude["data"]),
+            np.asarray(grid.origin_longitude["data"]),
+            np.asarray(grid.x["data"]),
+            np.asarray(grid.y["data"]),
+            sorted(grid.projection.items()),
+        ]
+        key = self._key(definition, shapefile, attribute, where)
+        return self._regions(
+            key, grid.get_point_longitude_latitude, shapefile, attribute, where
+        )
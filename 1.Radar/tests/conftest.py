@@ -0,0 +1,47 @@
+"""
+Shared fixtures of the reader tests.
+
+The readers are modules of the 1.Radar folder, not an installed package,
+so the folder is put on sys.path. Tests using the sample files of
+../dados/radar are skipped when the files are not there.
+"""
+
+import os
+import sys
+
+import pytest
+
+RADAR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(RADAR_DIR, "..", "dados", "radar")
+
+if RADAR_DIR not in sys.path:
+    sys.path.insert(0, RADAR_DIR)
+
+
+def sample(*path):
+    """Path of a sample file of ../dados/radar, skipping if missing."""
+    filename = os.path.join(DATA_DIR, *path)
+    if not os.path.isfile(filename):
+        pytest.skip("sample file not found: %s" % filename)
+    return filename
+
+
+@pytest.fixture
+def xpol_cmp():
+    return sample("XPOL_CMP", "117BRX-20171115215006.HDF5")
+
+
+@pytest.fixture
+def xpol_relampago():
+    return sample("XPOL_RELAMPAGO", "117BRX-20181127130002.HDF5")
+
+
+@pytest.fixture
+def fcth_cappi():
+    return sample("FCTH", "cappi_CZ_16000_20170314_1827.dat.gz")
+
+
+@pytest.fixture
+def fcth_vol():
+    """Common prefix of the FCTH moment files, e.g. prefix + 'dBZ.vol'."""
+    return sample("FCTH", "2017031418273000dBZ.vol")[: -len("dBZ.vol")]
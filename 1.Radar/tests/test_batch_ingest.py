@@ -0,0 +1,65 @@
+import os
+
+import h5py
+import pytest
+
+from batch_ingest import batch_ingest, detect_format, output_names
+
+
+def test_output_names_keep_directories(tmp_path):
+    filenames = [
+        str(tmp_path / "a" / "117BRX-20171115215006.HDF5"),
+        str(tmp_path / "b" / "117BRX-20171115215006.HDF5"),
+    ]
+    outputs = output_names(filenames, "/out")
+    assert outputs == [
+        os.path.join("/out", "a", "117BRX-20171115215006.nc"),
+        os.path.join("/out", "b", "117BRX-20171115215006.nc"),
+    ]
+    # a single directory keeps the flat layout
+    assert output_names(filenames[:1], "/out") == [
+        os.path.join("/out", "117BRX-20171115215006.nc")
+    ]
+
+
+def test_output_names_collision(tmp_path):
+    filenames = [str(tmp_path / "volume.HDF5"), str(tmp_path / "volume.h5")]
+    with pytest.raises(ValueError):
+        output_names(filenames, "/out")
+
+
+def test_unsupported_files_are_not_failures(tmp_path):
+    (tmp_path / "readme.txt").write_text("not a radar file")
+    (tmp_path / "notes.pdf").write_bytes(b"%PDF-1.4")
+    summary = batch_ingest([str(tmp_path)], str(tmp_path / "out"), log=None)
+    assert summary["unsupported"] == 2
+    assert summary["failed"] == 0
+    assert summary["written"] == 0
+
+
+def test_hdf5_without_how(tmp_path):
+    # the groups of a Rainbow volume, without the 'how' group
+    filename = str(tmp_path / "volume.h5")
+    with h5py.File(filename, "w") as r:
+        r.create_group("scan0")
+        r.create_group("where")
+    assert detect_format(filename) == "rainbow_hdf5"
+    (tmp_path / "readme.txt").write_text("not a radar file")
+    summary = batch_ingest(
+        [str(tmp_path)], str(tmp_path / "out"), workers=1, log=None
+    )
+    assert summary["failed"] == 1
+    assert summary["unsupported"] == 1
+    failed = [r for r in summary["files"] if r["status"] == "failed"][0]
+    assert failed["input"] == filename
+    assert failed["error"]
+
+
+def test_output_names_input_overwritten(tmp_path):
+    filename = str(tmp_path / "mira.nc")
+    with pytest.raises(ValueError):
+        output_names([filename], str(tmp_path))
+    # a different output directory is fine
+    assert output_names([filename], str(tmp_path / "out")) == [
+        str(tmp_path / "out" / "mira.nc")
+    ]
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from cross_sections import cross_section_ppi, extract_rhi
+from read_brazil_radar_py3 import read_rainbow_hdf5
+
+# away from north, where pyart does not wrap the azimuths around
+TARGETS = [45.3, 120.0, 300.7]
+
+
+def _sparse_radar():
+    """Two sweeps of rays every 10 degrees, the second one turned by 5."""
+    from pyart.testing import make_empty_ppi_radar
+
+    radar = make_empty_ppi_radar(10, 36, 2)
+    radar.azimuth["data"] = np.concatenate(
+        [np.arange(36) * 10.0, np.arange(36) * 10.0 + 5.0]
+    )
+    data = np.ma.arange(720, dtype="float32").reshape(72, 10)
+    radar.fields["reflectivity"] = {"data": data, "units": "dBZ"}
+    return radar
+
+
+def test_matches_pyart(xpol_cmp):
+    from pyart.util import cross_section_ppi as pyart_cross_section_ppi
+
+    radar = read_rainbow_hdf5(xpol_cmp)
+    reference = pyart_cross_section_ppi(radar, TARGETS)
+    radar_rhi = cross_section_ppi(radar, TARGETS)
+    rhi = extract_rhi(radar, TARGETS)
+    assert radar_rhi.nsweeps == reference.nsweeps == len(TARGETS)
+    np.testing.assert_array_equal(
+        radar_rhi.azimuth["data"], reference.azimuth["data"]
+    )
+    np.testing.assert_array_equal(
+        rhi["azimuth"].ravel(), reference.azimuth["data"]
+    )
+    for field in radar.fields:
+        expected = reference.fields[field]["data"]
+        for data in [radar_rhi.fields[field]["data"], rhi["fields"][field]]:
+            data = data.reshape(expected.shape)
+            np.testing.assert_array_equal(
+                np.ma.getmaskarray(data), np.ma.getmaskarray(expected)
+            )
+            np.testing.assert_array_equal(
+                np.ma.filled(data, 0), np.ma.filled(expected, 0)
+            )
+
+
+def test_quantized_gather(xpol_cmp):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    quantized = read_rainbow_hdf5(xpol_cmp, quantized=True)
+    targets = np.arange(0, 360, 7.5)
+    rhi = extract_rhi(radar, targets)
+    quantized_rhi = extract_rhi(quantized, targets)
+    np.testing.assert_array_equal(quantized_rhi["ray"], rhi["ray"])
+    for field, data in rhi["fields"].items():
+        gathered = quantized_rhi["fields"][field]
+        assert gathered.shape == (len(targets), radar.nsweeps, radar.ngates)
+        np.testing.assert_array_equal(
+            np.ma.getmaskarray(gathered), np.ma.getmaskarray(data)
+        )
+        # decoded in float32 by both readers, in a different order
+        np.testing.assert_allclose(
+            np.ma.filled(gathered, 0), data.filled(0), rtol=1e-6, atol=1e-6
+        )
+
+
+def test_az_tol_miss():
+    radar = _sparse_radar()
+    rhi = extract_rhi(radar, [10.0, 359.5, 2.5], az_tol=1.0)
+    # only the first sweep has rays at 10 and, across north, at 0, no ray
+    # is within 1 degree of 2.5
+    np.testing.assert_array_equal(rhi["ray"], [[1, -1], [0, -1], [-1, -1]])
+    data = rhi["fields"]["reflectivity"]
+    np.testing.assert_array_equal(np.ma.getmaskarray(data[:, :, 0]), rhi["ray"] < 0)
+    np.testing.assert_array_equal(data[0, 0], np.arange(10, 20))
+    assert np.ma.is_masked(rhi["azimuth"][0, 1])
+
+    # nearest ray at any distance without az_tol
+    np.testing.assert_array_equal(extract_rhi(radar, [9.0])["ray"], [[1, 36]])
+    np.testing.assert_array_equal(extract_rhi(radar, [359.0])["ray"], [[0, 71]])
+
+    with pytest.warns(UserWarning):
+        radar_rhi = cross_section_ppi(radar, [10.0], az_tol=1.0)
+    assert radar_rhi.nrays == 1
+    np.testing.assert_array_equal(
+        radar_rhi.fields["reflectivity"]["data"][0], np.arange(10, 20)
+    )
+    with pytest.raises(ValueError), pytest.warns(UserWarning):
+        cross_section_ppi(radar, [2.5], az_tol=1.0)
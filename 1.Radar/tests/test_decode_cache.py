@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from decode_cache import DecodeCache
+
+
+def read_numbers(filename, scale=1.0):
+    with open(filename) as f:
+        return {"data": np.arange(1000) * float(f.read()) * scale}
+
+
+def test_hits_and_options(tmp_path):
+    source = str(tmp_path / "source.txt")
+    with open(source, "w") as f:
+        f.write("2")
+    cache = DecodeCache(str(tmp_path / "cache"))
+    first = cache.fetch(source, read_numbers)
+    again = cache.fetch(source, read_numbers)
+    scaled = cache.fetch(source, read_numbers, scale=3.0)
+    np.testing.assert_array_equal(again["data"], first["data"])
+    assert isinstance(again["data"], np.memmap)
+    np.testing.assert_array_equal(scaled["data"], first["data"] * 3)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+
+
+def test_changed_source_invalidates_all_options(tmp_path):
+    source = str(tmp_path / "source.txt")
+    other = str(tmp_path / "other.txt")
+    for filename in [source, other]:
+        with open(filename, "w") as f:
+            f.write("2")
+    cache = DecodeCache(str(tmp_path / "cache"))
+    cache.fetch(source, read_numbers)
+    cache.fetch(source, read_numbers, scale=3.0)
+    cache.fetch(other, read_numbers)
+
+    with open(source, "w") as f:
+        f.write("5")
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.fetch(source, read_numbers)["data"][1] == 5
+    # the entry of the other options is outdated too, that of the other
+    # file is kept
+    stats = cache.stats()
+    assert stats["invalidations"] == 2
+    assert stats["entries"] == 2
+    assert cache.fetch(source, read_numbers, scale=3.0)["data"][1] == 15
+    assert cache.fetch(other, read_numbers)["data"][1] == 2
+    assert cache.stats()["invalidations"] == 2
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,65 @@
+import numpy as np
+
+from composite import Compositor
+from grid_weights import CachedGridder
+from read_brazil_radar_py3 import read_rainbow_hdf5
+
+GRID = ((5, 41, 41), ((1000, 5000), (-40000, 40000), (-40000, 40000)))
+
+
+def test_entries_reloaded_from_disk(xpol_cmp, tmp_path):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    gridder = CachedGridder(*GRID, cache_dir=str(tmp_path))
+    compositor = Compositor(resolution=0.05, cache_dir=str(tmp_path))
+    grid = gridder.grid(radar, ["reflectivity"])
+    composite = compositor.composite([radar])
+    gridder.grid(radar, ["reflectivity"])
+    assert gridder.stats() == {"hits": 1, "loads": 0, "builds": 1, "rebuilds": 0}
+
+    # new instances load the weights and index maps stored by the first
+    reloaded = CachedGridder(*GRID, cache_dir=str(tmp_path))
+    compositor = Compositor(resolution=0.05, cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(
+        reloaded.grid(radar, ["reflectivity"]).fields["reflectivity"]["data"],
+        grid.fields["reflectivity"]["data"],
+    )
+    np.testing.assert_array_equal(
+        compositor.composite([radar])["data"], composite["data"]
+    )
+    assert reloaded.stats()["loads"] == 1
+    assert compositor.stats()["loads"] == 1
+
+
+def test_rebuilt_when_angles_change(xpol_cmp):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    compositor = Compositor(resolution=0.05, angle_tolerance=0.5)
+    compositor.index_map(radar)
+    radar.azimuth["data"] = radar.azimuth["data"] + 0.2
+    compositor.index_map(radar)
+    radar.azimuth["data"] = radar.azimuth["data"] + 1.0
+    compositor.index_map(radar)
+    assert compositor.stats() == {"hits": 2, "loads": 0, "builds": 2, "rebuilds": 1}
+
+
+def test_gridder_matches_grid_from_radars(xpol_cmp):
+    from pyart.map import grid_from_radars
+
+    radar = read_rainbow_hdf5(xpol_cmp)
+    # away from the radar, where every gate within the radius of influence
+    # fits in max_neighbors
+    shape, limits = (5, 31, 31), ((1000, 5000), (10000, 40000), (10000, 40000))
+    options = {
+        "weighting_function": "Barnes2",
+        "roi_func": "constant",
+        "constant_roi": 1000.0,
+    }
+    gridder = CachedGridder(shape, limits, max_neighbors=512, **options)
+    data = gridder.grid(radar, ["reflectivity"]).fields["reflectivity"]["data"]
+    reference = grid_from_radars(
+        radar, shape, limits, fields=["reflectivity"], **options
+    ).fields["reflectivity"]["data"]
+    np.testing.assert_array_equal(
+        np.ma.getmaskarray(data), np.ma.getmaskarray(reference)
+    )
+    assert np.ma.count(data) > 1000
+    np.testing.assert_allclose(data.compressed(), reference.compressed(), atol=0.01)
@@ -0,0 +1,20 @@
+"""
+Importing the readers, the gridder and the compositor must not import
+Py-ART, which takes seconds; it is only imported when a Radar or Grid is
+built. Each module is imported in a new interpreter.
+"""
+
+import pytest
+
+from benchmark_readers import IMPORT_MODULES, check_imports, import_times
+
+# generous, so a loaded machine does not fail the test; importing Py-ART
+# takes several times longer
+BUDGET = 1.5
+
+
+@pytest.mark.parametrize("module", IMPORT_MODULES)
+def test_import_is_lazy(module):
+    times = import_times([module], repeat=2)
+    assert not times[module]["imports_pyart"]
+    assert check_imports(times, BUDGET) == []
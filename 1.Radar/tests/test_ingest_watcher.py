@@ -0,0 +1,88 @@
+import asyncio
+import os
+import shutil
+
+from ingest_watcher import IngestWatcher, _product_name
+
+
+def _nrays(volume):
+    return volume["data"].nrays
+
+
+_nrays.__name__ = "nrays"
+
+
+def _write(path, data=b"radar"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_product_name():
+    volume = {"filename": "/data/in/117BRX-20171115215006.HDF5"}
+    assert _product_name(volume, "/out", "maxz.npz") == os.path.join(
+        "/out", "117BRX-20171115215006_maxz.npz"
+    )
+
+
+def test_poll_settle_and_prune(tmp_path):
+    watcher = IngestWatcher(str(tmp_path), settle=5.0)
+    path = str(tmp_path / "volume.HDF5")
+    _write(path)
+    _write(str(tmp_path / "volume.HDF5.part"))
+    _write(str(tmp_path / ".hidden"))
+    assert watcher.poll(now=0.0) == []
+    assert watcher.poll(now=4.0) == []
+    assert watcher.poll(now=6.0) == [(path, 0.0)]
+    # taken files are not taken again while they are in the directory
+    assert watcher.poll(now=20.0) == []
+    assert watcher._taken == {path}
+    os.remove(path)
+    assert watcher.poll(now=21.0) == []
+    assert watcher._taken == set()
+    assert watcher._pending == {}
+
+
+def test_run(xpol_cmp, tmp_path):
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    shutil.copy(xpol_cmp, str(incoming / "a.HDF5"))
+    _write(str(incoming / "notes.txt"), b"not a radar file")
+    watcher = IngestWatcher(str(incoming), [_nrays], interval=0.05, atomic=True)
+
+    async def run_twice():
+        loop = asyncio.get_running_loop()
+        first = await watcher.run(max_files=2, timeout=0.5)
+        # the timeout of the first run must not stop the second one
+        loop.call_later(1.0, shutil.copy, xpol_cmp, str(incoming / "b.HDF5"))
+        second = await watcher.run(max_files=1, timeout=10.0)
+        return first, second
+
+    first, second = asyncio.run(run_twice())
+    reports = dict([(os.path.basename(r["filename"]), r) for r in first])
+    assert reports["a.HDF5"]["status"] == "done"
+    assert reports["a.HDF5"]["kind"] == "rainbow_hdf5"
+    assert set(reports["a.HDF5"]["seconds"]) == {"decode", "nrays"}
+    assert reports["notes.txt"]["status"] == "failed"
+    assert [os.path.basename(r["filename"]) for r in second] == ["b.HDF5"]
+    assert second[0]["status"] == "done"
+
+
+def test_bounded_runs_keep_remaining_files(tmp_path):
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        _write(str(tmp_path / name))
+    watcher = IngestWatcher(str(tmp_path), interval=0.05, atomic=True)
+
+    async def run_twice():
+        first = await watcher.run(max_files=2, timeout=5.0)
+        second = await watcher.run(max_files=1, timeout=5.0)
+        return first, second
+
+    first, second = asyncio.run(run_twice())
+    assert sorted([os.path.basename(r["filename"]) for r in first]) == [
+        "a.txt",
+        "b.txt",
+    ]
+    assert [os.path.basename(r["filename"]) for r in second] == ["c.txt"]
+    assert watcher._taken == set(
+        [str(tmp_path / name) for name in ["a.txt", "b.txt", "c.txt"]]
+    )
@@ -0,0 +1,37 @@
+import pickle
+
+import numpy as np
+
+from read_brazil_radar_py3 import QuantizedField, read_rainbow_hdf5
+
+
+def test_extract_sweeps(xpol_cmp):
+    radar = read_rainbow_hdf5(xpol_cmp, quantized=True)
+    reference = read_rainbow_hdf5(xpol_cmp)
+    subset = radar.extract_sweeps([0, 1])
+    expected = reference.extract_sweeps([0, 1])
+    for name, field in subset.fields.items():
+        assert isinstance(field, QuantizedField)
+        # the new data no longer matches the codes of the whole volume
+        assert field.moment is None
+        np.testing.assert_allclose(
+            field["data"], expected.fields[name]["data"], atol=1e-4
+        )
+
+
+def test_copy_keeps_codes(xpol_cmp):
+    radar = read_rainbow_hdf5(xpol_cmp, quantized=True)
+    field = radar.fields["reflectivity"]
+    copy = field.copy()
+    assert copy.moment is field.moment
+    assert "data" in copy._lazyload
+    np.testing.assert_array_equal(copy.get_sweep(1), field.get_sweep(1))
+
+
+def test_pickle_and_release(xpol_cmp):
+    radar = read_rainbow_hdf5(xpol_cmp, quantized=True)
+    field = pickle.loads(pickle.dumps(radar.fields["velocity"]))
+    data = field["data"]
+    field.release()
+    assert "data" in field._lazyload
+    np.testing.assert_array_equal(field["data"], data)
@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from quicklooks import ColormapLUT, QuicklookRenderer, _Layout
+from read_brazil_radar_py3 import QuantizedMoment, read_rainbow_hdf5
+
+
+@pytest.fixture
+def renderer(tmp_path):
+    with QuicklookRenderer(size=200, outlines=[], cache_dir=str(tmp_path)) as r:
+        yield r
+
+
+def _field(shape, index, value=40.0):
+    """Masked reflectivity field with a single valid value."""
+    data = np.ma.masked_all(shape, dtype="float32")
+    data[index] = value
+    return {"data": data, "units": "dBZ"}
+
+
+def _ppi_radar():
+    """One sweep of 360 rays and 100 gates every 1 km, with one gate 50 km
+    east of the radar."""
+    from pyart.testing import make_empty_ppi_radar
+
+    radar = make_empty_ppi_radar(100, 360, 1)
+    radar.range["data"] = np.arange(100) * 1000.0
+    radar.fields["reflectivity"] = _field((360, 100), (90, 50))
+    return radar
+
+
+def test_lut_index():
+    lut = ColormapLUT("viridis", vmin=0.0, vmax=10.0, ncolors=10)
+    data = np.ma.array([-5.0, 0.0, 4.5, 9.99, 10.0, 50.0, np.nan, 3.0])
+    data[-1] = np.ma.masked
+    np.testing.assert_array_equal(lut.index(data), [1, 1, 5, 10, 10, 10, 0, 0])
+    assert lut.index(data).dtype == np.uint8
+    # index 0 is transparent, the colors are opaque
+    assert lut.rgba(np.array([0]))[0, 3] == 0
+    assert np.all(lut.table[1:, 3] == 255)
+
+
+def test_lut_index_codes():
+    lut = ColormapLUT(vmin=-10.0, vmax=70.0)
+    codes = np.arange(256, dtype="uint8").reshape(2, 128)
+    moment = QuantizedMoment(codes, [0.5, 0.25], [-32.0, -20.0], [0, 1], [1, 1])
+    for sweep in [0, 1]:
+        table = lut.index_codes(moment, sweep)
+        values = moment.decode(sweep)[0]
+        np.testing.assert_array_equal(table[codes[sweep]], lut.index(values))
+        # code 0 is missing data
+        assert table[0] == 0
+
+
+def test_layout_compose():
+    background = np.full((4, 5, 3), 200, dtype="uint8")
+    # opaque black over the top left pixel of the box
+    layout = _Layout(
+        background,
+        (1, 2, 2, 3),
+        np.array([0], dtype="int32"),
+        np.zeros((1, 3), dtype="uint8"),
+        np.array([255], dtype="uint8"),
+    )
+    table = np.array([[0, 0, 0, 0], [255, 0, 0, 255], [0, 0, 255, 0]], "uint8")
+    codes = np.array([[1, 1, 0], [0, 1, 2]], dtype="uint8")
+    image = layout.compose(codes, table)
+    expected = background.copy()
+    expected[1, 2] = 0
+    expected[[1, 2], [3, 3]] = [255, 0, 0]
+    np.testing.assert_array_equal(image, expected)
+    # the background of the layout is left unchanged
+    assert np.all(layout.background == 200)
+
+
+def test_quantized_frame_matches_float(xpol_cmp, renderer):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    quantized = read_rainbow_hdf5(xpol_cmp, quantized=True)
+    assert getattr(quantized.fields["reflectivity"], "moment", None) is not None
+    for sweep in [0, 8, quantized.nsweeps - 1]:
+        _, _, codes, title = renderer.frame(radar, "reflectivity", sweep=sweep)
+        _, _, qcodes, qtitle = renderer.frame(quantized, "reflectivity", sweep=sweep)
+        assert codes.shape == (200, 200)
+        assert np.count_nonzero(codes) > 0
+        np.testing.assert_array_equal(qcodes, codes)
+        assert qtitle == title
+
+
+def test_ppi_gate_pixel(tmp_path):
+    radar = _ppi_radar()
+    # pixels of 1 km centered on the radar
+    with QuicklookRenderer(
+        size=199, max_range=99500.0, outlines=[], cache_dir=str(tmp_path)
+    ) as renderer:
+        _, _, codes, _ = renderer.frame(radar, "reflectivity")
+        value = renderer.lut.index(np.array([40.0]))[0]
+    expected = np.zeros((199, 199), dtype="uint8")
+    expected[99, 149] = value
+    np.testing.assert_array_equal(codes, expected)
+
+
+def test_grid_cell_pixels(renderer):
+    from pyart.testing import make_empty_grid
+
+    # 20 x 10 cells of 1 km, drawn 10 pixels per cell
+    grid = make_empty_grid((1, 10, 20), ((0, 0), (-4500, 4500), (-9500, 9500)))
+    grid.fields["reflectivity"] = _field((1, 10, 20), (0, 2, 5))
+    _, _, codes, _ = renderer.frame(grid, "reflectivity")
+    assert codes.shape == (100, 200)
+    expected = np.zeros(codes.shape, dtype=bool)
+    # rows start from the north
+    expected[70:80, 50:60] = True
+    np.testing.assert_array_equal(codes > 0, expected)
+
+
+def test_vpt_ray_pixels(tmp_path):
+    from pyart.testing import make_empty_ppi_radar
+
+    # profiles every 10 s from midnight, gates every 100 m
+    radar = make_empty_ppi_radar(100, 360, 1)
+    radar.scan_type = "vpt"
+    radar.elevation["data"][:] = 90.0
+    radar.time["units"] = "seconds since 2017-03-14T00:00:00Z"
+    radar.time["data"] = np.arange(360) * 10.0
+    radar.range["data"] = np.arange(100) * 100.0
+    radar.fields["reflectivity"] = _field((360, 100), (100, 30))
+    with QuicklookRenderer(
+        vpt_size=(360, 99), hours=1.0, cache_dir=str(tmp_path)
+    ) as renderer:
+        _, _, codes, _ = renderer.frame(radar, "reflectivity")
+    assert codes.shape == (99, 360)
+    rows, columns = np.nonzero(codes)
+    # one column per profile, 100 m per row from 9.9 km at the top
+    assert set(columns) == {100}
+    heights = (99 - rows - 0.5) * 100.0
+    assert np.all(np.abs(heights - 3000.0) <= 50.0)
+
+
+def test_layout_cache_hit(xpol_cmp, tmp_path, renderer):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    renderer.render(radar, str(tmp_path / "a.png"), sweep=0)
+    assert renderer.stats() == {"hits": 0, "loads": 0, "builds": 1}
+    # the sweeps share the layout of the radar
+    renderer.render(radar, str(tmp_path / "b.png"), sweep=1)
+    assert renderer.stats() == {"hits": 1, "loads": 0, "builds": 1}
+
+    with QuicklookRenderer(
+        size=200, outlines=[], cache_dir=renderer.cache_dir
+    ) as reloaded:
+        reloaded.render(radar, str(tmp_path / "c.png"), sweep=0)
+        assert reloaded.stats() == {"hits": 0, "loads": 1, "builds": 0}
+    np.testing.assert_array_equal(
+        np.asarray(Image.open(str(tmp_path / "c.png"))),
+        np.asarray(Image.open(str(tmp_path / "a.png"))),
+    )
+
+
+def test_render_many_workers(xpol_cmp, tmp_path, renderer):
+    radar = read_rainbow_hdf5(xpol_cmp)
+    items = []
+    for workers in [0, 2]:
+        directory = tmp_path / ("workers_%d" % workers)
+        directory.mkdir()
+        items.append(
+            [
+                (radar, str(directory / ("%02d.png" % i)), {"sweep": i})
+                for i in range(4)
+            ]
+        )
+    serial = renderer.render_many(items[0], workers=0)
+    parallel = renderer.render_many(items[1], workers=2)
+    assert parallel == [item[1] for item in items[1]]
+    for a, b in zip(serial, parallel):
+        np.testing.assert_array_equal(
+            np.asarray(Image.open(a)), np.asarray(Image.open(b))
+        )
@@ -0,0 +1,210 @@
+"""
+read_rainbow_hdf5 against the multi-pass algorithm it replaced: one
+np.append per sweep and moment, per-ray datetime objects and sweep
+boundaries from np.where on each unique elevation.
+
+The original code indexes every HDF5 attribute with [0] and fails on
+files storing them as scalars (XPOL_RELAMPAGO), so the reference below
+unwraps them; everything else follows it. Its duration of the last
+sweep comes from a linear fit of scan speed against sweep duration, which
+is undefined when all sweeps have the same speed (XPOL_RELAMPAGO); no
+times are returned then.
+"""
+
+import datetime as dt
+import shutil
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from read_brazil_radar_py3 import FIELD_NAMES, _ray_times, read_rainbow_hdf5
+
+
+def _first(value):
+    if np.ndim(value) > 0:
+        value = value[0]
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def multi_pass_reference(filename):
+    """Fields, angles, times and sweep indices of the multi-pass reader."""
+    bad = -32768
+    with h5py.File(filename, "r") as r:
+        elcnt = len([key for key in r.keys() if key[:4] == "scan"])
+        momlab = [key for key in r["scan0"].keys() if key[:6] == "moment"]
+        data = dict([(mom, []) for mom in momlab])
+        shp = np.shape(r["scan0"]["moment_0"])
+        azimuths, elevations = [], []
+        for i in range(elcnt):
+            slab = "scan" + str(i)
+            rayhead = np.array(r[slab]["ray_header"])
+            azimuths.append(np.array([ray[0] for ray in rayhead]))
+            elevations.append(np.array([ray[2] for ray in rayhead]))
+            for mom in momlab:
+                attrs = r[slab][mom].attrs
+                div = 254.0 if str(_first(attrs["format"])) == "UV8" else 65534.0
+                low = _first(attrs["dyn_range_min"])
+                high = _first(attrs["dyn_range_max"])
+                tmp = np.zeros(shp)
+                tmp[:, : r[slab][mom].shape[1]] = np.array(r[slab][mom])
+                invalid = tmp
+                tmp = low + tmp * (high - low) / div
+                tmp[np.where(invalid == 0)] = bad
+                if np.size(data[mom]) > 0:
+                    data[mom] = np.append(data[mom], tmp, axis=0)
+                else:
+                    data[mom] = tmp
+                data[mom] = np.ma.masked_where(data[mom] == bad, data[mom])
+        stamps = [
+            dt.datetime.strptime(
+                str(_first(r["scan%d" % i]["how"].attrs["timestamp"])),
+                "%Y-%m-%dT%H:%M:%S.000Z",
+            )
+            for i in range(elcnt)
+        ]
+        speeds = [
+            _first(r["scan%d" % i]["how"].attrs["scan_speed"]) for i in range(elcnt)
+        ]
+        x = [(t2 - t1).total_seconds() for t1, t2 in zip(stamps[:-1], stamps[1:])]
+        y = speeds[:-1]
+        totsec = None
+        if np.ptp(y) > 0:
+            m, b = np.polyfit(x, y, 1)
+            totsec = np.sum(x) + np.round((speeds[-1] - b) / m)
+        dstart = stamps[0]
+    azimuths = np.concatenate(azimuths)
+    elevations = np.concatenate(elevations)
+    nrays = len(azimuths)
+    times = None
+    if totsec is not None:
+        dtime = [
+            dstart + dt.timedelta(microseconds=int(j * 1e6 * totsec / nrays))
+            for j in np.arange(nrays)
+        ]
+        times = np.array([(t - dtime[0]).total_seconds() for t in dtime])
+    fixed_angle = np.unique(elevations)
+    starts = [np.min(np.where(elevations == ang)[0]) for ang in fixed_angle]
+    ends = [np.max(np.where(elevations == ang)[0]) for ang in fixed_angle]
+    return {
+        "fields": data,
+        "azimuth": azimuths,
+        "elevation": elevations,
+        "time": times,
+        "scan_start": np.array([(t - dstart).total_seconds() for t in stamps]),
+        "sweep_start": np.array(starts),
+        "sweep_end": np.array(ends),
+    }
+
+
+@pytest.fixture(params=["xpol_cmp", "xpol_relampago"])
+def volume(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_matches_multi_pass(volume):
+    radar = read_rainbow_hdf5(volume)
+    reference = multi_pass_reference(volume)
+    for mom, data in reference["fields"].items():
+        field = radar.fields[FIELD_NAMES[mom]]["data"]
+        np.testing.assert_array_equal(np.ma.getmaskarray(field), data.mask)
+        np.testing.assert_allclose(field.compressed(), data.compressed())
+    np.testing.assert_array_equal(radar.azimuth["data"], reference["azimuth"])
+    np.testing.assert_array_equal(radar.elevation["data"], reference["elevation"])
+    if reference["time"] is not None:
+        np.testing.assert_allclose(
+            radar.time["data"], reference["time"], atol=1e-6
+        )
+    else:
+        times = radar.time["data"]
+        assert times[0] == 0
+        assert np.all(np.diff(times) >= 0)
+        assert times[-1] >= reference["scan_start"][-1]
+    # the sample volumes have one sweep per distinct elevation, so both
+    # ways of finding the sweeps agree
+    np.testing.assert_array_equal(
+        radar.sweep_start_ray_index["data"], reference["sweep_start"]
+    )
+    np.testing.assert_array_equal(
+        radar.sweep_end_ray_index["data"], reference["sweep_end"]
+    )
+
+
+def test_repeated_and_jittered_elevations(xpol_cmp, tmp_path):
+    # scan1 repeats the elevation of scan0, and the rays of scan2 jitter
+    filename = str(tmp_path / "repeated.HDF5")
+    shutil.copy(xpol_cmp, filename)
+    with h5py.File(filename, "r+") as r:
+        header = r["scan0"]["ray_header"][()]
+        elevation = header.dtype.names[2]
+        repeated = r["scan1"]["ray_header"][()]
+        repeated[elevation] = header[elevation]
+        r["scan1"]["ray_header"][...] = repeated
+        if "elevation" in r["scan1"]["how"].attrs:
+            r["scan1"]["how"].attrs["elevation"] = r["scan0"]["how"].attrs[
+                "elevation"
+            ]
+        jittered = r["scan2"]["ray_header"][()]
+        jittered[elevation] += np.linspace(-0.05, 0.05, len(jittered))
+        r["scan2"]["ray_header"][...] = jittered
+        nrays = [r["scan%d" % i]["moment_0"].shape[0] for i in range(17)]
+
+    radar = read_rainbow_hdf5(filename)
+    original = read_rainbow_hdf5(xpol_cmp)
+    ends = np.cumsum(nrays) - 1
+    assert radar.nsweeps == 17
+    np.testing.assert_array_equal(radar.sweep_end_ray_index["data"], ends)
+    np.testing.assert_array_equal(
+        radar.sweep_start_ray_index["data"], ends - np.array(nrays) + 1
+    )
+    assert radar.fixed_angle["data"][1] == radar.fixed_angle["data"][0]
+    assert radar.fixed_angle["data"][2] == pytest.approx(
+        original.fixed_angle["data"][2], abs=0.01
+    )
+    for sweep in [0, 1, 2]:
+        np.testing.assert_array_equal(
+            radar.get_field(sweep, "reflectivity"),
+            original.get_field(sweep, "reflectivity"),
+        )
+
+    # the multi-pass reader merges the repeated sweeps and splits the
+    # jittered one
+    reference = multi_pass_reference(filename)
+    assert len(reference["sweep_start"]) != 17
+
+
+def _best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def test_single_pass_is_faster(xpol_cmp):
+    single = _best_of(lambda: read_rainbow_hdf5(xpol_cmp))
+    multi = _best_of(lambda: multi_pass_reference(xpol_cmp))
+    assert single < multi
+
+
+def test_ray_times_vectorized():
+    nrays, totsec = 36000, 431.0
+    start = dt.datetime(2017, 11, 15, 21, 50, 6)
+
+    def per_ray():
+        dtime = [
+            start + dt.timedelta(microseconds=int(j * 1e6 * totsec / nrays))
+            for j in np.arange(nrays)
+        ]
+        return np.array([(t - dtime[0]).total_seconds() for t in dtime])
+
+    expected = per_ray()
+    np.testing.assert_allclose(
+        _ray_times(np.arange(nrays), nrays, totsec), expected, atol=1e-6
+    )
+    vectorized = _best_of(lambda: _ray_times(np.arange(nrays), nrays, totsec))
+    assert vectorized * 10 < _best_of(per_ray, repeat=1)
@@ -0,0 +1,85 @@
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+
+from read_fcth_cappis import VOLUME_HEIGHTS, read_fcth_cappi, read_fcth_cappis
+
+
+@pytest.fixture
+def volume(tmp_path):
+    """A 15-level volume, as .dat and .dat.gz, and its levels."""
+    rng = np.random.default_rng(0)
+    cube = rng.uniform(-10, 70, (15, 500, 500)).astype("<f4")
+    cube[:, :10] = 100.0
+    cube[:, :, :10] = -99.0
+    filename = str(tmp_path / "RADL08061720170314182730.dat")
+    cube.tofile(filename)
+    with open(filename, "rb") as f, gzip.open(filename + ".gz", "wb") as g:
+        shutil.copyfileobj(f, g)
+    return filename, filename + ".gz", cube
+
+
+def _assert_grids_equal(grid, expected):
+    assert list(grid.fields) == list(expected.fields)
+    np.testing.assert_array_equal(grid.z["data"], expected.z["data"])
+    for name, field in grid.fields.items():
+        data = expected.fields[name]["data"]
+        assert field["data"].dtype == data.dtype
+        np.testing.assert_array_equal(
+            np.ma.getmaskarray(field["data"]), np.ma.getmaskarray(data)
+        )
+        np.testing.assert_array_equal(field["data"].filled(0), data.filled(0))
+
+
+def test_gzip_matches_dat(fcth_cappi, tmp_path):
+    filename = str(tmp_path / "cappi_CZ_16000_20170314_1827.dat")
+    with gzip.open(fcth_cappi, "rb") as f, open(filename, "wb") as out:
+        shutil.copyfileobj(f, out)
+    grid = read_fcth_cappi(filename)
+    assert grid.fields["corrected_reflectivity"]["data"].shape == (1, 500, 500)
+    np.testing.assert_array_equal(grid.z["data"], [16000.0])
+    _assert_grids_equal(read_fcth_cappi(fcth_cappi), grid)
+
+
+def test_z_levels(volume):
+    filename, compressed, cube = volume
+    # the nearest levels, in the requested order, with repeats
+    z_levels = [4100.0, 2000.0, 15700.0, 4000.0]
+    grid = read_fcth_cappi(filename, z_levels=z_levels)
+    np.testing.assert_array_equal(grid.z["data"], [4000, 2000, 16000, 4000])
+    data = grid.fields["reflectivity"]["data"]
+    # the y axis is flipped to south to north
+    np.testing.assert_array_equal(data.data, cube[[2, 0, 14, 2], ::-1])
+    missing = (cube >= 100) | (cube == -99)
+    np.testing.assert_array_equal(
+        np.ma.getmaskarray(data), missing[[2, 0, 14, 2], ::-1]
+    )
+    _assert_grids_equal(read_fcth_cappi(compressed, z_levels=z_levels), grid)
+
+    full = read_fcth_cappi(compressed)
+    np.testing.assert_array_equal(full.z["data"], VOLUME_HEIGHTS)
+    np.testing.assert_array_equal(
+        full.fields["reflectivity"]["data"].data, cube[:, ::-1]
+    )
+
+
+def test_read_many(volume):
+    filename, compressed, _ = volume
+    grids = read_fcth_cappis([filename, compressed], z_levels=[3000.0], workers=2)
+    expected = read_fcth_cappi(filename, z_levels=[3000.0])
+    for grid in grids:
+        _assert_grids_equal(grid, expected)
+
+
+def test_truncated_gzip(volume, tmp_path):
+    _, compressed, _ = volume
+    truncated = str(tmp_path / "RADL08061720170314183000.dat.gz")
+    with open(compressed, "rb") as f:
+        content = f.read()
+    # keep the gzip trailer, with the size of the whole volume
+    with open(truncated, "wb") as f:
+        f.write(content[: len(content) // 2] + content[-8:])
+    with pytest.raises((ValueError, EOFError, OSError)):
+        read_fcth_cappi(truncated, z_levels=[16000.0])
@@ -0,0 +1,19 @@
+import netCDF4
+import pytest
+
+from benchmark_readers import make_mmclx
+from read_mira_radar import read_multi_mira
+
+
+def test_field_missing_in_a_file(tmp_path):
+    filenames = [str(tmp_path / ("%d.mmclx" % i)) for i in range(2)]
+    for i, filename in enumerate(filenames):
+        make_mmclx(filename, 1489500000 + 3600 * i, ntimes=20, ngates=50, seed=i)
+    with netCDF4.Dataset(filenames[1], "a") as d:
+        d.renameVariable("LDR", "LDR_renamed")
+
+    full = read_multi_mira(filenames[:1])[0]
+    with pytest.warns(UserWarning, match="not present in all files"):
+        radar = read_multi_mira(filenames)[0]
+    assert set(full.fields) - set(radar.fields) == {"LDR"}
+    assert radar.nrays == 40
@@ -0,0 +1,65 @@
+import copy
+import os
+
+import numpy as np
+import pytest
+
+from read_rainbow_vol import _check_geometry, _decode_vol, read_rainbow_vol
+
+
+def _assert_radars_equal(radar, expected):
+    assert sorted(radar.fields) == sorted(expected.fields)
+    for name in ["time", "range", "azimuth", "elevation", "fixed_angle"]:
+        np.testing.assert_array_equal(
+            getattr(radar, name)["data"], getattr(expected, name)["data"]
+        )
+    for name, field in radar.fields.items():
+        data = expected.fields[name]["data"]
+        np.testing.assert_array_equal(
+            np.ma.getmaskarray(field["data"]), np.ma.getmaskarray(data)
+        )
+        np.testing.assert_array_equal(field["data"].filled(0), data.filled(0))
+
+
+def test_pool_matches_serial(fcth_vol):
+    radar = read_rainbow_vol(fcth_vol)
+    assert len(radar.fields) == 8
+    assert radar.fields["corrected_reflectivity"]["data"].shape == (
+        radar.nrays,
+        radar.ngates,
+    )
+    _assert_radars_equal(read_rainbow_vol(fcth_vol, workers=2), radar)
+
+    # a list of files, in another order, and a subset of the fields
+    fields = ["velocity", "corrected_reflectivity"]
+    subset = read_rainbow_vol(
+        [fcth_vol + "V.vol", fcth_vol + "dBZ.vol", fcth_vol + "W.vol"],
+        include_fields=fields,
+        workers=2,
+    )
+    assert sorted(subset.fields) == sorted(fields)
+    for name in fields:
+        np.testing.assert_array_equal(
+            subset.fields[name]["data"], radar.fields[name]["data"]
+        )
+
+
+def test_geometry_mismatch(fcth_vol):
+    fnames = [fcth_vol + "dBZ.vol", fcth_vol + "V.vol"]
+    vols = [_decode_vol(f) for f in fnames]
+    _check_geometry(vols, fnames)
+
+    turned = copy.deepcopy(vols[1])
+    turned["sweeps"][2]["angle"] = turned["sweeps"][2]["angle"] + 1.0
+    with pytest.raises(ValueError, match="Sweep 2 of .*V.vol"):
+        _check_geometry([vols[0], turned], fnames)
+
+    shorter = copy.deepcopy(vols[1])
+    shorter["sweeps"] = shorter["sweeps"][:-1]
+    with pytest.raises(ValueError, match="sweeps"):
+        _check_geometry([vols[0], shorter], fnames)
+
+    gates = copy.deepcopy(vols[1])
+    gates["sweeps"][0]["codes"] = gates["sweeps"][0]["codes"][:, :-1]
+    with pytest.raises(ValueError, match=os.path.basename(fnames[1])):
+        _check_geometry([vols[0], gates], fnames)
@@ -0,0 +1,118 @@
+import netCDF4
+import numpy as np
+import pytest
+
+from read_sipam_cappis import read_sipam_cappi_stack
+
+SHAPE = (5, 30, 40)
+FIELDS = ["DBZc", "VEL"]
+
+
+def _write_cappi(filename, minutes, seed, x0=None):
+    """SIPAM CAPPI file with random int16 packed fields, partly missing."""
+    rng = np.random.default_rng(seed)
+    nz, ny, nx = SHAPE
+    with netCDF4.Dataset(filename, "w") as dset:
+        dset.createDimension("time", 1)
+        for dim, n in [("z0", nz), ("y0", ny), ("x0", nx)]:
+            dset.createDimension(dim, n)
+        time = dset.createVariable("time", "f8", ("time",))
+        time.units = "seconds since 2014-03-01 00:00:00"
+        time[:] = [60.0 * minutes]
+        if x0 is None:
+            x0 = np.arange(nx) * 2.0 - 40.0
+        for dim, values in [
+            ("x0", x0),
+            ("y0", np.arange(ny) * 2.0 - 30.0),
+            ("z0", np.arange(nz) * 1.0 + 2.0),
+        ]:
+            var = dset.createVariable(dim, "f4", (dim,))
+            var.units = "km"
+            var[:] = values
+        grid_mapping = dset.createVariable("grid_mapping_0", "i4")
+        grid_mapping.grid_mapping_name = "azimuthal_equidistant"
+        grid_mapping.latitude_of_projection_origin = -3.149
+        grid_mapping.longitude_of_projection_origin = -59.992
+        for field in FIELDS:
+            var = dset.createVariable(
+                field, "i2", ("time", "z0", "y0", "x0"), fill_value=-32768
+            )
+            var.scale_factor = 0.01
+            var.add_offset = 0.0
+            var.units = "dBZ" if field == "DBZc" else "m/s"
+            data = np.ma.masked_array(rng.uniform(-20, 60, (1,) + SHAPE))
+            data[rng.uniform(size=data.shape) < 0.3] = np.ma.masked
+            var[:] = data
+
+
+@pytest.fixture
+def cappis(tmp_path):
+    filenames = []
+    for i in range(4):
+        filename = str(tmp_path / ("sbmn_cappi_20140301_%04d.nc" % (12 * i)))
+        _write_cappi(filename, 12 * i, i)
+        filenames.append(filename)
+    return filenames
+
+
+def _assert_stacks_equal(stack, expected):
+    np.testing.assert_array_equal(stack["time"], expected["time"])
+    for dim in ["x", "y", "z"]:
+        np.testing.assert_array_equal(stack[dim]["data"], expected[dim]["data"])
+    assert sorted(stack["fields"]) == sorted(expected["fields"])
+    for field, dic in stack["fields"].items():
+        np.testing.assert_array_equal(dic["data"], expected["fields"][field]["data"])
+
+
+def test_serial_pool_memmap(cappis, tmp_path):
+    stack = read_sipam_cappi_stack(cappis)
+    assert sorted(stack["fields"]) == FIELDS
+    cube = stack["fields"]["DBZc"]["data"]
+    assert cube.shape == (4,) + SHAPE and cube.dtype == np.float32
+    assert 0 < np.isnan(cube).sum() < cube.size
+    times = np.datetime64("2014-03-01T00:00", "s") + np.arange(4) * 720
+    np.testing.assert_array_equal(stack["time"], times)
+    with netCDF4.Dataset(cappis[2]) as dset:
+        expected = np.ma.filled(dset.variables["VEL"][0].astype("float32"), np.nan)
+    np.testing.assert_array_equal(stack["fields"]["VEL"]["data"][2], expected)
+
+    _assert_stacks_equal(read_sipam_cappi_stack(cappis, workers=2), stack)
+    memmap_dir = tmp_path / "memmap"
+    memmap_dir.mkdir()
+    mapped = read_sipam_cappi_stack(cappis, workers=2, memmap_dir=str(memmap_dir))
+    _assert_stacks_equal(mapped, stack)
+    assert isinstance(mapped["fields"]["VEL"]["data"], np.memmap)
+    np.testing.assert_array_equal(
+        np.load(str(memmap_dir / "DBZc.npy")), stack["fields"]["DBZc"]["data"]
+    )
+
+
+def test_levels_and_region(cappis):
+    stack = read_sipam_cappi_stack(cappis)
+    subset = read_sipam_cappi_stack(
+        cappis, fields=["VEL"], z_levels=[5900.0, 3000.0], workers=2
+    )
+    np.testing.assert_array_equal(subset["z"]["data"], [3000.0, 6000.0])
+    np.testing.assert_array_equal(
+        subset["fields"]["VEL"]["data"], stack["fields"]["VEL"]["data"][:, [1, 4]]
+    )
+
+    # about 11 km around the radar
+    region = read_sipam_cappi_stack(cappis, bbox=(-60.1, -3.25, -59.9, -3.05))
+    x = np.searchsorted(stack["x"]["data"], region["x"]["data"])
+    y = np.searchsorted(stack["y"]["data"], region["y"]["data"])
+    np.testing.assert_array_equal(stack["x"]["data"][x], region["x"]["data"])
+    np.testing.assert_array_equal(stack["y"]["data"][y], region["y"]["data"])
+    assert 5 < len(x) < SHAPE[2] and 5 < len(y) < SHAPE[1]
+    np.testing.assert_array_equal(
+        region["fields"]["DBZc"]["data"],
+        stack["fields"]["DBZc"]["data"][:, :, y[0] : y[-1] + 1, x[0] : x[-1] + 1],
+    )
+
+
+def test_grid_mismatch(cappis, tmp_path):
+    other = str(tmp_path / "sbmn_cappi_20140301_0048.nc")
+    _write_cappi(other, 48, 4, x0=np.arange(SHAPE[2]) * 2.0 - 39.0)
+    for workers in [None, 2]:
+        with pytest.raises(ValueError, match="x0"):
+            read_sipam_cappi_stack(cappis + [other], workers=workers)
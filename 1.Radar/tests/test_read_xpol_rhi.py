@@ -0,0 +1,86 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from read_xpol_rhi import (
+    PROD_FILL,
+    RHI_ELEVATIONS,
+    map_rhi_product,
+    read_xpol_rhi,
+    read_xpol_rhi_batch,
+)
+
+
+@pytest.fixture
+def products(xpol_relampago):
+    files = sorted(
+        glob.glob(os.path.join(os.path.dirname(xpol_relampago), "*.rhi.PROD"))
+    )
+    if len(files) != 8:
+        pytest.skip("RHI product files not found")
+    return files
+
+
+def test_read_xpol_rhi(products, xpol_relampago):
+    radar = read_xpol_rhi(products, xpol_relampago)
+    assert radar.scan_type == "rhi"
+    assert radar.nsweeps == 1
+    assert radar.nrays == len(RHI_ELEVATIONS) == 121
+    np.testing.assert_array_equal(radar.elevation["data"], RHI_ELEVATIONS)
+    assert np.all(radar.azimuth["data"] == 0.0)
+    assert radar.time["units"] == "seconds since 2018-11-27T13:28:07Z"
+    assert len(radar.fields) == 8
+    for field in radar.fields.values():
+        assert field["data"].shape == (radar.nrays, radar.ngates)
+        assert field["data"].dtype == np.float32
+
+
+def test_gate_pixels(products, xpol_relampago):
+    radar = read_xpol_rhi(products, xpol_relampago)
+    image = map_rhi_product(products[-2])
+    assert products[-2].endswith("dBZ.rhi.PROD")
+    assert isinstance(image, np.memmap)
+    assert image.shape == (400, 500) and image.dtype == np.float32
+
+    # pixel of each gate, from the gate heights and ground distances, for
+    # gates not within 1 m of the edge of a pixel, where the float32 gate
+    # coordinates of pyart may round to the next one
+    ground = np.hypot(radar.gate_x["data"], radar.gate_y["data"])
+    height = np.maximum(radar.gate_z["data"], 0)
+    rows = 399 - np.floor(height / 50.0).astype(int)
+    cols = np.floor(ground / 200.0).astype(int)
+    edge = (np.abs(height - np.round(height / 50.0) * 50.0) < 1.0) & (height > 1.0)
+    edge |= np.abs(ground - np.round(ground / 200.0) * 200.0) < 1.0
+    inside = (rows >= 0) & (cols < 500) & ~edge
+    data = radar.fields["reflectivity"]["data"]
+    expected = image[rows[inside], cols[inside]]
+    np.testing.assert_array_equal(
+        np.ma.getmaskarray(data)[inside], expected == PROD_FILL
+    )
+    np.testing.assert_array_equal(data.filled(PROD_FILL)[inside], expected)
+    assert np.all(np.ma.getmaskarray(data)[(rows < 0) | (cols >= 500)])
+    assert np.ma.count(data) > 0
+
+
+def test_batch_and_size(products, xpol_relampago, tmp_path):
+    # the same RHI copied at another azimuth
+    copies = []
+    for filename in products:
+        copy = str(tmp_path / os.path.basename(filename).replace("000_", "090_"))
+        shutil.copy(filename, copy)
+        copies.append(copy)
+    radars = read_xpol_rhi_batch(products + copies, xpol_relampago)
+    assert [radar.fixed_angle["data"][0] for radar in radars] == [0.0, 90.0]
+    np.testing.assert_array_equal(
+        radars[1].fields["velocity"]["data"], radars[0].fields["velocity"]["data"]
+    )
+    with pytest.raises(ValueError):
+        read_xpol_rhi(products + copies, xpol_relampago)
+
+    with open(copies[0], "r+b") as f:
+        f.truncate(1000)
+    with pytest.raises(ValueError):
+        read_xpol_rhi(copies, xpol_relampago)
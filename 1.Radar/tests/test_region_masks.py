@@ -0,0 +1,50 @@
+import os
+import shutil
+
+import numpy as np
+import shapefile
+
+from region_masks import RegionMasker
+
+
+def _write_shapefile(base, name):
+    with shapefile.Writer(base, shapeType=shapefile.POLYGON) as w:
+        w.field("name", "C", size=10)
+        w.poly([[(-47.0, -24.0), (-46.0, -24.0), (-46.0, -23.0), (-47.0, -23.0)]])
+        w.record(name)
+
+
+def test_regions_cached(tmp_path):
+    base = str(tmp_path / "square")
+    _write_shapefile(base, "inside")
+    lon, lat = np.meshgrid(np.arange(-48, -45, 0.5), np.arange(-25, -22, 0.5))
+    masker = RegionMasker(cache_dir=str(tmp_path / "cache"))
+    regions = masker.regions(lon, lat, base + ".shp", attribute="name")
+    assert regions.names == ["inside"]
+    assert regions.labels.sum() == 9
+    masker.regions(lon, lat, base + ".shp", attribute="name")
+    loaded = RegionMasker(cache_dir=str(tmp_path / "cache"))
+    np.testing.assert_array_equal(
+        loaded.regions(lon, lat, base + ".shp", attribute="name").labels,
+        regions.labels,
+    )
+    assert masker.stats() == {"hits": 1, "loads": 0, "builds": 1}
+    assert loaded.stats() == {"hits": 0, "loads": 1, "builds": 0}
+
+
+def test_dbf_change_invalidates(tmp_path):
+    base = str(tmp_path / "square")
+    _write_shapefile(base, "before")
+    _write_shapefile(str(tmp_path / "renamed"), "after")
+    lon, lat = np.meshgrid(np.arange(-48, -45, 0.5), np.arange(-25, -22, 0.5))
+    masker = RegionMasker()
+    assert masker.regions(lon, lat, base, attribute="name").names == ["before"]
+
+    # only the attributes change, the .shp is left as it was
+    shp = os.stat(base + ".shp")
+    shutil.copy(str(tmp_path / "renamed.dbf"), base + ".dbf")
+    dbf = os.stat(base + ".dbf")
+    os.utime(base + ".dbf", ns=(dbf.st_atime_ns, dbf.st_mtime_ns + 10**9))
+    assert os.stat(base + ".shp").st_mtime_ns == shp.st_mtime_ns
+    assert masker.regions(lon, lat, base, attribute="name").names == ["after"]
+    assert masker.stats()["builds"] == 2
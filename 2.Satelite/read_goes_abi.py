@@ -0,0 +1,522 @@
+"""
+Reading windows of GOES-16/17/18 ABI full disk images.
+
+Data source: https://registry.opendata.aws/noaa-goes/ (ABI-L1b-RadF and
+ABI-L2-CMIPF products, one NetCDF file per band and scan)
+
+ABI images are on the fixed grid of the GOES-R series: the 'x' and 'y'
+variables are the east-west and north-south scan angles, in radians, of
+the columns and rows, and 'goes_imager_projection' describes the
+geostationary projection (GOES-R Product User Guide, section 4.2.8). A
+full disk band 13 image has 5424 x 5424 pixels, of which the Sao Paulo
+region is about 1 %.
+
+`fixed_grid_window` finds the rows and columns covering a latitude /
+longitude box once per satellite geometry (projection, scan angles of the
+grid and box) and keeps them in memory, so `read_goes_abi` only reads that
+hyperslab of each file, as raw integers, and decodes it to float32 with
+the scale_factor and add_offset of the variable. `read_goes_abi_stack`
+reads many files into (time, y, x) cubes, with a pool of worker
+processes.
+
+Example
+-------
+>>> from read_goes_abi import read_goes_abi, read_goes_abi_stack
+>>> image = read_goes_abi(
+...     "OR_ABI-L2-CMIPF-M6C13_G16_s20200201200200_e20200201209520_c20200201210000.nc"
+... )
+>>> image["fields"]["CMI"]["data"].shape  # (rows, columns) of the window
+>>> filenames = sorted(glob.glob("OR_ABI-L2-CMIPF-M6C13*.nc"))
+>>> stack = read_goes_abi_stack(filenames, workers=4)
+>>> stack["fields"]["CMI"]["data"].shape  # (time, rows, columns)
+
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import netCDF4
+import numpy as np
+
+# (lon_min, lat_min, lon_max, lat_max) of the default regions
+SAO_PAULO_BBOX = (-49.0, -25.5, -44.0, -21.0)
+SOUTHEAST_BBOX = (-53.5, -25.5, -39.5, -14.0)
+
+# Image variables of the products, in order of preference
+IMAGE_VARIABLES = ["CMI", "Rad"]
+
+# Attributes describing the packing of a variable, not its decoded data
+_PACKING_ATTRS = [
+    "scale_factor",
+    "add_offset",
+    "_FillValue",
+    "_Unsigned",
+    "valid_range",
+]
+
+# Windows by geometry, see fixed_grid_window
+_windows = {}
+
+
+def _projection(dset):
+    """Parameters of the geostationary projection of an ABI file."""
+    proj = dset.variables["goes_imager_projection"]
+    return {
+        "perspective_point_height": float(proj.perspective_point_height),
+        "semi_major_axis": float(proj.semi_major_axis),
+        "semi_minor_axis": float(proj.semi_minor_axis),
+        "longitude_of_projection_origin": float(proj.longitude_of_projection_origin),
+        "sweep_angle_axis": str(proj.sweep_angle_axis),
+    }
+
+
+def geographic_to_fixed_grid(lon, lat, projection):
+    """
+    Scan angles x and y in radians of longitudes and latitudes, as in the
+    GOES-R Product User Guide. Points not seen by the satellite are NaN.
+
+    Parameters
+    ----------
+    lon, lat : array
+        Longitudes and latitudes in degrees.
+    projection : dict
+        Attributes of the goes_imager_projection variable.
+
+    Returns
+    -------
+    x, y : array
+        East-west and north-south scan angles, in radians.
+    """
+    req = projection["semi_major_axis"]
+    rpol = projection["semi_minor_axis"]
+    H = projection["perspective_point_height"] + req
+    lon_0 = np.deg2rad(projection["longitude_of_projection_origin"])
+    lon = np.deg2rad(np.asarray(lon, dtype="float64"))
+    lat = np.deg2rad(np.asarray(lat, dtype="float64"))
+    e2 = (req**2 - rpol**2) / req**2
+    # geocentric latitude and distance to the center of the Earth
+    phi_c = np.arctan(rpol**2 / req**2 * np.tan(lat))
+    r_c = rpol / np.sqrt(1 - e2 * np.cos(phi_c) ** 2)
+    s_x = H - r_c * np.cos(phi_c) * np.cos(lon - lon_0)
+    s_y = -r_c * np.cos(phi_c) * np.sin(lon - lon_0)
+    s_z = r_c * np.sin(phi_c)
+    x = np.arcsin(-s_y / np.sqrt(s_x**2 + s_y**2 + s_z**2))
+    y = np.arctan(s_z / s_x)
+    hidden = H * (H - s_x) < s_y**2 + req**2 / rpol**2 * s_z**2
+    x = np.where(hidden, np.nan, x)
+    y = np.where(hidden, np.nan, y)
+    return x, y
+
+
+def fixed_grid_to_geographic(x, y, projection):
+    """
+    Longitudes and latitudes in degrees of scan angles, as in the GOES-R
+    Product User Guide. Angles off the Earth disk are NaN.
+
+    Parameters
+    ----------
+    x, y : array
+        East-west and north-south scan angles in radians, broadcast
+        against each other (e.g. x[np.newaxis, :] and y[:, np.newaxis]).
+    projection : dict
+        Attributes of the goes_imager_projection variable.
+
+    Returns
+    -------
+    lon, lat : array
+        Longitudes and latitudes in degrees.
+    """
+    req = projection["semi_major_axis"]
+    rpol = projection["semi_minor_axis"]
+    H = projection["perspective_point_height"] + req
+    lon_0 = np.deg2rad(projection["longitude_of_projection_origin"])
+    x, y = np.broadcast_arrays(
+        np.asarray(x, dtype="float64"), np.asarray(y, dtype="float64")
+    )
+    a = np.sin(x) ** 2 + np.cos(x) ** 2 * (
+        np.cos(y) ** 2 + req**2 / rpol**2 * np.sin(y) ** 2
+    )
+    b = -2 * H * np.cos(x) * np.cos(y)
+    c = H**2 - req**2
+    with np.errstate(invalid="ignore"):
+        r_s = (-b - np.sqrt(b**2 - 4 * a * c)) / (2 * a)
+    s_x = r_s * np.cos(x) * np.cos(y)
+    s_y = -r_s * np.sin(x)
+    s_z = r_s * np.cos(x) * np.sin(y)
+    lat = np.arctan(req**2 / rpol**2 * s_z / np.sqrt((H - s_x) ** 2 + s_y**2))
+    lon = lon_0 - np.arctan(s_y / (H - s_x))
+    return np.rad2deg(lon), np.rad2deg(lat)
+
+
+def _axis_definition(ncvar):
+    """Size, scale_factor and add_offset of a packed scan angle variable."""
+    return (
+        len(ncvar),
+        float(getattr(ncvar, "scale_factor", 1.0)),
+        float(getattr(ncvar, "add_offset", 0.0)),
+    )
+
+
+class FixedGridWindow(object):
+    """
+    Rows and columns of a fixed grid image covering a latitude / longitude
+    box.
+
+    Attributes
+    ----------
+    rows, columns : slice
+        Index of the window in the y and x dimensions.
+    x, y : array
+        Scan angles of the columns and rows of the window, in radians.
+    projection : dict
+        Attributes of the goes_imager_projection variable.
+    bbox : tuple
+        (lon_min, lat_min, lon_max, lat_max) of the box.
+    """
+
+    def __init__(self, rows, columns, x, y, projection, bbox):
+        self.rows = rows
+        self.columns = columns
+        self.x = x
+        self.y = y
+        self.projection = projection
+        self.bbox = bbox
+        self._lonlat = None
+
+    @property
+    def shape(self):
+        return (len(self.y), len(self.x))
+
+    def lonlat(self):
+        """Longitude and latitude of the pixels of the window, (rows,
+        columns) arrays, computed on first use."""
+        if self._lonlat is None:
+            self._lonlat = fixed_grid_to_geographic(
+                self.x[np.newaxis, :], self.y[:, np.newaxis], self.projection
+            )
+        return self._lonlat
+
+
+def _geometry_key(dset, bbox):
+    """Key of the satellite geometry of an open file and a box."""
+    projection = _projection(dset)
+    return (
+        tuple(sorted(projection.items())),
+        _axis_definition(dset.variables["x"]),
+        _axis_definition(dset.variables["y"]),
+        tuple(np.round(bbox, 6)) if bbox is not None else None,
+    )
+
+
+def fixed_grid_window(dset, bbox=SAO_PAULO_BBOX):
+    """
+    Window of the fixed grid of an open ABI file covering a box, computed
+    once per geometry and kept in memory.
+
+    Parameters
+    ----------
+    dset : netCDF4.Dataset
+        Open ABI file.
+    bbox : tuple or None, optional
+        (lon_min, lat_min, lon_max, lat_max) of the region. None takes the
+        whole image.
+
+    Returns
+    -------
+    window : FixedGridWindow
+        Shared by all files with the same geometry, must not be changed.
+    """
+    key = _geometry_key(dset, bbox)
+    window = _windows.get(key)
+    if window is not None:
+        return window
+    projection = _projection(dset)
+    x = dset.variables["x"][:].astype("float64")
+    y = dset.variables["y"][:].astype("float64")
+    if bbox is None:
+        columns = slice(0, len(x))
+        rows = slice(0, len(y))
+    else:
+        # the box is curved on the fixed grid, so its edges are sampled to
+        # find its extent in x and y
+        lon_min, lat_min, lon_max, lat_max = bbox
+        edge = np.linspace(0, 1, 33)
+        ones = np.ones(33)
+        lons = lon_min + (lon_max - lon_min) * np.concatenate(
+            [edge, ones, edge[::-1], 0 * ones]
+        )
+        lats = lat_min + (lat_max - lat_min) * np.concatenate(
+            [0 * ones, edge, ones, edge[::-1]]
+        )
+        xs, ys = geographic_to_fixed_grid(lons, lats, projection)
+        if np.any(np.isnan(xs)):
+            raise ValueError("Box %s is not seen by the satellite" % (bbox,))
+        # x grows to the east and y to the north, so y decreases with the
+        # row
+        columns = slice(
+            int(np.searchsorted(x, xs.min(), side="left")),
+            int(np.searchsorted(x, xs.max(), side="right")),
+        )
+        rows = slice(
+            int(np.searchsorted(-y, -ys.max(), side="left")),
+            int(np.searchsorted(-y, -ys.min(), side="right")),
+        )
+        if columns.start == columns.stop or rows.start == rows.stop:
+            raise ValueError("Box %s is outside the image" % (bbox,))
+    window = FixedGridWindow(rows, columns, x[columns], y[rows], projection, bbox)
+    _windows[key] = window
+    return window
+
+
+def _ncvar_attrs(ncvar):
+    """
+    Attributes of a NetCDF variable, without the packing parameters.
+    """
+    return dict(
+        [(k, getattr(ncvar, k)) for k in ncvar.ncattrs() if k not in _PACKING_ATTRS]
+    )
+
+
+def _decode(ncvar, index):
+    """
+    Read a hyperslab of a packed variable as raw integers and decode it to
+    float32, NaN where it is the fill value or outside the valid range.
+    """
+    ncvar.set_auto_maskandscale(False)
+    raw = ncvar[index]
+    fill = getattr(ncvar, "_FillValue", None)
+    valid_range = getattr(ncvar, "valid_range", None)
+    if getattr(ncvar, "_Unsigned", "false") == "true":
+        # unsigned values stored as signed integers (e.g. Rad of L1b files)
+        unsigned = np.dtype("u%d" % raw.dtype.itemsize)
+        raw = raw.view(unsigned)
+        if fill is not None:
+            fill = np.asarray(fill, dtype=ncvar.dtype).view(unsigned)
+        if valid_range is not None:
+            valid_range = np.asarray(valid_range, dtype=ncvar.dtype).view(unsigned)
+    data = raw.astype(np.float32)
+    scale = getattr(ncvar, "scale_factor", None)
+    offset = getattr(ncvar, "add_offset", None)
+    if scale is not None:
+        data *= np.float32(scale)
+    if offset is not None:
+        data += np.float32(offset)
+    invalid = np.zeros(raw.shape, dtype=bool)
+    if fill is not None:
+        invalid |= raw == fill
+    if valid_range is not None:
+        invalid |= (raw < valid_range[0]) | (raw > valid_range[1])
+    data[invalid] = np.nan
+    return data
+
+
+def _image_variables(dset, variables=None):
+    """Variables to read, the first image variable of the product if
+    None."""
+    if variables is not None:
+        return list(variables)
+    for name in IMAGE_VARIABLES:
+        if name in dset.variables:
+            return [name]
+    raise KeyError("No image variable in the file: %s" % IMAGE_VARIABLES)
+
+
+def _scan_time(dset):
+    """Mid scan time of an ABI file, from its 't' variable."""
+    t = dset.variables["t"]
+    date = netCDF4.num2date(
+        t[:],
+        t.units,
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
+    return np.datetime64(date, "s")
+
+
+def read_goes_abi(filename, variables=None, bbox=SAO_PAULO_BBOX):
+    """
+    Read a window of an ABI full disk (or CONUS / mesoscale) file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the ABI NetCDF file (OR_ABI-L1b-RadF-*.nc,
+        OR_ABI-L2-CMIPF-*.nc, ...).
+    variables : list or None, optional
+        Variables of (y, x) dimensions to read, e.g. ['CMI', 'DQF']. None
+        reads CMI (L2) or Rad (L1b).
+    bbox : tuple or None, optional
+        (lon_min, lat_min, lon_max, lat_max) of the region to read. None
+        reads the whole image.
+
+    Returns
+    -------
+    image : dict
+        Dictionary with 'time' (datetime64 of the middle of the scan), 'x'
+        and 'y' dictionaries (scan angles in radians), 'window'
+        (FixedGridWindow), 'band_id', and 'fields', a dictionary of field
+        dictionaries whose 'data' is a (y, x) float32 array, NaN where data
+        is missing.
+    """
+    with netCDF4.Dataset(filename, mode="r") as dset:
+        window = fixed_grid_window(dset, bbox)
+        variables = _image_variables(dset, variables)
+        fields = {}
+        for name in variables:
+            ncvar = dset.variables[name]
+            fields[name] = _ncvar_attrs(ncvar)
+            fields[name]["data"] = _decode(ncvar, (window.rows, window.columns))
+        coords = {}
+        for dim, data in [("x", window.x), ("y", window.y)]:
+            coords[dim] = _ncvar_attrs(dset.variables[dim])
+            coords[dim]["data"] = data
+        band_id = None
+        if "band_id" in dset.variables:
+            band_id = int(np.asarray(dset.variables["band_id"][:]).ravel()[0])
+        time = _scan_time(dset)
+    return {
+        "time": time,
+        "x": coords["x"],
+        "y": coords["y"],
+        "window": window,
+        "band_id": band_id,
+        "fields": fields,
+    }
+
+
+def _read_abi_slab(filename, variables, rows, columns, key):
+    """
+    Read the window of some variables of an ABI file as float32 arrays,
+    with the scan time, checking the geometry of the file against key.
+    """
+    with netCDF4.Dataset(filename, mode="r") as dset:
+        if _geometry_key(dset, key[-1]) != key:
+            raise ValueError("Fixed grid of %s differs from the first file" % filename)
+        data = {}
+        for name in variables:
+            data[name] = _decode(dset.variables[name], (rows, columns))
+        return _scan_time(dset), data
+
+
+def read_goes_abi_stack(
+    filenames,
+    variables=None,
+    bbox=SAO_PAULO_BBOX,
+    workers=None,
+    memmap_dir=None,
+    as_xarray=False,
+):
+    """
+    Read the same window of a sequence of ABI files into (time, y, x)
+    cubes, one per variable.
+
+    The window is computed from the first file, and each cube is
+    allocated once as float32 (NaN where data is missing), optionally as a
+    memory-mapped .npy file, and filled in file order. All files must have
+    the same fixed grid as the first one.
+
+    Parameters
+    ----------
+    filenames : list of str
+        ABI files of the same product and band, in time order.
+    variables : list or None, optional
+        Variables to read, see read_goes_abi.
+    bbox : tuple or None, optional
+        (lon_min, lat_min, lon_max, lat_max) of the region to read.
+    workers : int or None, optional
+        Number of worker processes reading files in parallel. None reads
+        the files one by one in this process.
+    memmap_dir : str or None, optional
+        Directory where each cube is stored as a memory-mapped
+        <variable>.npy file. None keeps the cubes in memory.
+    as_xarray : bool, optional
+        True to return an xarray.Dataset wrapping the cubes (without
+        copying them), with longitude and latitude coordinates, instead of
+        a dictionary.
+
+    Returns
+    -------
+    stack : dict or xarray.Dataset
+        Dictionary with 'time' (datetime64 array), 'x' and 'y'
+        dictionaries (scan angles in radians), 'window' (FixedGridWindow)
+        and 'fields', a dictionary of field dictionaries whose 'data' is
+        the (time, y, x) cube.
+    """
+    with netCDF4.Dataset(filenames[0], mode="r") as dset:
+        window = fixed_grid_window(dset, bbox)
+        key = _geometry_key(dset, bbox)
+        variables = _image_variables(dset, variables)
+        attrs = {}
+        for name in variables:
+            attrs[name] = _ncvar_attrs(dset.variables[name])
+        coords = {}
+        for dim, data in [("x", window.x), ("y", window.y)]:
+            coords[dim] = _ncvar_attrs(dset.variables[dim])
+            coords[dim]["data"] = data
+
+    shape = (len(filenames),) + window.shape
+    cubes = {}
+    for name in variables:
+        if memmap_dir is None:
+            cubes[name] = np.empty(shape, dtype=np.float32)
+        else:
+            cubes[name] = np.lib.format.open_memmap(
+                os.path.join(memmap_dir, name + ".npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=shape,
+            )
+    times = np.empty(len(filenames), dtype="datetime64[s]")
+
+    reader = partial(
+        _read_abi_slab,
+        variables=variables,
+        rows=window.rows,
+        columns=window.columns,
+        key=key,
+    )
+    executor = None
+    if workers is None:
+        results = map(reader, filenames)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(reader, filenames)
+    try:
+        for i, (time, data) in enumerate(results):
+            times[i] = time
+            for name in variables:
+                cubes[name][i] = data[name]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if as_xarray:
+        import xarray as xr
+
+        lon, lat = window.lonlat()
+        data_vars = {}
+        for name in variables:
+            data_vars[name] = (("time", "y", "x"), cubes[name], dict(attrs[name]))
+        return xr.Dataset(
+            data_vars,
+            coords={
+                "time": times,
+                "y": window.y,
+                "x": window.x,
+                "lon": (("y", "x"), lon),
+                "lat": (("y", "x"), lat),
+            },
+        )
+
+    stack_fields = {}
+    for name in variables:
+        stack_fields[name] = dict(attrs[name])
+        stack_fields[name]["data"] = cubes[name]
+    return {
+        "time": times,
+        "x": coords["x"],
+        "y": coords["y"],
+        "window": window,
+        "fields": stack_fields,
+    }
@@ -0,0 +1,72 @@
+"""
+Shared fixtures of the satellite reader tests.
+
+The readers are modules of the 2.Satelite folder, not an installed
+package, so the folder is put on sys.path. The ABI files are small
+synthetic full disk images, written like the CMIPF band 13 product with a
+10 times coarser fixed grid (543 x 543 pixels).
+"""
+
+import os
+import sys
+
+import netCDF4
+import numpy as np
+import pytest
+
+SATELITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if SATELITE_DIR not in sys.path:
+    sys.path.insert(0, SATELITE_DIR)
+
+NPIXELS = 543
+# first scan time of the files, in seconds since 2000-01-01 12:00:00
+T0 = 633830400.0
+
+
+def write_abi(filename, index, npixels=NPIXELS, longitude=-75.0):
+    """Write a synthetic ABI L2 CMI file, the index-th of a sequence."""
+    rng = np.random.default_rng(index)
+    with netCDF4.Dataset(filename, "w") as d:
+        d.createDimension("x", npixels)
+        d.createDimension("y", npixels)
+        step = 0.303688 / (npixels - 1)
+        for dim, scale, offset in [("x", step, -0.151844), ("y", -step, 0.151844)]:
+            var = d.createVariable(dim, "i2", (dim,))
+            var.scale_factor = np.float32(scale)
+            var.add_offset = np.float32(offset)
+            var.units = "rad"
+            var.set_auto_scale(False)
+            var[:] = np.arange(npixels, dtype="i2")
+        proj = d.createVariable("goes_imager_projection", "i4")
+        proj.perspective_point_height = 35786023.0
+        proj.semi_major_axis = 6378137.0
+        proj.semi_minor_axis = 6356752.31414
+        proj.longitude_of_projection_origin = longitude
+        proj.sweep_angle_axis = "x"
+        cmi = d.createVariable("CMI", "i2", ("y", "x"), fill_value=np.int16(-1))
+        cmi.scale_factor = np.float32(0.06145332)
+        cmi.add_offset = np.float32(89.62)
+        cmi._Unsigned = "true"
+        # 0 to 40000 as unsigned, stored as signed like the data
+        cmi.valid_range = np.array([0, 40000], dtype="u2").view("i2")
+        cmi.units = "K"
+        cmi.set_auto_maskandscale(False)
+        raw = rng.integers(0, 45000, (npixels, npixels)).astype("u2")
+        raw[rng.random((npixels, npixels)) < 0.05] = 65535  # fill value
+        cmi[:] = raw.view("i2")
+        t = d.createVariable("t", "f8")
+        t.units = "seconds since 2000-01-01 12:00:00"
+        t[:] = T0 + 600.0 * index
+        band = d.createVariable("band_id", "i1")
+        band[:] = 13
+
+
+@pytest.fixture
+def abi_files(tmp_path):
+    filenames = []
+    for i in range(3):
+        filename = str(tmp_path / ("OR_ABI-L2-CMIPF-M6C13_G16_%d.nc" % i))
+        write_abi(filename, i)
+        filenames.append(filename)
+    return filenames
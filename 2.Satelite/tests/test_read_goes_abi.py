@@ -0,0 +1,134 @@
+import os
+
+import netCDF4
+import numpy as np
+import pytest
+
+from conftest import T0, write_abi
+from read_goes_abi import (
+    SAO_PAULO_BBOX,
+    fixed_grid_to_geographic,
+    fixed_grid_window,
+    geographic_to_fixed_grid,
+    read_goes_abi,
+    read_goes_abi_stack,
+)
+
+
+def _expected(filename, window):
+    """CMI of the window of a file, decoded from all the raw values."""
+    with netCDF4.Dataset(filename) as d:
+        cmi = d.variables["CMI"]
+        cmi.set_auto_maskandscale(False)
+        raw = cmi[:].view("u2")[window.rows, window.columns]
+        data = raw * float(cmi.scale_factor) + float(cmi.add_offset)
+    return np.where((raw == 65535) | (raw > 40000), np.nan, data)
+
+
+def test_fixed_grid_round_trip():
+    projection = {
+        "perspective_point_height": 35786023.0,
+        "semi_major_axis": 6378137.0,
+        "semi_minor_axis": 6356752.31414,
+        "longitude_of_projection_origin": -75.0,
+        "sweep_angle_axis": "x",
+    }
+    lon, lat = np.meshgrid(np.arange(-80, -30, 5.0), np.arange(-50, 20, 5.0))
+    x, y = geographic_to_fixed_grid(lon, lat, projection)
+    lon2, lat2 = fixed_grid_to_geographic(x, y, projection)
+    np.testing.assert_allclose(lon2, lon, atol=1e-6)
+    np.testing.assert_allclose(lat2, lat, atol=1e-6)
+    # the other side of the Earth is not seen
+    assert np.isnan(geographic_to_fixed_grid(105.0, 0.0, projection)[0])
+
+
+def test_window(abi_files):
+    with netCDF4.Dataset(abi_files[0]) as d:
+        window = fixed_grid_window(d, SAO_PAULO_BBOX)
+        whole = fixed_grid_window(d, None)
+    with netCDF4.Dataset(abi_files[1]) as d:
+        assert fixed_grid_window(d, SAO_PAULO_BBOX) is window
+    assert whole.shape == (543, 543)
+    # about 20 km pixels over a 500 km box
+    assert 20 < window.shape[0] < 40 and 20 < window.shape[1] < 40
+    # the window is the smallest one covering the edges of the box
+    lon_min, lat_min, lon_max, lat_max = SAO_PAULO_BBOX
+    edge = np.linspace(0, 1, 100)
+    lons = np.concatenate([lon_min + (lon_max - lon_min) * edge, [lon_min, lon_max]])
+    lats = np.concatenate([[lat_min, lat_max], lat_min + (lat_max - lat_min) * edge])
+    lons, lats = np.meshgrid(lons, lats)
+    xs, ys = geographic_to_fixed_grid(lons, lats, window.projection)
+    dx = window.x[1] - window.x[0]
+    dy = window.y[0] - window.y[1]
+    assert window.x[0] - dx < xs.min() <= window.x[0]
+    assert window.x[-1] <= xs.max() < window.x[-1] + dx
+    assert window.y[0] <= ys.max() < window.y[0] + dy
+    assert window.y[-1] - dy < ys.min() <= window.y[-1]
+    lon, lat = window.lonlat()
+    assert lon.shape == window.shape
+    center = (window.shape[0] // 2, window.shape[1] // 2)
+    assert lon_min < lon[center] < lon_max and lat_min < lat[center] < lat_max
+
+
+def test_window_not_seen(tmp_path):
+    filename = str(tmp_path / "east.nc")
+    write_abi(filename, 0, longitude=105.0)
+    with netCDF4.Dataset(filename) as d:
+        with pytest.raises(ValueError):
+            fixed_grid_window(d, SAO_PAULO_BBOX)
+
+
+def test_decode(abi_files):
+    image = read_goes_abi(abi_files[0])
+    window = image["window"]
+    cmi = image["fields"]["CMI"]
+    assert cmi["data"].dtype == np.float32
+    assert cmi["data"].shape == window.shape
+    assert cmi["units"] == "K"
+    for attr in ["scale_factor", "add_offset", "_FillValue", "_Unsigned"]:
+        assert attr not in cmi
+    expected = _expected(abi_files[0], window)
+    assert np.isnan(expected).any() and (expected > 89.62 + 0.0615 * 32767).any()
+    np.testing.assert_allclose(cmi["data"], expected, rtol=1e-6)
+    np.testing.assert_array_equal(image["x"]["data"], window.x)
+    assert image["band_id"] == 13
+    assert image["time"] == np.datetime64("2020-02-01T12:00:00")
+
+
+def test_stack(abi_files, tmp_path):
+    serial = read_goes_abi_stack(abi_files)
+    stack = read_goes_abi_stack(abi_files, workers=2, memmap_dir=str(tmp_path))
+    window = stack["window"]
+    cube = stack["fields"]["CMI"]["data"]
+    assert isinstance(cube, np.memmap)
+    assert cube.shape == (3,) + window.shape
+    for i, filename in enumerate(abi_files):
+        np.testing.assert_allclose(cube[i], _expected(filename, window), rtol=1e-6)
+    np.testing.assert_array_equal(cube, serial["fields"]["CMI"]["data"])
+    np.testing.assert_array_equal(
+        stack["time"] - stack["time"][0], np.array([0, 600, 1200], "timedelta64[s]")
+    )
+    cube.flush()
+    np.testing.assert_array_equal(np.load(str(tmp_path / "CMI.npy")), cube)
+
+
+def test_stack_geometry_mismatch(abi_files, tmp_path):
+    other = str(tmp_path / "other.nc")
+    write_abi(other, 3, npixels=600)
+    with pytest.raises(ValueError):
+        read_goes_abi_stack(abi_files + [other])
+
+
+def test_stack_as_xarray(abi_files):
+    pytest.importorskip("xarray")
+    stack = read_goes_abi_stack(abi_files)
+    ds = read_goes_abi_stack(abi_files, as_xarray=True)
+    assert ds["CMI"].dims == ("time", "y", "x")
+    assert ds["CMI"].attrs["units"] == "K"
+    np.testing.assert_array_equal(ds["CMI"].values, stack["fields"]["CMI"]["data"])
+    lon, lat = stack["window"].lonlat()
+    np.testing.assert_array_equal(ds["lon"].values, lon)
+    np.testing.assert_array_equal(ds["lat"].values, lat)
+    assert ds["time"].values[0] == np.datetime64(
+        "2000-01-01T12:00:00"
+    ) + np.timedelta64(int(T0), "s")